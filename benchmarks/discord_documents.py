@@ -0,0 +1,167 @@
+"""
+Benchmark DiscordMessageProcessor document building on a synthetic channel.
+
+Compares the current copy free implementation against the old deepcopy based
+one (kept here as the baseline) for runtime and peak memory.
+
+    python -m benchmarks.discord_documents --messages 100000
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+from copy import deepcopy
+from dataclasses import asdict
+
+from src.functions.discord.messageProcessor import DiscordMessageProcessor
+
+
+def synthetic_channel(n_messages: int, thread_share: float = 0.3, seed: int = 7) -> list:
+    """
+    Build a channel where most messages reply to a recent message, so reply
+    chains get long and busy messages collect many children.
+    """
+    rng = random.Random(seed)
+    messages = []
+    base_id = 1_300_000_000_000_000_000
+
+    for i in range(n_messages):
+        message_id = str(base_id + i)
+        message = {
+            "type": 0,
+            "id": message_id,
+            "channel_id": "1293665802523902032",
+            "content": f"message {i} " + "lorem ipsum dolor sit amet " * rng.randint(1, 8),
+            "timestamp": f"2025-01-{1 + i % 28:02d}T{i % 24:02d}:00:00.000000+00:00",
+            "author": {"id": str(rng.randint(1, 500)), "username": f"user{rng.randint(1, 500)}", "global_name": None},
+            "mentions": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": "false",
+            "edited_timestamp": "null",
+        }
+
+        if i and rng.random() < 0.7:
+            parent = messages[max(0, i - rng.randint(1, 50))]
+            message["message_reference"] = {"message_id": parent["id"], "channel_id": parent["channel_id"]}
+            message["referenced_message"] = {"id": parent["id"], "content": parent["content"]}
+
+        if rng.random() < thread_share / 10:
+            message["thread"] = {"id": message_id, "name": f"thread {i}", "thread_metadata": {"archived": False}}
+
+        messages.append(message)
+
+    return messages
+
+
+def legacy_documents(messages: list) -> dict:
+    """The previous deepcopy based implementation, kept as the baseline"""
+    from src.functions.discord.messageProcessor import ThreadInfo
+
+    def convert(data):
+        if isinstance(data, dict):
+            return {key: convert(value) for key, value in data.items()}
+        elif isinstance(data, list):
+            return [convert(item) for item in data]
+        elif data == "null":
+            return None
+        elif data == "true":
+            return True
+        elif data == "false":
+            return False
+        return data
+
+    messages = convert(messages)
+    processed = {}
+    threads = {}
+    for message in messages:
+        processed[message['id']] = {**message, 'references': [], 'children': []}
+        thread = message.get('thread')
+        if thread:
+            if thread['id'] not in threads:
+                threads[thread['id']] = ThreadInfo(thread_id=thread['id'], thread_metadata=thread, messages=[])
+            threads[thread['id']].messages.append(message['id'])
+
+    for message in processed.values():
+        message_reference = message.get('message_reference')
+        if message_reference:
+            parent = processed.get(message_reference.get('message_id'))
+            if parent:
+                parent['children'].append(message['id'])
+                message['references'].append(message_reference.get('message_id'))
+        referenced_message = message.get('referenced_message')
+        if referenced_message:
+            message['references'].append(referenced_message['id'])
+
+    def build(message):
+        doc = deepcopy(message)
+        doc['referenced_messages'] = [deepcopy(processed[r]) for r in message['references'] if r in processed]
+        doc['child_messages'] = [deepcopy(processed[c]) for c in message['children'] if c in processed]
+        return doc
+
+    message_documents = [
+        {'type': 'message', 'content': build(m)} for m in processed.values() if not m.get('thread')
+    ]
+    thread_documents = []
+    for thread in threads.values():
+        ids = sorted(thread.messages, key=lambda i: processed[i]['timestamp'])
+        thread_documents.append({
+            'type': 'thread',
+            'content': {'thread_info': asdict(thread), 'messages': [build(processed[i]) for i in ids]}
+        })
+    return {'message_documents': message_documents, 'thread_documents': thread_documents}
+
+
+def current_documents(messages: list) -> dict:
+    return DiscordMessageProcessor(messages).process_messages().generate_drive_documents()
+
+
+def measure(name: str, build, n_messages: int) -> dict:
+    messages = synthetic_channel(n_messages)
+    gc.collect()
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    documents = build(messages)
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "implementation": name,
+        "messages": n_messages,
+        "documents": len(documents['message_documents']) + len(documents['thread_documents']),
+        "seconds": round(seconds, 3),
+        "peak_mb": round(peak / 1024 / 1024, 1),
+    }
+    del documents
+    return result
+
+
+def check_same_output(n_messages: int = 2000):
+    """Both implementations have to produce the same JSON"""
+    legacy = json.dumps(legacy_documents(synthetic_channel(n_messages)), sort_keys=True)
+    current = json.dumps(current_documents(synthetic_channel(n_messages)), sort_keys=True)
+    if legacy != current:
+        raise AssertionError("copy free documents differ from the deepcopy baseline")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--skip-legacy", action="store_true", help="only run the current implementation")
+    args = parser.parse_args()
+
+    check_same_output()
+
+    results = [measure("copy_free", current_documents, args.messages)]
+    if not args.skip_legacy:
+        results.append(measure("deepcopy_baseline", legacy_documents, args.messages))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+"""
+Local stand-ins for the external services the query pipeline talks to.
+
+Every fake goes through a FaultInjector, so each service can get its own
+latency, jitter and error rate. The fakes plug in at the same seams the real
+clients use (the engine cache constructors, the Perplexity and Gemini clients,
+the Drive service, the Discord API URL and workflow.step), so the functions
+and the workflow themselves run unchanged.
+"""
+import asyncio
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms import CompletionResponse, CustomLLM, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from benchmarks.discord_documents import synthetic_channel
+from src.functions.RAG.localIndex import LocalDocument, LocalHybridIndex
+
+
+class InjectedFault(Exception):
+    """Raised by a fake when the error injection fires"""
+
+    # Looks like a provider 503 to the resilience layer, so it gets retried like one
+    status_code = 503
+
+
+@dataclass
+class FaultProfile:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    # Only used by the LLM fakes, delay between two streamed tokens
+    token_ms: float = 0.0
+
+
+# Rough production numbers, override them per run with --latency / --error-rate
+DEFAULT_PROFILES = {
+    "llamacloud": FaultProfile(latency_ms=150, jitter_ms=50),
+    "anthropic": FaultProfile(latency_ms=600, jitter_ms=200, token_ms=4),
+    "perplexity": FaultProfile(latency_ms=400, jitter_ms=150, token_ms=4),
+    "gemini": FaultProfile(latency_ms=300, jitter_ms=100),
+    "discord": FaultProfile(latency_ms=60, jitter_ms=20),
+    "drive": FaultProfile(latency_ms=120, jitter_ms=40),
+}
+
+
+class FaultInjector:
+    """Draws latency and failures per service call, seeded so runs are comparable"""
+
+    def __init__(self, profiles: Dict[str, FaultProfile], seed: int = 0):
+        self.profiles = profiles
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.faults: Dict[str, int] = {}
+
+    def profile(self, service: str) -> FaultProfile:
+        return self.profiles.get(service, FaultProfile())
+
+    def _draw(self, service: str):
+        profile = self.profile(service)
+        with self._lock:
+            self.calls[service] = self.calls.get(service, 0) + 1
+            delay = max(0.0, profile.latency_ms + self._rng.uniform(-profile.jitter_ms, profile.jitter_ms)) / 1000
+            fail = self._rng.random() < profile.error_rate
+            if fail:
+                self.faults[service] = self.faults.get(service, 0) + 1
+        return delay, fail
+
+    async def ainject(self, service: str):
+        delay, fail = self._draw(service)
+        await asyncio.sleep(delay)
+        if fail:
+            raise InjectedFault(f"injected {service} failure")
+
+    def inject(self, service: str):
+        delay, fail = self._draw(service)
+        time.sleep(delay)
+        if fail:
+            raise InjectedFault(f"injected {service} failure")
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "faults": dict(self.faults)}
+
+
+# -- LlamaCloud ----------------------------------------------------------------
+
+def synthetic_corpus(n_documents: int = 2000, seed: int = 7) -> List[LocalDocument]:
+    """Question/answer shaped documents with a shared vocabulary, so retrieval scores spread out"""
+    rng = random.Random(seed)
+    topics = ["deploy", "workflow", "function", "schedule", "retry", "timeout", "docker", "engine", "python", "typescript"]
+    words = ["restack", "agent", "task", "queue", "service", "client", "error", "config", "cloud", "local", "api", "event"]
+    documents = []
+    for i in range(n_documents):
+        topic = topics[i % len(topics)]
+        body = " ".join(rng.choice(words) for _ in range(rng.randint(30, 120)))
+        documents.append(LocalDocument(
+            doc_id=f"bench-{i}",
+            text=f"Question: how do I {topic} with restack ({i})?\n\nAnswer:\n{topic} {body}",
+            metadata={"source": "benchmark"},
+        ))
+    return documents
+
+
+class FakeCloudRetriever(BaseRetriever):
+    """as_retriever() of FakeLlamaCloudIndex, searches the in memory corpus"""
+
+    def __init__(self, index: "FakeLlamaCloudIndex", dense_similarity_top_k: int = 5, sparse_similarity_top_k: int = 5,
+                 alpha: float = 0.5, enable_reranking: bool = False, rerank_top_n: int = 5, **kwargs):
+        self._index = index
+        self._params = dict(dense_top_k=dense_similarity_top_k, sparse_top_k=sparse_similarity_top_k, alpha=alpha)
+        self._top_n = rerank_top_n if enable_reranking else max(dense_similarity_top_k, sparse_similarity_top_k)
+        super().__init__()
+
+    def _nodes(self, query: str) -> List[NodeWithScore]:
+        hits = self._index.corpus.search(query, top_k=self._top_n, **self._params)
+        return [
+            NodeWithScore(node=TextNode(text=h.document.text, id_=h.document.doc_id, metadata=h.document.metadata), score=h.score)
+            for h in hits
+        ]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        self._index.injector.inject("llamacloud")
+        return self._nodes(query_bundle.query_str)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        await self._index.injector.ainject("llamacloud")
+        return self._nodes(query_bundle.query_str)
+
+
+class FakeLlamaCloudIndex:
+    """Takes the LlamaCloudIndex constructor arguments, the corpus is shared between instances"""
+
+    corpus: LocalHybridIndex = None
+    injector: FaultInjector = None
+
+    def __init__(self, name: str = None, project_name: str = None, organization_id: str = None, api_key: str = None, **kwargs):
+        self.name = name
+        self.inserted: Dict[str, str] = {}
+
+    def as_retriever(self, **params) -> FakeCloudRetriever:
+        return FakeCloudRetriever(self, **params)
+
+    def insert(self, document):
+        self.injector.inject("llamacloud")
+        self.inserted[document.id_] = document.text
+
+    def update_ref_doc(self, document):
+        self.insert(document)
+
+
+# -- Anthropic / Perplexity ----------------------------------------------------
+
+VALIDATION_MARKER = "Reply with only a JSON object"
+
+
+class FakeLLM(CustomLLM):
+    """
+    Completion model that answers after the injected latency.
+
+    Validation prompts get a JSON verdict back, everything else a canned
+    answer of answer_tokens words, streamed token by token when asked.
+    """
+
+    service: str = "anthropic"
+    answer_tokens: int = 200
+    _injector: FaultInjector = PrivateAttr()
+
+    def __init__(self, injector: FaultInjector, **kwargs):
+        super().__init__(**kwargs)
+        self._injector = injector
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=200_000, num_output=4096, model_name=f"fake-{self.service}", is_chat_model=False)
+
+    def _answer(self, prompt: str) -> str:
+        if VALIDATION_MARKER in prompt:
+            return '{"valid": true, "reason": "benchmark verdict"}'
+        return " ".join(f"token{i}" for i in range(self.answer_tokens))
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        self._injector.inject(self.service)
+        return CompletionResponse(text=self._answer(prompt))
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        await self._injector.ainject(self.service)
+        return CompletionResponse(text=self._answer(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        self._injector.inject(self.service)
+        token_seconds = self._injector.profile(self.service).token_ms / 1000
+
+        def gen():
+            text = ""
+            for token in self._answer(prompt).split(" "):
+                time.sleep(token_seconds)
+                text += token + " "
+                yield CompletionResponse(text=text, delta=token + " ")
+
+        return gen()
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        await self._injector.ainject(self.service)
+        token_seconds = self._injector.profile(self.service).token_ms / 1000
+
+        async def gen():
+            text = ""
+            for token in self._answer(prompt).split(" "):
+                await asyncio.sleep(token_seconds)
+                text += token + " "
+                yield CompletionResponse(text=text, delta=token + " ")
+
+        return gen()
+
+
+# -- Gemini ----------------------------------------------------------------------
+
+class _FakeGeminiModels:
+    def __init__(self, injector: FaultInjector):
+        self._injector = injector
+
+    async def generate_content(self, model: str, contents: str, config=None):
+        await self._injector.ainject("gemini")
+        return type("GenerateContentResponse", (), {"text": "function benchmark_function"})()
+
+
+class FakeGenAI:
+    """Replaces the google.genai module in restack_code_generator, only Client(...).aio.models is used"""
+
+    def __init__(self, injector: FaultInjector):
+        self._injector = injector
+
+    def Client(self, api_key: str = None, **kwargs):
+        aio = type("Aio", (), {"models": _FakeGeminiModels(self._injector)})()
+        return type("Client", (), {"aio": aio})()
+
+
+def fake_restack_cli(command: str) -> str:
+    """Stands in for ./restack_cli, which is not part of the repo"""
+    cmd_type, name = command.split()
+    return f"created {cmd_type} {name}"
+
+
+# -- Google Drive --------------------------------------------------------------
+
+class _FakeRequest:
+    def __init__(self, injector: FaultInjector, result: dict):
+        self._injector = injector
+        self._result = result
+
+    def execute(self):
+        self._injector.inject("drive")
+        return self._result
+
+
+class _FakeFiles:
+    def __init__(self, drive: "FakeDriveService"):
+        self._drive = drive
+
+    def create(self, body: dict = None, media_body=None, fields: str = None, **kwargs):
+        file_id = uuid.uuid4().hex
+        self._drive.files_created[file_id] = (body or {}).get("name")
+        return _FakeRequest(self._drive.injector, {"id": file_id, "name": (body or {}).get("name")})
+
+    def list(self, **kwargs):
+        files = [{"id": file_id, "name": name} for file_id, name in self._drive.files_created.items()]
+        return _FakeRequest(self._drive.injector, {"files": files})
+
+
+class FakeDriveService:
+    """The bits of the Drive v3 service the upload path uses"""
+
+    def __init__(self, injector: FaultInjector):
+        self.injector = injector
+        self.files_created: Dict[str, str] = {}
+
+    def files(self):
+        return _FakeFiles(self)
+
+
+# -- Discord -------------------------------------------------------------------
+
+GUILD_ID = "1000000000000000000"
+
+
+class FakeDiscordServer:
+    """
+    aiohttp server for GET /channels/{id}/messages with limit/before/after
+    paging, GET /channels/{id} and the guild's active threads.
+
+    The channel is the synthetic one from the document benchmark, every
+    thread gets a few replies of its own. Injected errors come back as a 429
+    with retry_after, like a real rate limit.
+    """
+
+    def __init__(self, injector: FaultInjector, channel_id: str, n_messages: int = 2000, replies_per_thread: int = 5):
+        self.injector = injector
+        self.channel_id = channel_id
+        self.channels: Dict[str, List[dict]] = {}
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+        messages = synthetic_channel(n_messages)
+        for message in messages:
+            message["channel_id"] = channel_id
+        self.channels[channel_id] = messages
+
+        for message in messages:
+            thread = message.get("thread")
+            if thread:
+                self.channels[thread["id"]] = [
+                    {**message, "id": f"{message['id']}{r:02d}", "channel_id": thread["id"],
+                     "content": f"reply {r} to {message['id']}", "thread": None}
+                    for r in range(replies_per_thread)
+                ]
+
+    async def handle_messages(self, request: web.Request) -> web.Response:
+        try:
+            await self.injector.ainject("discord")
+        except InjectedFault:
+            return web.json_response({"message": "You are being rate limited.", "retry_after": 0.05}, status=429)
+
+        messages = self.channels.get(request.match_info["channel_id"])
+        if messages is None:
+            return web.json_response({"message": "Unknown Channel"}, status=404)
+
+        limit = int(request.query.get("limit", 50))
+        ordered = sorted(messages, key=lambda m: int(m["id"]))
+        if "after" in request.query:
+            after = int(request.query["after"])
+            page = [m for m in ordered if int(m["id"]) > after][:limit]
+        else:
+            before = int(request.query.get("before", 2 ** 63))
+            page = [m for m in ordered if int(m["id"]) < before][-limit:]
+
+        return web.json_response(list(reversed(page)))
+
+    async def handle_channel(self, request: web.Request) -> web.Response:
+        if request.match_info["channel_id"] not in self.channels:
+            return web.json_response({"message": "Unknown Channel"}, status=404)
+        return web.json_response({"id": request.match_info["channel_id"], "guild_id": GUILD_ID})
+
+    async def handle_active_threads(self, request: web.Request) -> web.Response:
+        threads = [
+            {**message["thread"], "parent_id": self.channel_id}
+            for message in self.channels[self.channel_id]
+            if message.get("thread") and not message["thread"]["thread_metadata"]["archived"]
+        ]
+        return web.json_response({"threads": threads, "members": []})
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/channels/{channel_id}/messages", self.handle_messages)
+        app.router.add_get("/channels/{channel_id}", self.handle_channel)
+        app.router.add_get("/guilds/{guild_id}/threads/active", self.handle_active_threads)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# -- Restack engine ------------------------------------------------------------
+
+class LocalWorkflowEngine:
+    """
+    Runs workflow.step in process, the function is awaited directly.
+
+    Records the latency of every step per function name so the workflow run
+    can be broken down by stage.
+    """
+
+    def __init__(self):
+        self.step_latencies: Dict[str, List[float]] = {}
+        self.step_errors: Dict[str, int] = {}
+
+    async def step(self, function, function_input=None, start_to_close_timeout=None, **kwargs):
+        name = getattr(function, "__name__", str(function))
+        started = time.perf_counter()
+        try:
+            call = function() if function_input is None else function(function_input)
+            if asyncio.iscoroutine(call):
+                timeout = start_to_close_timeout.total_seconds() if start_to_close_timeout else None
+                call = await asyncio.wait_for(call, timeout=timeout)
+            return call
+        except BaseException:
+            self.step_errors[name] = self.step_errors.get(name, 0) + 1
+            raise
+        finally:
+            self.step_latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        # Everything else (defn, run, ...) comes from the real restack workflow object
+        from restack_ai.workflow import workflow
+        return getattr(workflow, name)
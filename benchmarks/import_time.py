@@ -0,0 +1,154 @@
+"""
+Report what importing the worker entry point costs, from `python -X importtime`.
+
+Imports the module in a fresh interpreter and reports the wall time, the
+slowest imports (cumulative, so a package includes everything it pulled in)
+and the time per top level package. Heavy provider SDKs that got imported at
+startup are listed separately, they should only load on first use
+(src/utils/lazy.py).
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --module src.services --top 30 --output imports.json
+    python -m benchmarks.import_time --budget 1.0        # exit 1 when the import takes longer
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from benchmarks.query_pipeline import git_commit
+
+
+# Modules that must not be imported before a worker registers with Restack
+HEAVY_MODULES = [
+    "llama_index",
+    "google.genai",
+    "googleapiclient",
+    "google.oauth2",
+    "mistralai",
+    "anthropic",
+    "openai",
+    "transformers",
+    "torch",
+]
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def parse_importtime(stderr: str) -> List[dict]:
+    """One entry per module: name, self and cumulative seconds and nesting depth"""
+    modules = []
+    for line in stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        modules.append({
+            "module": name,
+            "self_seconds": int(self_us) / 1e6,
+            "cumulative_seconds": int(cumulative_us) / 1e6,
+            # -X importtime indents nested imports by two spaces per level
+            "depth": (len(indent) - 1) // 2,
+        })
+    return modules
+
+
+def measure(module: str) -> dict:
+    code = (
+        "import time; started = time.perf_counter(); "
+        f"import {module}; "
+        "print(time.perf_counter() - started)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        # Show the traceback, the importtime lines before it are noise
+        errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+        raise RuntimeError(f"Importing {module} failed:\n" + "\n".join(errors))
+
+    return {"wall_seconds": float(result.stdout.strip().splitlines()[-1]), "modules": parse_importtime(result.stderr)}
+
+
+def build_report(module: str, measured: dict, top: int) -> dict:
+    modules = measured["modules"]
+
+    by_package: Dict[str, float] = defaultdict(float)
+    for entry in modules:
+        by_package[entry["module"].split(".")[0]] += entry["self_seconds"]
+
+    names = {entry["module"] for entry in modules}
+    heavy = sorted({
+        heavy for heavy in HEAVY_MODULES
+        if any(name == heavy or name.startswith(heavy + ".") for name in names)
+    })
+
+    slowest = sorted(modules, key=lambda entry: entry["cumulative_seconds"], reverse=True)[:top]
+    packages = sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]
+
+    return {
+        "module": module,
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "wall_seconds": round(measured["wall_seconds"], 4),
+        "modules_imported": len(modules),
+        "heavy_modules_imported": heavy,
+        "slowest_imports": [
+            {
+                "module": entry["module"],
+                "cumulative_seconds": round(entry["cumulative_seconds"], 4),
+                "self_seconds": round(entry["self_seconds"], 4),
+            }
+            for entry in slowest
+        ],
+        "packages": [{"package": name, "seconds": round(seconds, 4)} for name, seconds in packages],
+    }
+
+
+def print_summary(report: dict):
+    print(f"import {report['module']}: {report['wall_seconds']:.3f}s, {report['modules_imported']} modules", file=sys.stderr)
+    print("\nSlowest imports (cumulative):", file=sys.stderr)
+    for entry in report["slowest_imports"]:
+        print(f"  {entry['cumulative_seconds']:8.3f}s  {entry['module']}", file=sys.stderr)
+    print("\nBy package (self time):", file=sys.stderr)
+    for entry in report["packages"]:
+        print(f"  {entry['seconds']:8.3f}s  {entry['package']}", file=sys.stderr)
+    if report["heavy_modules_imported"]:
+        print(f"\nHeavy SDKs imported at startup: {', '.join(report['heavy_modules_imported'])}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="src.services", help="module to import, the worker entry point by default")
+    parser.add_argument("--top", type=int, default=20, help="rows in the slowest imports and package tables")
+    parser.add_argument("--budget", type=float, help="fail when the import takes longer than this many seconds")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = build_report(args.module, measure(args.module), args.top)
+    print_summary(report)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.budget is not None and report["wall_seconds"] > args.budget:
+        print(f"\nImport took {report['wall_seconds']:.3f}s, over the {args.budget:.3f}s budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Benchmark the query pipeline against local stand-ins for every external service.
+
+Drives the real functions and query_question_workflow with LlamaCloud,
+Anthropic, Perplexity, Gemini, Discord and Google Drive replaced by the fakes
+in benchmarks/fakes.py, and reports p50/p95/p99 latency, throughput and peak
+memory per stage as JSON.
+
+    python -m benchmarks.query_pipeline --requests 50 --concurrency 8 --output bench.json
+    python -m benchmarks.query_pipeline --latency anthropic=1500 --error-rate llamacloud=0.05
+    python -m benchmarks.query_pipeline --stages llama_cloud_rag,workflow_fan_out --compare bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, replace
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+from unittest import mock
+
+import numpy as np
+
+
+BENCH_CHANNEL = "1293665802523902032"
+
+TOPICS = ["deploy", "schedule a workflow", "retry a function", "set a timeout", "run docker", "use python", "call an agent"]
+
+
+def configure_environment(work_dir: str):
+    """Point every on disk cache at the scratch dir and fill in dummy keys, has to run before src is imported"""
+    os.environ.update({
+        "SEMANTIC_CACHE_PATH": os.path.join(work_dir, "semantic_cache.sqlite3"),
+        "RETRIEVAL_CACHE_PATH": os.path.join(work_dir, "retrieval_cache.sqlite3"),
+        "EMBEDDING_STORE_DIR": os.path.join(work_dir, "embeddings"),
+        "TOKEN_STREAM_DIR": os.path.join(work_dir, "streams"),
+        "DISCORD_CRAWL_DIR": os.path.join(work_dir, "discord"),
+        "DISCORD_INGEST_MANIFEST": os.path.join(work_dir, "discord_manifest.json"),
+        "DRIVE_DELTA_STATE_DIR": os.path.join(work_dir, "drive"),
+        "RAG_RETRIEVER_BACKEND": "llamacloud",
+        "LLAMA_CLOUD_API_KEY": "benchmark",
+        "ANTHROPIC_API_KEY": "benchmark",
+        "PERPLEXITY_API_KEY": "benchmark",
+        "GEMINI_API_KEY": "benchmark",
+        "DISCORD_AUTH_TOKEN": "benchmark",
+        "DISCORD_CHANNEL_ID": BENCH_CHANNEL,
+    })
+
+
+def percentiles(latencies: List[float]) -> dict:
+    if not latencies:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None, "max_ms": None}
+    ms = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "mean_ms": round(float(ms.mean()), 2),
+        "max_ms": round(float(ms.max()), 2),
+    }
+
+
+class Harness:
+    """Installs the fakes and knows how to call every stage"""
+
+    def __init__(self, injector, corpus_size: int, discord_messages: int, work_dir: str):
+        from benchmarks import fakes
+        from benchmarks.discord_documents import synthetic_channel
+        from src.functions.discord.messageProcessor import DiscordMessageProcessor
+        from src.functions.RAG.localIndex import LocalHybridIndex
+
+        self.fakes = fakes
+        self.injector = injector
+        self.work_dir = work_dir
+        self.engine = fakes.LocalWorkflowEngine()
+        self.drive = fakes.FakeDriveService(injector)
+        self.discord = fakes.FakeDiscordServer(injector, BENCH_CHANNEL, n_messages=discord_messages)
+
+        fakes.FakeLlamaCloudIndex.corpus = LocalHybridIndex.build(fakes.synthetic_corpus(corpus_size))
+        fakes.FakeLlamaCloudIndex.injector = injector
+
+        # Documents for the Discord question ingestion, kept small since every pair is one index insert
+        self.discord_documents = DiscordMessageProcessor(synthetic_channel(200)).process_messages().generate_drive_documents()
+        self.sources = [h.document.text for h in fakes.FakeLlamaCloudIndex.corpus.search("deploy restack", top_k=5)]
+        self._patches = contextlib.ExitStack()
+
+    async def __aenter__(self):
+        from src.functions.RAG import engineCache
+        from src.functions.discord import crawler
+        from src.functions.gen_code import restack_code_generator
+        from src.functions.perplexity import perplexityAgent
+        from src.utils import google_drive
+        from src.workflows import query_question_workflow, submit_answer_workflow
+
+        fakes, injector = self.fakes, self.injector
+        discord_url = await self.discord.start()
+
+        patches = [
+            mock.patch.object(engineCache, "LlamaCloudIndex", fakes.FakeLlamaCloudIndex),
+            mock.patch.object(engineCache, "Anthropic", lambda **kwargs: fakes.FakeLLM(injector, service="anthropic")),
+            mock.patch.object(perplexityAgent, "Perplexity", lambda **kwargs: fakes.FakeLLM(injector, service="perplexity")),
+            mock.patch.object(restack_code_generator, "genai", fakes.FakeGenAI(injector)),
+            mock.patch.object(restack_code_generator, "use_cli", fakes.fake_restack_cli),
+            mock.patch.object(google_drive, "get_drive_service", lambda: self.drive),
+            mock.patch.object(crawler, "DISCORD_API_URL", discord_url),
+            mock.patch.object(query_question_workflow, "workflow", self.engine),
+            mock.patch.object(submit_answer_workflow, "workflow", self.engine),
+        ]
+        for patch in patches:
+            self._patches.enter_context(patch)
+
+        # Engines built before the patches would still talk to the real services
+        engineCache.engine_cache.invalidate()
+
+        # discordAgent only reads the snapshot the scheduled crawl writes
+        from src.functions.discordAgent import crawl_discord_channel
+        await crawl_discord_channel({})
+        return self
+
+    async def __aexit__(self, *exc_info):
+        from src.functions.RAG import engineCache
+
+        self._patches.close()
+        engineCache.engine_cache.invalidate()
+        await self.discord.stop()
+
+    def query(self, i: int) -> str:
+        return f"How do I {TOPICS[i % len(TOPICS)]} with restack? ({i})"
+
+    def stages(self) -> Dict[str, Callable]:
+        from src.functions.cache.semanticCache import lookup_semantic_cache, store_semantic_cache
+        from src.functions.discordAgent import crawl_discord_channel, discordAgent
+        from src.functions.gen_code.restack_code_generator import restack_code_gen
+        from src.functions.perplexity.perplexityAgent import perplexityAgent
+        from src.functions.RAG.ingestDocuments import create_questions_from_processed_discord_messages, ingest_documents_to_rag
+        from src.functions.RAG.llamaCloudRAG import llama_cloud_rag
+        from src.functions.RAG.validateRAGResponse import validate_RAG_response
+        from src.workflows.query_question_workflow import query_question_workflow
+
+        answer = "Run `restack deploy` from the project root. " * 20
+
+        return {
+            "semantic_cache_lookup": lambda i: lookup_semantic_cache({"query": self.query(i)}),
+            "semantic_cache_store": lambda i: store_semantic_cache({"query": self.query(i), "response": {"rag_results": answer}}),
+            "llama_cloud_rag": lambda i: llama_cloud_rag({"query": self.query(i)}),
+            "llama_cloud_rag_stream": lambda i: llama_cloud_rag({"query": self.query(i), "stream_id": f"bench-rag-{i}"}),
+            "validate_RAG_response": lambda i: validate_RAG_response({"query": self.query(i), "response": answer, "sources": self.sources}),
+            "perplexityAgent": lambda i: perplexityAgent({"query": self.query(i)}),
+            "discordAgent": lambda i: discordAgent({"query": self.query(i)}),
+            # Incremental, every crawl after the first only asks for new messages
+            "discord_crawl": lambda i: crawl_discord_channel({}),
+            "restack_code_gen": lambda i: restack_code_gen({"query": self.query(i)}),
+            "ingest_documents_to_rag": lambda i: ingest_documents_to_rag({"query": self.query(i), "answer": answer}),
+            "discord_question_ingestion": lambda i: create_questions_from_processed_discord_messages({
+                "documents": self.discord_documents,
+                "manifest_path": os.path.join(self.work_dir, "manifests", f"{i}-{time.time_ns()}.json"),
+            }),
+            "workflow_fan_out": lambda i: query_question_workflow().run({"query": self.query(i), "use_cache": False}),
+            "workflow_sequential": lambda i: query_question_workflow().run({"query": self.query(i), "use_cache": False, "mode": "sequential"}),
+            # Stores on the first pass, the later requests for the same topic are cache hits
+            "workflow_cached": lambda i: query_question_workflow().run({"query": TOPICS[i % len(TOPICS)]}),
+        }
+
+
+async def _drive(call: Callable, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], {}
+
+    async def one(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await call(i)
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            finally:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def run_stage(harness: Harness, name: str, call: Callable, requests: int, concurrency: int, memory_requests: int) -> dict:
+    """Latency pass without tracemalloc, then a shorter pass with it for the peak memory"""
+    harness.engine.step_latencies.clear()
+    harness.engine.step_errors.clear()
+
+    latencies, errors, wall = await _drive(call, requests, concurrency)
+    steps = {
+        step: {**percentiles(values), "count": len(values), "errors": harness.engine.step_errors.get(step, 0)}
+        for step, values in harness.engine.step_latencies.items()
+    }
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    await _drive(call, memory_requests, concurrency)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": sum(errors.values()),
+        "error_types": errors,
+        **percentiles(latencies),
+        "throughput_rps": round(requests / wall, 2) if wall else None,
+        "wall_seconds": round(wall, 3),
+        "peak_mb": round((peak - baseline) / 1024 / 1024, 2),
+    }
+    if steps:
+        result["steps"] = steps
+    print(f"{name}: p50 {result['p50_ms']}ms p95 {result['p95_ms']}ms, {result['throughput_rps']} req/s, {result['errors']} errors", file=sys.stderr)
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict):
+    """Print the p50/p95 and throughput change per stage against an earlier run"""
+    print(f"\nAgainst {baseline.get('commit') or 'baseline'}:", file=sys.stderr)
+    for name, stage in current["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if not before:
+            continue
+        parts = []
+        for metric in ("p50_ms", "p95_ms", "throughput_rps", "peak_mb"):
+            old, new = before.get(metric), stage.get(metric)
+            if old and new is not None:
+                parts.append(f"{metric} {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+        print(f"  {name}: " + ", ".join(parts), file=sys.stderr)
+
+
+def _service_overrides(values: List[str], option: str) -> Dict[str, float]:
+    overrides = {}
+    for value in values or []:
+        service, _, number = value.partition("=")
+        if not number:
+            raise SystemExit(f"{option} expects service=value, got '{value}'")
+        overrides[service] = float(number)
+    return overrides
+
+
+async def run(args) -> dict:
+    from benchmarks.fakes import DEFAULT_PROFILES, FaultInjector, FaultProfile
+    from src.functions.RAG.promptTemplates import prompt_report
+
+    profiles = dict(DEFAULT_PROFILES)
+    for field_name, option in (("latency_ms", args.latency), ("error_rate", args.error_rate), ("token_ms", args.token_ms)):
+        for service, value in _service_overrides(option, field_name).items():
+            profiles[service] = replace(profiles.get(service, FaultProfile()), **{field_name: value})
+
+    injector = FaultInjector(profiles, seed=args.seed)
+
+    async with Harness(injector, args.corpus_size, args.discord_messages, args.work_dir) as harness:
+        stages = harness.stages()
+        selected = args.stages.split(",") if args.stages else list(stages)
+        unknown = [name for name in selected if name not in stages]
+        if unknown:
+            raise SystemExit(f"Unknown stages: {', '.join(unknown)}, available: {', '.join(stages)}")
+
+        results = {}
+        for name in selected:
+            results[name] = await run_stage(harness, name, stages[name], args.requests, args.concurrency, args.memory_requests)
+
+    return {
+        "benchmark": "query_pipeline",
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "memory_requests": args.memory_requests,
+            "seed": args.seed,
+            "corpus_size": args.corpus_size,
+            "discord_messages": args.discord_messages,
+            "profiles": {service: asdict(profile) for service, profile in profiles.items()},
+        },
+        "stages": results,
+        "services": injector.stats(),
+        # Template sizes, to see prompt changes next to their latency impact
+        "prompts": prompt_report(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50, help="requests per stage")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--memory-requests", type=int, default=10, help="requests in the tracemalloc pass")
+    parser.add_argument("--stages", help="comma separated stage names, all of them by default")
+    parser.add_argument("--latency", action="append", metavar="SERVICE=MS", help="mean latency of a fake service")
+    parser.add_argument("--error-rate", action="append", metavar="SERVICE=RATE", help="share of failing calls, 0..1")
+    parser.add_argument("--token-ms", action="append", metavar="SERVICE=MS", help="delay between streamed tokens")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus-size", type=int, default=2000, help="documents behind the fake LlamaCloud index")
+    parser.add_argument("--discord-messages", type=int, default=2000, help="messages in the fake Discord channel")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to print the changes against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="query-bench-") as work_dir:
+        args.work_dir = work_dir
+        configure_environment(work_dir)
+        report = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import asyncio
+import json
+import time
+from restack_ai import Restack
+
+from src.functions.RAG.batchPlan import read_queries
+
+
+async def main(args):
+
+    client = Restack()
+
+    input = {
+        "batch_id": args.batch_id or f"batch-{int(time.time())}",
+        "concurrency": args.concurrency,
+    }
+    if args.output:
+        input["output_path"] = args.output
+
+    if args.worker_path:
+        # The workers read the file themselves, it has to be on a volume they can see
+        input["queries_path"] = args.queries
+    else:
+        input["queries"] = read_queries(args.queries)
+
+    workflow_id = f"{int(time.time() * 1000)}-batch_query_workflow"
+    run_id = await client.schedule_workflow(
+        workflow_name="batch_query_workflow",
+        workflow_id=workflow_id,
+        input=input
+    )
+
+    print(f"Started batch {input['batch_id']} as {workflow_id}")
+
+    result = await client.get_workflow_result(
+        workflow_id=workflow_id,
+        run_id=run_id
+    )
+    print(json.dumps(result, indent=2))
+
+    exit(0)
+
+def run_schedule_batch():
+    parser = argparse.ArgumentParser(description="Answer a file of queries with batch_query_workflow")
+    parser.add_argument("queries", help=".txt (one query per line), .jsonl or .json file")
+    parser.add_argument("--batch-id", help="reuse an earlier batch id to resume it, a new one by default")
+    parser.add_argument("--output", help="JSONL output path on the workers, .cache/batches/<batch id>.jsonl by default")
+    parser.add_argument("--concurrency", type=int, default=8, help="chunks answered at the same time")
+    parser.add_argument("--worker-path", action="store_true", help="pass the file path to the workers instead of the queries")
+    asyncio.run(main(parser.parse_args()))
+
+if __name__ == "__main__":
+    run_schedule_batch()
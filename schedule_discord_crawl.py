@@ -0,0 +1,40 @@
+import argparse
+import asyncio
+import time
+from restack_ai import Restack
+from restack_ai.restack import ScheduleSpec, ScheduleIntervalSpec
+from datetime import timedelta
+
+
+async def main(args):
+
+    client = Restack()
+
+    input = {}
+    if args.channel_id:
+        input["channel_id"] = args.channel_id
+
+    workflow_id = f"{int(time.time() * 1000)}-discord_crawl_workflow"
+    await client.schedule_workflow(
+        workflow_name="discord_crawl_workflow",
+        workflow_id=workflow_id,
+        input=input,
+        schedule=ScheduleSpec(
+            intervals=[ScheduleIntervalSpec(
+                every=timedelta(minutes=args.every_minutes)
+            )]
+        )
+    )
+
+    print(f"Scheduled {workflow_id} every {args.every_minutes} minutes")
+
+    exit(0)
+
+def run_schedule_discord_crawl():
+    parser = argparse.ArgumentParser(description="Crawl the Discord support channel on a schedule for discordAgent")
+    parser.add_argument("--channel-id", help="DISCORD_CHANNEL_ID of the workers by default")
+    parser.add_argument("--every-minutes", type=int, default=15)
+    asyncio.run(main(parser.parse_args()))
+
+if __name__ == "__main__":
+    run_schedule_discord_crawl()
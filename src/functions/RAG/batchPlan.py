@@ -0,0 +1,153 @@
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List, Optional, Set
+import fcntl
+import hashlib
+import json
+import os
+
+from src.utils.text import normalize_query
+
+
+# Planning and output for batch_query_workflow, no llama_index in here so
+# schedule_batch.py can read query files with it.
+#
+# A batch is deduped on the normalized query (case, punctuation and
+# whitespace), every unique query gets its own retrieval and answer. Queries
+# that only look alike ("deploy to AWS" / "deploy to GCP") are not merged.
+# The unique queries are packed into chunks that each become one
+# answer_query_batch step. The JSONL output doubles as the checkpoint:
+# queries that already have an answer line are skipped when the same batch
+# is started again.
+
+DEFAULT_OUTPUT_DIR = os.getenv("BATCH_OUTPUT_DIR", os.path.join(os.getcwd(), ".cache", "batches"))
+
+# Queries per answer_query_batch step
+DEFAULT_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "10"))
+
+
+def query_key(query: str) -> str:
+    return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()[:24]
+
+
+@dataclass
+class BatchQuery:
+    key: str
+    query: str
+    # Other spellings of the same normalized query, answered once
+    aliases: List[str] = field(default_factory=list)
+
+
+@dataclass
+class BatchPlan:
+    chunks: List[List[BatchQuery]]
+    total: int
+    unique: int
+    duplicates: int
+    already_done: int
+
+    @property
+    def pending(self) -> int:
+        return sum(len(chunk) for chunk in self.chunks)
+
+    def to_dict(self) -> dict:
+        return {
+            "chunks": [[asdict(q) for q in chunk] for chunk in self.chunks],
+            "total": self.total,
+            "unique": self.unique,
+            "duplicates": self.duplicates,
+            "already_done": self.already_done,
+            "pending": self.pending,
+        }
+
+
+def read_queries(path: str) -> List[str]:
+    """
+    Queries from a file:
+      .txt    one query per line
+      .jsonl  one object per line with a "query" (or "question") field
+      .json   a list of strings or of such objects
+    """
+    def pick(item) -> Optional[str]:
+        if isinstance(item, str):
+            return item
+        if isinstance(item, dict):
+            return item.get("query") or item.get("question")
+        return None
+
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            items = [json.loads(line) for line in f if line.strip()]
+        elif path.endswith(".json"):
+            items = json.load(f)
+        else:
+            items = [line.rstrip("\n") for line in f]
+
+    return [query for query in map(pick, items) if query and query.strip()]
+
+
+def dedupe(queries: Iterable[str]) -> List[BatchQuery]:
+    """One BatchQuery per normalized query, in first seen order"""
+    unique: Dict[str, BatchQuery] = {}
+    for query in queries:
+        key = query_key(query)
+        if key in unique:
+            if query.strip() != unique[key].query:
+                unique[key].aliases.append(query)
+        else:
+            unique[key] = BatchQuery(key=key, query=query.strip())
+    return list(unique.values())
+
+
+def pack_chunks(queries: List[BatchQuery], chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[List[BatchQuery]]:
+    return [queries[start:start + chunk_size] for start in range(0, len(queries), chunk_size)]
+
+
+def plan_batch(queries: List[str], done: Set[str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> BatchPlan:
+    unique = dedupe(queries)
+    pending = [q for q in unique if q.key not in done]
+    return BatchPlan(
+        chunks=pack_chunks(pending, chunk_size),
+        total=len(queries),
+        unique=len(unique),
+        duplicates=len(queries) - len(unique),
+        already_done=len(unique) - len(pending),
+    )
+
+
+def output_path_for(batch_id: str) -> str:
+    return os.path.join(DEFAULT_OUTPUT_DIR, f"{batch_id}.jsonl")
+
+
+def completed_keys(path: str) -> Set[str]:
+    """Keys that already have a successful answer line, the batch checkpoint"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut off by a crash, that query is answered again
+                continue
+            if not record.get("error"):
+                done.add(record["key"])
+    return done
+
+
+def append_results(path: str, records: List[dict]):
+    """
+    Append answer lines to the JSONL output. Steps of one batch can run in
+    several worker processes at once, so the append holds an exclusive lock.
+    """
+    if not records:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+    with open(path, "a", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(data)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,137 @@
+from restack_ai.function import function, FunctionFailure, log
+from typing import Dict
+import asyncio
+import time
+
+from src.functions.RAG.batchPlan import (
+    append_results, completed_keys, output_path_for, plan_batch, read_queries, DEFAULT_CHUNK_SIZE
+)
+from src.functions.RAG.engineCache import get_engine, get_required_keys
+from src.functions.RAG.llamaCloudRAG import retrieve_nodes
+from src.functions.cache.semanticCache import semantic_cache
+from src.utils.executor import run_blocking
+from src.utils.lazy import lazy_import
+from src.utils.resilience import call_provider
+from src.utils.telemetry import instrument
+
+QueryBundle = lazy_import("llama_index.core.schema", "QueryBundle")
+
+# Queries answered at the same time inside one step
+DEFAULT_STEP_CONCURRENCY = 4
+
+
+@function.defn()
+@instrument
+async def plan_query_batch(input: dict) -> dict:
+    """
+    Read and dedupe the queries of a batch, drop the ones the output file
+    already has answers for and pack the rest into chunks.
+
+    Input: batch_id, queries (list) or queries_path (file), optional
+    output_path and chunk_size.
+    """
+    if not input or not input.get("batch_id"):
+        raise FunctionFailure("Invalid input: batch_id is required", non_retryable=True)
+    if not input.get("queries") and not input.get("queries_path"):
+        raise FunctionFailure("Invalid input: queries or queries_path is required", non_retryable=True)
+
+    output_path = input.get("output_path") or output_path_for(input["batch_id"])
+
+    def plan() -> dict:
+        queries = input.get("queries") or read_queries(input["queries_path"])
+        batch_plan = plan_batch(
+            queries,
+            completed_keys(output_path),
+            chunk_size=input.get("chunk_size", DEFAULT_CHUNK_SIZE),
+        )
+        return {**batch_plan.to_dict(), "output_path": output_path}
+
+    try:
+        result = await run_blocking(plan)
+    except (OSError, ValueError) as e:
+        raise FunctionFailure(f"Failed to read batch queries: {str(e)}", non_retryable=True) from e
+
+    log.info(
+        f"Batch {input['batch_id']}: {result['total']} queries, {result['unique']} unique, "
+        f"{result['already_done']} already answered, {result['pending']} in {len(result['chunks'])} chunks"
+    )
+    return result
+
+
+async def _answer_query(engine, item: dict, batch_id: str, use_cache: bool, stats: Dict[str, int]) -> dict:
+    """
+    Answer one unique query of the batch. Cached answers are only served for
+    the exact normalized query. Answers written here are not validated, so
+    they go to the JSONL output but never into the semantic cache.
+    """
+    started = time.perf_counter()
+    record = {"batch_id": batch_id, "key": item["key"], "query": item["query"], "aliases": item.get("aliases", [])}
+    try:
+        hit = await run_blocking(semantic_cache.lookup, item["query"]) if use_cache else None
+        if hit is not None:
+            cached = hit["response"]
+            record.update(
+                answer=cached.get("rag_results") or cached.get("perplexity_response"),
+                source="cache",
+                similarity=hit["similarity"],
+            )
+            stats["from_cache"] += 1
+        else:
+            query_bundle = QueryBundle(item["query"])
+            nodes, _, from_cache = await retrieve_nodes(engine, query_bundle)
+            record["retrieval_reused"] = from_cache
+            stats["retrieval_reused" if from_cache else "retrievals"] += 1
+
+            # Sources from the retrieval cache were sent before, worth a prompt cache breakpoint
+            query_engine = engine.synthesis_engine(repeated_context=from_cache)
+            response = await call_provider("anthropic", lambda: query_engine.asynthesize(query_bundle, nodes))
+            record.update(
+                answer=response.response,
+                source="rag",
+                sources=[node.text for node in response.source_nodes],
+            )
+        stats["answered"] += 1
+    except Exception as e:
+        log.error(f"Batch {batch_id}: failed to answer '{item['query']}': {str(e)}")
+        record["error"] = str(e)
+        stats["failed"] += 1
+
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+@function.defn()
+@instrument
+async def answer_query_batch(input: dict) -> dict:
+    """
+    Answer one chunk of a batch with the RAG pipeline and append the answers
+    to the batch's JSONL output as soon as each query is done.
+
+    A failing query is written with an "error" and left for the next run of
+    the batch, it doesn't fail the step.
+    """
+    if not input or not input.get("queries") or not input.get("output_path"):
+        raise FunctionFailure("Invalid input: queries and output_path are required", non_retryable=True)
+
+    required_keys = get_required_keys()
+    missing_keys = [k for k, v in required_keys.items() if not v]
+    if missing_keys:
+        raise FunctionFailure(f"Missing required API keys: {', '.join(missing_keys)}", non_retryable=True)
+
+    started = time.perf_counter()
+    engine = await run_blocking(get_engine, required_keys, fusion=input.get("fusion"))
+
+    batch_id = input.get("batch_id")
+    output_path = input["output_path"]
+    use_cache = input.get("use_cache", True)
+    stats = {"answered": 0, "failed": 0, "from_cache": 0, "retrievals": 0, "retrieval_reused": 0}
+    semaphore = asyncio.Semaphore(input.get("concurrency", DEFAULT_STEP_CONCURRENCY))
+
+    async def answer(item: dict):
+        async with semaphore:
+            record = await _answer_query(engine, item, batch_id, use_cache, stats)
+        await run_blocking(append_results, output_path, [record])
+
+    await asyncio.gather(*(answer(item) for item in input["queries"]))
+
+    return {**stats, "seconds": round(time.perf_counter() - started, 3)}
@@ -0,0 +1,163 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+import math
+import os
+import re
+
+
+# Token budget for everything we send to the validation prompt (query + response + sources)
+DEFAULT_TOKEN_BUDGET = int(os.getenv("RAG_VALIDATION_TOKEN_BUDGET", "6000"))
+
+# The candidate response never gets more than this share of the budget,
+# the rest is left for the sources it is checked against
+MAX_RESPONSE_SHARE = 0.4
+
+# Don't bother adding a source once less than this many tokens are left
+MIN_SOURCE_TOKENS = 80
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+_WORD_PATTERN = re.compile(r"\w+")
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "how",
+    "i", "in", "is", "it", "of", "on", "or", "that", "the", "this", "to", "what", "with", "you",
+}
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a text.
+
+    Claude and GPT style tokenizers average a bit over one token per word and
+    about four characters per token on English and code, so take the larger of
+    the two estimates to stay on the safe side of the limit.
+    """
+    if not text:
+        return 0
+    pieces = len(_TOKEN_PATTERN.findall(text))
+    return max(math.ceil(pieces * 1.1), math.ceil(len(text) / 4))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut a text down to roughly max_tokens, on a word boundary"""
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    # Leave room for the " ..." marker
+    limit = max(max_tokens - 2, 0)
+
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) <= limit:
+            low = mid
+        else:
+            high = mid - 1
+
+    cut = text[:low]
+    space = cut.rfind(" ")
+    if space > len(cut) // 2:
+        cut = cut[:space]
+    return cut.rstrip() + " ..."
+
+
+def _terms(text: str) -> set:
+    return {w for w in _WORD_PATTERN.findall((text or "").lower()) if w not in STOP_WORDS}
+
+
+def rank_sources(query: str, response: str, sources: List[str]) -> List[int]:
+    """
+    Order sources by how much they overlap with the query and the candidate response.
+
+    Query terms count double since the verdict is about the question, the
+    length normalization keeps long sources from winning on size alone.
+
+    Returns:
+        List[int]: indexes into sources, most relevant first
+    """
+    query_terms = _terms(query)
+    response_terms = _terms(response)
+
+    scores = []
+    for i, source in enumerate(sources):
+        source_terms = _terms(source)
+        if not source_terms:
+            scores.append((0.0, i))
+            continue
+        overlap = 2 * len(query_terms & source_terms) + len(response_terms & source_terms)
+        scores.append((overlap / math.sqrt(len(source_terms)), i))
+
+    scores.sort(key=lambda item: (-item[0], item[1]))
+    return [i for _, i in scores]
+
+
+@dataclass
+class PackedContext:
+    query: str
+    response: str
+    sources: List[str]
+    budget: int
+    tokens: int
+    dropped_sources: int = 0
+    truncated_sources: int = 0
+    response_truncated: bool = False
+
+    def metadata(self) -> dict:
+        return {
+            "token_budget": self.budget,
+            "context_tokens": self.tokens,
+            "sources_used": len(self.sources),
+            "sources_dropped": self.dropped_sources,
+            "sources_truncated": self.truncated_sources,
+            "response_truncated": self.response_truncated,
+        }
+
+
+def pack_context(query: str, response: str, sources: Optional[List[str]], budget: int = DEFAULT_TOKEN_BUDGET) -> PackedContext:
+    """
+    Fit the query, candidate response and retrieved sources into a token budget.
+
+    Args:
+        query (str): The user question, always kept whole
+        response (str): The candidate answer, truncated past MAX_RESPONSE_SHARE of the budget
+        sources (List[str]): Retrieved source texts
+        budget (int): Total token budget
+
+    Returns:
+        PackedContext: the texts to put in the prompt and what was cut
+    """
+    sources = [s for s in (sources or []) if s and s.strip()]
+
+    query_tokens = count_tokens(query)
+    remaining = budget - query_tokens
+
+    response_limit = max(MIN_SOURCE_TOKENS, int(budget * MAX_RESPONSE_SHARE))
+    packed_response = truncate_to_tokens(response or "", min(response_limit, max(remaining, 0)))
+    remaining -= count_tokens(packed_response)
+
+    packed = PackedContext(
+        query=query,
+        response=packed_response,
+        sources=[],
+        budget=budget,
+        tokens=0,
+        response_truncated=packed_response != (response or ""),
+    )
+
+    for i in rank_sources(query, response, sources):
+        source = sources[i]
+        source_tokens = count_tokens(source)
+
+        if source_tokens <= remaining:
+            packed.sources.append(source)
+            remaining -= source_tokens
+        elif remaining >= MIN_SOURCE_TOKENS:
+            cut = truncate_to_tokens(source, remaining)
+            packed.sources.append(cut)
+            packed.truncated_sources += 1
+            remaining -= count_tokens(cut)
+        else:
+            packed.dropped_sources += 1
+
+    packed.tokens = budget - remaining
+    return packed
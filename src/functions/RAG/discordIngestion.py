@@ -0,0 +1,196 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+import hashlib
+import json
+import os
+
+
+# Keeps the content hash of every Discord document already in the index,
+# so re-ingesting an unchanged channel doesn't touch the index at all
+DEFAULT_MANIFEST_PATH = os.getenv(
+    "DISCORD_INGEST_MANIFEST",
+    os.path.join(os.getcwd(), ".cache", "ingestion", "discord_manifest.json")
+)
+
+DEFAULT_BATCH_SIZE = int(os.getenv("DISCORD_INGEST_BATCH_SIZE", "20"))
+
+
+@dataclass
+class QAPair:
+    doc_id: str
+    question: str
+    answer: str
+    metadata: dict = field(default_factory=dict)
+
+    @property
+    def text(self) -> str:
+        return f"Question: {self.question}\n\nAnswer:\n{self.answer}"
+
+    @property
+    def content_hash(self) -> str:
+        return hashlib.sha256(self.text.encode("utf-8")).hexdigest()
+
+
+def _author(message: dict) -> str:
+    author = message.get('author') or {}
+    return author.get('global_name') or author.get('username') or 'unknown'
+
+
+def _author_id(message: dict) -> Optional[str]:
+    return (message.get('author') or {}).get('id')
+
+
+def _conversation(messages: List[dict]) -> str:
+    return "\n".join(
+        f"{_author(m)}: {m['content'].strip()}" for m in messages if (m.get('content') or '').strip()
+    )
+
+
+def qa_from_thread(thread_doc: dict) -> Optional[QAPair]:
+    """
+    Turn a thread document into a question/answer pair.
+
+    The thread title and starter message are the question, the rest of the
+    thread is the answer. Threads nobody else replied to are skipped.
+    """
+    info = thread_doc['thread_info']
+    thread_id = info['thread_id']
+    metadata = info.get('thread_metadata') or {}
+    messages = [m for m in thread_doc['messages'] if (m.get('content') or '').strip()]
+    if not messages:
+        return None
+
+    starter = next((m for m in messages if m['id'] == thread_id), messages[0])
+    asker_id = metadata.get('owner_id') or _author_id(starter)
+    replies = [m for m in messages if m is not starter]
+
+    if not any(_author_id(m) != asker_id for m in replies):
+        return None
+
+    title = metadata.get('name') or ''
+    question = starter['content'].strip()
+    if title and title not in question:
+        question = f"{title}\n{question}"
+
+    return QAPair(
+        doc_id=f"discord-thread-{thread_id}",
+        question=question,
+        answer=_conversation(replies),
+        metadata={
+            "source": "discord",
+            "type": "thread",
+            "thread_id": thread_id,
+            "channel_id": metadata.get('parent_id') or starter.get('channel_id'),
+            "title": title,
+            "timestamp": starter.get('timestamp'),
+        }
+    )
+
+
+def qa_from_message(message_doc: dict) -> Optional[QAPair]:
+    """A channel question with replies from someone else becomes a question/answer pair"""
+    content = (message_doc.get('content') or '').strip()
+    # Outside threads most reply chains are chatter, only keep the ones that start with a question
+    if '?' not in content:
+        return None
+
+    asker_id = _author_id(message_doc)
+    replies = [m for m in message_doc.get('child_messages', []) if _author_id(m) != asker_id]
+    answer = _conversation(replies)
+    if not answer:
+        return None
+
+    return QAPair(
+        doc_id=f"discord-message-{message_doc['id']}",
+        question=content,
+        answer=answer,
+        metadata={
+            "source": "discord",
+            "type": "message",
+            "message_id": message_doc['id'],
+            "channel_id": message_doc.get('channel_id'),
+            "timestamp": message_doc.get('timestamp'),
+        }
+    )
+
+
+def extract_qa_pairs(documents) -> List[QAPair]:
+    """
+    Extract question/answer pairs from DiscordMessageProcessor output.
+
+    Args:
+        documents: the generate_drive_documents() dict or the iter_drive_documents() iterator
+
+    Returns:
+        List[QAPair]: one pair per answered thread or message, deduplicated by content hash
+    """
+    if isinstance(documents, dict):
+        documents = list(documents.get('message_documents', [])) + list(documents.get('thread_documents', []))
+
+    pairs = []
+    seen_hashes = set()
+    for document in documents:
+        if document['type'] == 'thread':
+            pair = qa_from_thread(document['content'])
+        else:
+            pair = qa_from_message(document['content'])
+
+        # The same conversation shows up as a thread and as reply chains, keep it once
+        if pair is None or pair.content_hash in seen_hashes:
+            continue
+        seen_hashes.add(pair.content_hash)
+        pairs.append(pair)
+
+    return pairs
+
+
+class IngestionManifest:
+    """
+    doc_id -> content hash of everything already upserted, per index.
+
+    The file holds one section per index (see engineCache.index_id), so
+    switching the retriever backend or the index name starts from an empty
+    section and the new index gets every pair.
+    """
+
+    def __init__(self, path: str = DEFAULT_MANIFEST_PATH, index: str = ""):
+        self.path = path
+        self.index = index
+        self.hashes: Dict[str, str] = dict(self._load().get(index, {}))
+
+    def _load(self) -> Dict[str, Dict[str, str]]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def plan(self, pairs: Iterable[QAPair]):
+        """Split the pairs into new and changed ones, unchanged pairs are dropped"""
+        new, changed = [], []
+        for pair in pairs:
+            known = self.hashes.get(pair.doc_id)
+            if known is None:
+                new.append(pair)
+            elif known != pair.content_hash:
+                changed.append(pair)
+        return new, changed
+
+    def record(self, pairs: Iterable[QAPair]):
+        for pair in pairs:
+            self.hashes[pair.doc_id] = pair.content_hash
+
+    def save(self):
+        # Keep the other indexes' sections as they are on disk
+        indexes = self._load()
+        indexes[self.index] = self.hashes
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(indexes, f)
+        os.replace(tmp_path, self.path)
+
+
+def batched(items: List, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -0,0 +1,317 @@
+from restack_ai.function import log
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+import hashlib
+import json
+import os
+import threading
+import time
+
+from src.functions.RAG.fusion import FusionSettings, FUSION_SETTINGS
+from src.functions.RAG.promptTemplates import RAG_ANSWER
+from src.utils.lazy import lazy_import
+from src.utils.telemetry import install_llama_index_handler, record_engine_build, record_engine_cache, record_engines
+
+# llama_index is only imported when the first engine is built, see src/utils/lazy.py
+Anthropic = lazy_import("llama_index.llms.anthropic", "Anthropic")
+LlamaCloudIndex = lazy_import("llama_index.indices.managed.llama_cloud", "LlamaCloudIndex")
+get_response_synthesizer = lazy_import("llama_index.core", "get_response_synthesizer")
+RetrieverQueryEngine = lazy_import("llama_index.core.query_engine", "RetrieverQueryEngine")
+
+
+# Defaults shared by every RAG function, these used to be copy pasted into
+# llamaCloudRAG, validateRAGResponse and ingestDocuments
+
+INDEX_NAME = "Trieoverflow General Index for All Frameworks"
+PROJECT_NAME = "Trieoverflow"
+ORGANIZATION_ID = "37ad34df-e1d9-481e-9007-9b194cf46e13"
+ANTHROPIC_MODEL = "claude-3-5-sonnet-20240620"
+
+# "llamacloud" queries the managed LlamaCloud index, "local" uses the on disk
+# hybrid index built by src/functions/RAG/localIndex.py
+RETRIEVER_BACKEND = os.getenv("RAG_RETRIEVER_BACKEND", "llamacloud")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", os.path.join(os.getcwd(), ".cache", "local_index"))
+
+# Base retriever configuration. With the local fusion stage enabled (see
+# fusion.py) alpha and reranking are applied locally instead
+RETRIEVER_PARAMS = {
+    "dense_similarity_top_k": 5,
+    "sparse_similarity_top_k": 5,
+    "alpha": 0.5,
+    "enable_reranking": True,
+    "rerank_top_n": 5,
+}
+
+
+def index_id(index_name: str = INDEX_NAME) -> str:
+    """
+    The index the configured backend reads from. The local backend is
+    identified by its directory so a rebuilt index in another place counts as
+    another index
+    """
+    if RETRIEVER_BACKEND == "local":
+        return f"local:{LOCAL_INDEX_DIR}"
+    return index_name
+
+
+@dataclass
+class EngineEntry:
+    index: object
+    llm: object
+    retriever: object
+    query_engine: object
+    built_at: float
+    build_seconds: float
+    # Index id and retriever settings, what the retrieval cache is keyed on
+    index_name: str = ""
+    retrieval_settings: str = ""
+    # Same engine with a prompt cache breakpoint after the sources, see promptTemplates.py
+    context_cached_query_engine: object = None
+
+    def synthesis_engine(self, repeated_context: bool):
+        """The query engine to synthesize with, repeated_context when the same nodes were sent before or will be again"""
+        if repeated_context and self.context_cached_query_engine is not None:
+            return self.context_cached_query_engine
+        return self.query_engine
+
+
+def _fingerprint(secret: Optional[str]) -> str:
+    """Hash an API key so it can be part of the cache key without keeping it around in plain text"""
+    if not secret:
+        return ""
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()[:16]
+
+
+class QueryEngineCache:
+    """
+    Process wide cache of LlamaCloudIndex / Anthropic / RetrieverQueryEngine objects.
+
+    Engines are built lazily on first use and keyed by index name, model,
+    retriever params and a fingerprint of the API keys, so rotating a key or
+    pointing at another index builds a new engine instead of reusing a stale one.
+    The index and the LLM keep their own HTTP clients, so reusing the entry
+    also reuses their pooled connections.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Tuple, EngineEntry] = {}
+        self._lock = threading.Lock()
+
+    def _make_key(self, index_name: str, model: str, retriever_params: dict, streaming: bool, fusion: FusionSettings, llama_api_key: str, anthropic_api_key: str) -> Tuple:
+        return (
+            index_id(index_name),
+            model,
+            tuple(sorted(retriever_params.items())),
+            streaming,
+            fusion.key(),
+            _fingerprint(llama_api_key),
+            _fingerprint(anthropic_api_key),
+        )
+
+    def _make_retriever(self, make, retriever_params: dict, fusion: FusionSettings):
+        """Either the plain hybrid retriever or a dense and a sparse one behind the local fusion stage"""
+        if not fusion.enabled:
+            return make(**retriever_params)
+
+        from src.functions.RAG.fusionRetriever import FusionRetriever
+
+        candidate_params = {
+            **retriever_params,
+            "dense_similarity_top_k": fusion.candidate_top_k,
+            "sparse_similarity_top_k": fusion.candidate_top_k,
+            "enable_reranking": False,
+        }
+        return FusionRetriever(
+            {
+                "dense": make(**{**candidate_params, "alpha": 1.0}),
+                "sparse": make(**{**candidate_params, "alpha": 0.0}),
+            },
+            fusion,
+        )
+
+    def _build(self, index_name: str, model: str, retriever_params: dict, streaming: bool, fusion: FusionSettings, llama_api_key: str, anthropic_api_key: str) -> EngineEntry:
+        started = time.perf_counter()
+        install_llama_index_handler()
+
+        if RETRIEVER_BACKEND == "local":
+            # Imported here so the LlamaCloud setup doesn't need numpy
+            from src.functions.RAG.localIndex import shared_index
+            from src.functions.RAG.localRetriever import LocalHybridRetriever
+
+            index = shared_index(LOCAL_INDEX_DIR)
+            retriever = self._make_retriever(lambda **params: LocalHybridRetriever(index, **params), retriever_params, fusion)
+        else:
+            # Initialize LlamaCloud Index
+            index = LlamaCloudIndex(
+                name=index_name,
+                project_name=PROJECT_NAME,
+                organization_id=ORGANIZATION_ID,
+                api_key=llama_api_key
+            )
+            retriever = self._make_retriever(index.as_retriever, retriever_params, fusion)
+
+        # Initialize LLMs
+        llm_anthropic = Anthropic(
+            model=model,
+            api_key=anthropic_api_key,
+            timeout=60
+        )
+
+        # Setup retriever and query engine
+        # Instructions and retrieved context go first so repeated sources can be cached, see promptTemplates.py
+        response_synthesizer = get_response_synthesizer(
+            llm=llm_anthropic,
+            streaming=streaming,
+            text_qa_template=RAG_ANSWER.chat_template()
+        )
+
+        query_engine = RetrieverQueryEngine(
+            retriever=retriever,
+            response_synthesizer=response_synthesizer
+        )
+
+        context_cached_query_engine = RetrieverQueryEngine(
+            retriever=retriever,
+            response_synthesizer=get_response_synthesizer(
+                llm=llm_anthropic,
+                streaming=streaming,
+                text_qa_template=RAG_ANSWER.chat_template(cache_context=True)
+            )
+        )
+
+        elapsed = time.perf_counter() - started
+        return EngineEntry(
+            index=index,
+            llm=llm_anthropic,
+            retriever=retriever,
+            query_engine=query_engine,
+            built_at=time.time(),
+            build_seconds=elapsed,
+            index_name=index_name,
+            retrieval_settings=json.dumps([sorted(retriever_params.items()), fusion.key()], default=str),
+            context_cached_query_engine=context_cached_query_engine,
+        )
+
+    def get(
+        self,
+        llama_api_key: str,
+        anthropic_api_key: str,
+        index_name: str = INDEX_NAME,
+        model: str = ANTHROPIC_MODEL,
+        retriever_params: Optional[dict] = None,
+        streaming: bool = False,
+        fusion: FusionSettings = FUSION_SETTINGS,
+    ) -> EngineEntry:
+        """
+        Return the cached engine for these settings, building it on a miss.
+
+        Args:
+            llama_api_key (str): LlamaCloud API key
+            anthropic_api_key (str): Anthropic API key
+            index_name (str): Name of the LlamaCloud index
+            model (str): Anthropic model used for response synthesis
+            retriever_params (dict, optional): Overrides for RETRIEVER_PARAMS
+            streaming (bool): Build the response synthesizer in streaming mode
+            fusion (FusionSettings): Local fusion / rerank settings
+
+        Returns:
+            EngineEntry: index, llm, retriever and query engine
+        """
+        params = {**RETRIEVER_PARAMS, **(retriever_params or {})}
+        key = self._make_key(index_name, model, params, streaming, fusion, llama_api_key, anthropic_api_key)
+        index_name = key[0]
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            record_engine_cache("hit")
+            return entry
+
+        # Build under the lock so concurrent callers don't all construct the same engine
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                record_engine_cache("hit")
+                return entry
+
+            record_engine_cache("miss")
+
+            # A new key for the same index means the keys were rotated, drop the old engines
+            stale = [k for k in self._entries if k[0] == index_name and k[1:5] == key[1:5]]
+            for k in stale:
+                del self._entries[k]
+            if stale:
+                record_engine_cache("invalidated", len(stale))
+
+            entry = self._build(index_name, model, params, streaming, fusion, llama_api_key, anthropic_api_key)
+            self._entries[key] = entry
+            record_engine_build(entry.build_seconds)
+            record_engines(len(self._entries))
+
+        log.info(f"Built RAG query engine for '{index_name}' in {entry.build_seconds:.3f}s")
+        return entry
+
+    def invalidate(self, index_name: Optional[str] = None) -> int:
+        """Drop cached engines, either all of them or only the ones for one index"""
+        with self._lock:
+            keys = [k for k in self._entries if index_name is None or k[0] == index_name]
+            for k in keys:
+                del self._entries[k]
+            if keys:
+                record_engine_cache("invalidated", len(keys))
+            record_engines(len(self._entries))
+        return len(keys)
+
+
+engine_cache = QueryEngineCache()
+
+
+def get_required_keys() -> dict:
+    """Read the API keys needed by the RAG functions from the environment"""
+    required_keys = {
+        "LLAMA_CLOUD_API_KEY": os.getenv("LLAMA_CLOUD_API_KEY"),
+        "ANTHROPIC_API_KEY": os.getenv("ANTHROPIC_API_KEY"),
+    }
+    # The local index works offline, only the LLM needs a key
+    if RETRIEVER_BACKEND == "local":
+        del required_keys["LLAMA_CLOUD_API_KEY"]
+    return required_keys
+
+
+def get_engine(required_keys: dict, retriever_params: Optional[dict] = None, streaming: bool = False, fusion: Optional[dict] = None) -> EngineEntry:
+    """
+    Get the pooled engine entry, for callers that need the llm or retriever on their own.
+
+    fusion holds per request overrides of FUSION_SETTINGS, e.g. {"method": "rrf"}
+    """
+    return engine_cache.get(
+        llama_api_key=required_keys.get("LLAMA_CLOUD_API_KEY"),
+        anthropic_api_key=required_keys["ANTHROPIC_API_KEY"],
+        retriever_params=retriever_params,
+        streaming=streaming,
+        fusion=FUSION_SETTINGS.override(fusion),
+    )
+
+
+def get_query_engine(required_keys: dict, retriever_params: Optional[dict] = None, streaming: bool = False, fusion: Optional[dict] = None):
+    """Shortcut used by the RAG functions to get a pooled query engine"""
+    return get_engine(required_keys, retriever_params, streaming, fusion).query_engine
+
+
+def warm_up_engines() -> bool:
+    """
+    Build the default engine at service startup so the first request doesn't pay for it.
+
+    Returns:
+        bool: True if an engine was built or already cached, False if keys are missing or the build failed
+    """
+    required_keys = get_required_keys()
+    if not all(required_keys.values()):
+        log.info("Skipping RAG engine warm up, API keys are not configured")
+        return False
+
+    try:
+        get_query_engine(required_keys)
+        return True
+    except Exception as e:
+        log.error(f"RAG engine warm up failed: {str(e)}")
+        return False
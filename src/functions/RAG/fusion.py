@@ -0,0 +1,247 @@
+from dataclasses import asdict, dataclass, field, replace
+from typing import Dict, List, Optional, Sequence
+import os
+import time
+
+import numpy as np
+
+from src.functions.cache.embeddings import EmbeddingService, embedding_service
+
+
+# Local fusion / rerank stage that sits between the retrievers and the LLM.
+# Every retriever hands over its own ranked candidate list, the lists are
+# normalized together in one NumPy matrix, blended (alpha or reciprocal rank
+# fusion) and finally diversified with MMR.
+
+FUSION_METHODS = ("alpha", "rrf")
+
+
+@dataclass(frozen=True)
+class FusionSettings:
+    # Opt in (RAG_FUSION_ENABLED or the request's fusion input): replaces the
+    # index's own reranking and runs two retrievals per query. Off keeps a
+    # single hybrid retriever with remote reranking
+    enabled: bool = False
+    # "alpha" blends normalized scores, "rrf" only looks at the ranks
+    method: str = "alpha"
+    # Weight of the dense list, the sparse list gets 1 - alpha
+    alpha: float = 0.5
+    rrf_k: int = 60
+    # How many candidates every retriever returns before fusion
+    candidate_top_k: int = 20
+    top_n: int = 5
+    # 1.0 is pure relevance, lower values trade relevance for diversity
+    mmr_lambda: float = 0.7
+
+    @classmethod
+    def from_env(cls) -> "FusionSettings":
+        return cls(
+            enabled=os.getenv("RAG_FUSION_ENABLED", "false").lower() in ("1", "true", "yes"),
+            method=os.getenv("RAG_FUSION_METHOD", "alpha"),
+            alpha=float(os.getenv("RAG_FUSION_ALPHA", "0.5")),
+            rrf_k=int(os.getenv("RAG_FUSION_RRF_K", "60")),
+            candidate_top_k=int(os.getenv("RAG_FUSION_CANDIDATES", "20")),
+            top_n=int(os.getenv("RAG_FUSION_TOP_N", "5")),
+            mmr_lambda=float(os.getenv("RAG_FUSION_MMR_LAMBDA", "0.7")),
+        ).validate()
+
+    def validate(self) -> "FusionSettings":
+        if self.method not in FUSION_METHODS:
+            raise ValueError(f"Unknown fusion method '{self.method}', expected one of {', '.join(FUSION_METHODS)}")
+        if not 0.0 <= self.alpha <= 1.0:
+            raise ValueError(f"Fusion alpha has to be between 0 and 1, got {self.alpha}")
+        if not 0.0 <= self.mmr_lambda <= 1.0:
+            raise ValueError(f"MMR lambda has to be between 0 and 1, got {self.mmr_lambda}")
+        if self.top_n < 1 or self.candidate_top_k < self.top_n:
+            raise ValueError("Fusion needs top_n >= 1 and candidate_top_k >= top_n")
+        return self
+
+    def override(self, overrides: Optional[dict]) -> "FusionSettings":
+        """Copy of the settings with the given fields replaced, used for per request overrides"""
+        if not overrides:
+            return self
+        unknown = set(overrides) - set(asdict(self))
+        if unknown:
+            raise ValueError(f"Unknown fusion settings: {', '.join(sorted(unknown))}")
+        return replace(self, **overrides).validate()
+
+    def key(self) -> tuple:
+        return tuple(sorted(asdict(self).items()))
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+# Shared by llama_cloud_rag, validate_RAG_response and the Discord ingestion
+# through the engine cache, so all of them retrieve the same way
+FUSION_SETTINGS = FusionSettings.from_env()
+
+
+@dataclass
+class Candidate:
+    doc_id: str
+    text: str
+    score: Optional[float]
+    # Whatever the retriever returned (a llama_index node for example), handed back untouched
+    payload: object = None
+
+
+@dataclass
+class FusedCandidate:
+    candidate: Candidate
+    score: float
+    # Normalized score per retriever list, missing lists are left out
+    list_scores: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class FusionResult:
+    candidates: List[FusedCandidate]
+    timings: Dict[str, float]
+
+
+def normalize_scores(scores: np.ndarray) -> np.ndarray:
+    """
+    Min-max scale every row to 0..1 in one pass.
+
+    Missing scores (NaN or -inf) become 0. A row where all finite scores are
+    equal becomes 1 when the scores are positive and 0 otherwise. Works on a
+    single 1-D score vector as well.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    finite = np.isfinite(scores)
+    low = np.where(finite, scores, np.inf).min(axis=-1, keepdims=True)
+    high = np.where(finite, scores, -np.inf).max(axis=-1, keepdims=True)
+    span = high - low
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scaled = np.where(span > 0, (scores - low) / np.where(span > 0, span, 1.0), np.where(high > 0, 1.0, 0.0))
+    return np.where(finite, scaled, 0.0).astype(np.float32)
+
+
+def _score_matrix(candidate_lists: Dict[str, Sequence[Candidate]]):
+    """
+    Stack the lists into list x document matrices of raw scores and ranks.
+
+    Documents returned by several retrievers share one column, missing
+    entries are NaN.
+    """
+    columns: Dict[str, int] = {}
+    candidates: List[Candidate] = []
+    for results in candidate_lists.values():
+        for candidate in results:
+            if candidate.doc_id not in columns:
+                columns[candidate.doc_id] = len(candidates)
+                candidates.append(candidate)
+
+    scores = np.full((len(candidate_lists), len(candidates)), np.nan, dtype=np.float32)
+    ranks = np.full_like(scores, np.nan)
+    for row, results in enumerate(candidate_lists.values()):
+        for rank, candidate in enumerate(results):
+            column = columns[candidate.doc_id]
+            if not np.isnan(ranks[row, column]):
+                continue
+            ranks[row, column] = rank + 1
+            # Retrievers without scores still rank, give them a linearly decaying score
+            scores[row, column] = candidate.score if candidate.score is not None else -rank
+
+    return candidates, scores, ranks
+
+
+def _list_weights(names: Sequence[str], alpha: float) -> np.ndarray:
+    """dense gets alpha, sparse gets 1 - alpha, any other list counts fully"""
+    weights = {"dense": alpha, "sparse": 1.0 - alpha}
+    return np.asarray([weights.get(name, 1.0) for name in names], dtype=np.float32)
+
+
+def mmr(relevance: np.ndarray, vectors: np.ndarray, top_n: int, mmr_lambda: float) -> List[int]:
+    """
+    Maximal marginal relevance selection.
+
+    The pairwise similarity matrix is computed once, after that every step
+    only updates the running "closest selected document" vector.
+
+    Args:
+        relevance (np.ndarray): Relevance per candidate, 0..1
+        vectors (np.ndarray): L2 normalized candidate embeddings
+        top_n (int): How many candidates to pick
+        mmr_lambda (float): 1.0 is pure relevance, 0.0 pure diversity
+
+    Returns:
+        List[int]: Picked candidate positions, best first
+    """
+    n = len(relevance)
+    similarity = vectors @ vectors.T
+    closest = np.zeros(n, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    picked = []
+
+    for _ in range(min(top_n, n)):
+        marginal = mmr_lambda * relevance - (1.0 - mmr_lambda) * closest
+        marginal[~available] = -np.inf
+        best = int(np.argmax(marginal))
+        picked.append(best)
+        available[best] = False
+        closest = np.maximum(closest, similarity[best])
+
+    return picked
+
+
+def fuse(
+    candidate_lists: Dict[str, Sequence[Candidate]],
+    settings: FusionSettings = FUSION_SETTINGS,
+    embedder: EmbeddingService = embedding_service,
+) -> FusionResult:
+    """
+    Fuse the candidate lists of several retrievers into one ranked list.
+
+    Args:
+        candidate_lists (dict): Retriever name ("dense", "sparse", ...) -> ranked candidates
+        settings (FusionSettings): Blend method, weights and MMR settings
+        embedder (EmbeddingService): Embeds the candidates for the MMR diversity term,
+            the same documents come back for many queries so their vectors are stored
+
+    Returns:
+        FusionResult: at most settings.top_n candidates and the time spent per stage in ms
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    candidates, scores, ranks = _score_matrix(candidate_lists)
+    if not candidates:
+        return FusionResult([], {"normalize_ms": 0.0, "blend_ms": 0.0, "mmr_ms": 0.0, "fusion_ms": 0.0})
+
+    normalized = normalize_scores(scores)
+    mark = time.perf_counter()
+    timings["normalize_ms"] = (mark - started) * 1000
+
+    weights = _list_weights(list(candidate_lists), settings.alpha)
+    if settings.method == "rrf":
+        contributions = np.where(np.isnan(ranks), 0.0, 1.0 / (settings.rrf_k + np.nan_to_num(ranks, nan=1.0)))
+    else:
+        contributions = normalized
+    fused = (weights[:, None] * contributions).sum(axis=0) / max(float(weights.sum()), 1e-9)
+    relevance = normalize_scores(fused)
+    timings["blend_ms"] = (time.perf_counter() - mark) * 1000
+    mark = time.perf_counter()
+
+    if settings.mmr_lambda < 1.0 and len(candidates) > 1:
+        vectors = embedder.embed([c.text for c in candidates])
+        order = mmr(relevance, vectors, settings.top_n, settings.mmr_lambda)
+    else:
+        order = list(np.argsort(-relevance, kind="stable")[: settings.top_n])
+    timings["mmr_ms"] = (time.perf_counter() - mark) * 1000
+    timings["fusion_ms"] = (time.perf_counter() - started) * 1000
+
+    names = list(candidate_lists)
+    fused_candidates = [
+        FusedCandidate(
+            candidate=candidates[i],
+            score=float(fused[i]),
+            list_scores={
+                names[row]: float(normalized[row, i]) for row in range(len(names)) if not np.isnan(scores[row, i])
+            },
+        )
+        for i in order
+    ]
+    return FusionResult(fused_candidates, {k: round(v, 3) for k, v in timings.items()})
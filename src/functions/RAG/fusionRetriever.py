@@ -0,0 +1,69 @@
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from restack_ai.function import log
+from typing import Dict, List
+import asyncio
+import time
+
+from src.functions.RAG.fusion import Candidate, FusionResult, FusionSettings, FUSION_SETTINGS, fuse
+from src.utils.executor import run_blocking
+from src.utils.telemetry import record_fusion, record_http, record_retrieval
+
+
+def _candidates(nodes: List[NodeWithScore]) -> List[Candidate]:
+    return [Candidate(doc_id=n.node.node_id, text=n.node.get_content(), score=n.score, payload=n) for n in nodes]
+
+
+def _nodes(result: FusionResult) -> List[NodeWithScore]:
+    return [NodeWithScore(node=fused.candidate.payload.node, score=fused.score) for fused in result.candidates]
+
+
+class FusionRetriever(BaseRetriever):
+    """
+    Runs several retrievers and puts their results through the local fusion stage.
+
+    The engine cache builds one dense weighted and one sparse weighted
+    retriever over the same index, this class queries both concurrently and
+    returns the fused, MMR diversified nodes.
+    """
+
+    def __init__(self, retrievers: Dict[str, BaseRetriever], settings: FusionSettings = FUSION_SETTINGS):
+        self._retrievers = retrievers
+        self.settings = settings
+        super().__init__()
+
+    def _finish(self, candidate_lists: Dict[str, List[Candidate]], retrieve_seconds: float) -> FusionResult:
+        result = fuse(candidate_lists, self.settings)
+        result.timings["retrieve_ms"] = round(retrieve_seconds * 1000, 3)
+        record_fusion(result.timings)
+        record_retrieval(len(result.candidates), candidates=sum(len(c) for c in candidate_lists.values()))
+        record_http("retriever", "ok", retrieve_seconds)
+        log.info(f"RAG fusion: {sum(len(c) for c in candidate_lists.values())} candidates -> {len(result.candidates)}, timings {result.timings}")
+        return result
+
+    def fuse_retrieve(self, query_bundle: QueryBundle) -> FusionResult:
+        started = time.perf_counter()
+        candidate_lists = {
+            name: _candidates(retriever.retrieve(query_bundle)) for name, retriever in self._retrievers.items()
+        }
+        return self._finish(candidate_lists, time.perf_counter() - started)
+
+    async def afuse_retrieve(self, query_bundle: QueryBundle) -> FusionResult:
+        """Like aretrieve but also returns the per stage timings of this query"""
+        if isinstance(query_bundle, str):
+            query_bundle = QueryBundle(query_bundle)
+        started = time.perf_counter()
+        results = await asyncio.gather(*(r.aretrieve(query_bundle) for r in self._retrievers.values()))
+        candidate_lists = {name: _candidates(nodes) for name, nodes in zip(self._retrievers, results)}
+        # Embedding the candidates and the MMR pass are CPU work, keep them off the event loop
+        return await run_blocking(self._finish, candidate_lists, time.perf_counter() - started)
+
+    @staticmethod
+    def to_nodes(result: FusionResult) -> List[NodeWithScore]:
+        return _nodes(result)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return _nodes(self.fuse_retrieve(query_bundle))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return _nodes(await self.afuse_retrieve(query_bundle))
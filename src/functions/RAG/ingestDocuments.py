@@ -1,19 +1,48 @@
 from restack_ai.function import function, FunctionFailure, log
-from llama_index.indices.managed.llama_cloud import LlamaCloudIndex
-from llama_index.core import get_response_synthesizer
-from llama_index.core.query_engine import RetrieverQueryEngine
 from typing import Dict, List
 
 from src.utils.google_drive import upload_json_to_drive
+from src.functions.RAG.engineCache import get_engine, get_required_keys, index_id, RETRIEVER_BACKEND, LOCAL_INDEX_DIR
+from src.functions.cache.embeddings import embedding_service
+from src.functions.cache.retrievalCache import retrieval_cache
+from src.functions.RAG.discordIngestion import (
+    extract_qa_pairs, IngestionManifest, batched, DEFAULT_BATCH_SIZE, DEFAULT_MANIFEST_PATH
+)
+from src.utils.executor import run_blocking
+from src.utils.lazy import lazy_import
+from src.utils.resilience import provider_failure
+from src.utils.telemetry import instrument
+import json
 import os
 import time
 
+Document = lazy_import("llama_index.core", "Document")
+
+DEFAULT_DISCORD_OUTPUT = os.path.join(os.path.dirname(__file__), "..", "discord", "discord_processed_output.json")
+
+# How long after an upload to the Drive folder the index has synced it
+INDEX_SYNC_DELAY_SECONDS = int(os.getenv("INDEX_SYNC_DELAY_SECONDS", "1800"))
+
+
+async def invalidate_retrievals(index_name: str, delay_seconds: float = 0):
+    """Stop serving cached retrievals for an index that got (or will soon have) new documents"""
+    try:
+        version = await run_blocking(retrieval_cache.invalidate, index_name, delay_seconds)
+        if delay_seconds:
+            log.info(f"Retrieval cache for '{index_name}' will be invalidated in {delay_seconds}s")
+        else:
+            log.info(f"Retrieval cache for '{index_name}' invalidated, index version {version}")
+    except Exception as e:
+        # The documents are in, the cached results just live until their TTL
+        log.error(f"Failed to invalidate the retrieval cache: {str(e)}")
+
 
 @function.defn()
+@instrument
 async def ingest_documents_to_rag(input: dict) -> dict:
     # Validate input and API keys
     if not input:
-        raise function.FunctionFailure("Invalid input: input dictionary cannot be empty", non_retryable=True)
+        raise FunctionFailure("Invalid input: input dictionary cannot be empty", non_retryable=True)
     
    
     try:
@@ -34,99 +63,122 @@ async def ingest_documents_to_rag(input: dict) -> dict:
 
         filename = f"{int(time.time() * 1000)}-answer.json"
 
-        upload_json_to_drive(json_data, filename)
-        
+        # Reuses the cached Drive service and uploads from memory, off the event loop
+        upload = await run_blocking(upload_json_to_drive, json_data, filename=filename)
+        if not upload['success']:
+            # Nothing was stored yet, so the upload is safe to retry
+            raise FunctionFailure(f"Failed to upload the answer to Drive: {upload['error']}")
+
+        if RETRIEVER_BACKEND == "local":
+            from src.functions.RAG.localIndex import document_from_drive_file, shared_index
+
+            # Same document the local index build makes from the Drive folder
+            document = document_from_drive_file({"id": upload["file_id"], "name": filename}, json_data)
+            await run_blocking(shared_index(LOCAL_INDEX_DIR).upsert_and_save, [document], LOCAL_INDEX_DIR)
+            await invalidate_retrievals(index_id())
+        else:
+            # LlamaCloud only has the answer after its next sync of the folder,
+            # results retrieved until then are still current
+            await invalidate_retrievals(index_id(), delay_seconds=INDEX_SYNC_DELAY_SECONDS)
+
         return {
             "result": "success"
         }
         
 
+    except FunctionFailure:
+        raise
     except Exception as e:
-        function.log.error(f"Error in llama_cloud_rag: {str(e)}")
-        raise function.FunctionFailure(f"Error ingesting documents: {str(e)}", non_retryable=True) from e
+        log.error(f"Error in ingest_documents_to_rag: {str(e)}")
+        raise FunctionFailure(f"Error ingesting documents: {str(e)}", non_retryable=True) from e
 
+@function.defn()
+@instrument
 async def create_questions_from_processed_discord_messages(input: dict) -> dict:
     # Validate input and API keys
     if not input:
-        raise function.FunctionFailure("Invalid input: input dictionary cannot be empty", non_retryable=True)
+        raise FunctionFailure("Invalid input: input dictionary cannot be empty", non_retryable=True)
     
-    required_keys = {
-        "LLAMA_CLOUD_API_KEY": os.getenv("LLAMA_CLOUD_API_KEY"),
-        "ANTHROPIC_API_KEY": os.getenv("ANTHROPIC_API_KEY"),
-    }
+    required_keys = get_required_keys()
     
     missing_keys = [k for k, v in required_keys.items() if not v]
     if missing_keys:
-        raise function.FunctionFailure(f"Missing required API keys: {', '.join(missing_keys)}", non_retryable=True)
+        raise FunctionFailure(f"Missing required API keys: {', '.join(missing_keys)}", non_retryable=True)
 
     try:
-        # Initialize LlamaCloud Index
-        
+        # Either the generate_drive_documents() output itself or a file it was saved to
+        documents = input.get("documents")
+        if documents is None:
+            documents_path = input.get("documents_path", DEFAULT_DISCORD_OUTPUT)
+            with open(documents_path) as f:
+                documents = json.load(f)
+
+        batch_size = input.get("batch_size", DEFAULT_BATCH_SIZE)
+
+        pairs = extract_qa_pairs(documents)
+
+        # Only new or changed question/answer pairs go to the index
+        manifest = IngestionManifest(input.get("manifest_path", DEFAULT_MANIFEST_PATH), index_id())
+        new, changed = manifest.plan(pairs)
+
+        if not new and not changed:
+            log.info(f"Discord ingestion: {len(pairs)} question/answer pairs, nothing new")
+            return {
+                "result": "success",
+                "pairs": len(pairs),
+                "inserted": 0,
+                "updated": 0,
+                "unchanged": len(pairs)
+            }
 
-        index = LlamaCloudIndex(
-            name="Trieoverflow General Index for All Frameworks", 
-            project_name="Trieoverflow",
-            organization_id="37ad34df-e1d9-481e-9007-9b194cf46e13",
-            api_key=required_keys["LLAMA_CLOUD_API_KEY"]
-        )
-
-        # Initialize LLMs
-        llm_anthropic = Anthropic(
-            model="claude-3-5-sonnet-20240620",
-            api_key=required_keys["ANTHROPIC_API_KEY"],
-            timeout=60
-        )
-
-       
-
-        # Setup retriever and query engine
-        response_synthesizer = get_response_synthesizer(llm=llm_anthropic)
-        retriever = index.as_retriever(
-            dense_similarity_top_k=5,
-            sparse_similarity_top_k=5,
-            alpha=0.5,
-            enable_reranking=True,
-            rerank_top_n=5
-        )
-
-        query_engine = RetrieverQueryEngine(
-            retriever=retriever,
-            response_synthesizer=response_synthesizer
-        )
-
-        # Extract input parameters
-        query = input.get("query")
-        user_preferences = input.get("user_preferences")
-        context = input.get("context", "")
-
-        # Construct the query prompt
-        query_prompt = f"""
-        Based on the following information:
-        
-        Query: {query}
-        User Preferences: {user_preferences}
-        Additional Context: {context}
-        
-        Please provide relevant information and insights while considering:
-        1. The specific query requirements
-        2. User's stated preferences
-        3. Any contextual information provided
-        
-        Format the response to be clear and structured.
-        """
+        # Reuse the pooled index instead of building it per call,
+        # building it on a cold cache is blocking so keep it off the event loop
+        # Same fusion settings as the query functions, so they share one cached engine
+        engine = await run_blocking(get_engine, required_keys, fusion=input.get("fusion"))
+        index = engine.index
+
+        upserts = [(pair, False) for pair in new] + [(pair, True) for pair in changed]
+
+        for batch in batched(upserts, batch_size):
+            def upsert_batch():
+                if RETRIEVER_BACKEND == "local":
+                    from src.functions.RAG.localIndex import LocalDocument
+
+                    # The local index rebuilds its sparse and IVF parts per upsert, so do the batch at once
+                    index.upsert_and_save([LocalDocument(pair.doc_id, pair.text, pair.metadata) for pair, _ in batch], LOCAL_INDEX_DIR)
+                    return
+
+                # LlamaCloud embeds on its side, store our vectors for when the
+                # pairs come back as fusion candidates. The local index gets
+                # them from the store in upsert
+                embedding_service.embed([pair.text for pair, _ in batch], persist=True)
+
+                for pair, exists in batch:
+                    document = Document(text=pair.text, id_=pair.doc_id, metadata=pair.metadata)
+                    if exists:
+                        index.update_ref_doc(document)
+                    else:
+                        index.insert(document)
+
+            await run_blocking(upsert_batch)
+            await invalidate_retrievals(engine.index_name)
+
+            # Save after every batch so a failed run picks up where it stopped
+            manifest.record(pair for pair, _ in batch)
+            await run_blocking(manifest.save)
+
+        log.info(f"Discord ingestion: {len(new)} inserted, {len(changed)} updated, {len(pairs) - len(upserts)} unchanged")
 
-        # Execute query
-        response = query_engine.query(query_prompt)
-        
         return {
-            "response": response.response,
-            "sources": [node.text for node in response.source_nodes],
-            "metadata": {
-                "query_timestamp": response.metadata.get("timestamp"),
-                "total_sources": len(response.source_nodes)
-            }
+            "result": "success",
+            "pairs": len(pairs),
+            "inserted": len(new),
+            "updated": len(changed),
+            "unchanged": len(pairs) - len(upserts)
         }
 
     except Exception as e:
-        function.log.error(f"Error in llama_cloud_rag: {str(e)}")
-        raise function.FunctionFailure(f"Failed to process RAG query: {str(e)}", non_retryable=True) from e
\ No newline at end of file
+        log.error(f"Error in create_questions_from_processed_discord_messages: {str(e)}")
+        # Transient LlamaCloud and network errors are retried, the manifest
+        # makes the retry skip the batches that are already in
+        raise provider_failure("Failed to ingest Discord questions", e) from e
@@ -1,11 +1,18 @@
 from restack_ai.function import function, FunctionFailure, log
-from llama_index.llms.anthropic import Anthropic
-from llama_index.indices.managed.llama_cloud import LlamaCloudIndex
-from llama_index.core import get_response_synthesizer
-from llama_index.core.query_engine import RetrieverQueryEngine
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 import os
 
+from src.functions.RAG.engineCache import get_engine, get_required_keys, RETRIEVER_BACKEND
+from src.functions.RAG.promptTemplates import RAG_ANSWER
+from src.functions.cache.retrievalCache import retrieval_cache, ENABLED as RETRIEVAL_CACHE_ENABLED
+from src.utils.executor import run_blocking
+from src.utils.lazy import lazy_import
+from src.utils.resilience import call_provider, provider_failure
+from src.utils.token_stream import open_stream
+from src.utils.telemetry import instrument, record_retrieval
+
+QueryBundle = lazy_import("llama_index.core.schema", "QueryBundle")
+
 
 
 # from snowflake.core import Root
@@ -49,95 +56,123 @@ import os
 #         "result": "success"
 #     }
 
+async def stream_response(response, stream_id: str) -> str:
+    """Push the synthesized tokens to the frontend as they arrive and return the full text"""
+    chunks = []
+    with open_stream(stream_id) as stream:
+        try:
+            if hasattr(response, "async_response_gen"):
+                async for delta in response.async_response_gen():
+                    chunks.append(delta)
+                    stream.publish("rag_results", delta)
+            else:
+                for delta in response.response_gen:
+                    chunks.append(delta)
+                    stream.publish("rag_results", delta)
+        except Exception as e:
+            stream.finish("rag_results", error=str(e))
+            raise
+        stream.finish("rag_results")
+    return "".join(chunks)
+
+
+async def retrieve_nodes(engine, query_bundle) -> Tuple[list, Optional[dict], bool]:
+    """
+    Retrieve the nodes for a query through the resilience layer (retrieval is
+    idempotent, so it gets hedged).
+
+    Repeat retrievals are answered by the retrieval cache until the next
+    ingestion into the index, see src/functions/cache/retrievalCache.py.
+
+    Returns:
+        tuple: the nodes, the fusion timings (None without the local fusion
+        stage or when the nodes came from the cache) and whether the nodes
+        came from the retrieval cache
+    """
+    cache_key = None
+    if RETRIEVAL_CACHE_ENABLED:
+        try:
+            nodes, cache_key = await run_blocking(
+                retrieval_cache.lookup, engine.index_name, engine.retrieval_settings, query_bundle.query_str
+            )
+            if nodes is not None:
+                return nodes, None, True
+        except Exception as e:
+            # A broken cache should never fail the query, just retrieve
+            log.error(f"Retrieval cache lookup failed: {str(e)}")
+
+    if hasattr(engine.retriever, "afuse_retrieve"):
+        fused = await call_provider(RETRIEVER_BACKEND, lambda: engine.retriever.afuse_retrieve(query_bundle), hedge=True)
+        nodes, fusion_timings = engine.retriever.to_nodes(fused), fused.timings
+    else:
+        nodes = await call_provider(RETRIEVER_BACKEND, lambda: engine.query_engine.aretrieve(query_bundle), hedge=True)
+        record_retrieval(len(nodes))
+        fusion_timings = None
+
+    # An empty result is more likely a hiccup than the answer, retrieve it again next time
+    if cache_key is not None and nodes:
+        try:
+            await run_blocking(retrieval_cache.store, cache_key, engine.index_name, nodes)
+        except Exception as e:
+            log.error(f"Retrieval cache store failed: {str(e)}")
+
+    return nodes, fusion_timings, False
+
+
 @function.defn()
+@instrument
 async def llama_cloud_rag(input: dict) -> dict:
     # Validate input and API keys
     if not input:
         raise FunctionFailure("Invalid input: input dictionary cannot be empty", non_retryable=True)
     
-    required_keys = {
-        "LLAMA_CLOUD_API_KEY": os.getenv("LLAMA_CLOUD_API_KEY"),
-        "ANTHROPIC_API_KEY": os.getenv("ANTHROPIC_API_KEY"),
-
-    }
+    required_keys = get_required_keys()
     
     missing_keys = [k for k, v in required_keys.items() if not v]
     if missing_keys:
         raise FunctionFailure(f"Missing required API keys: {', '.join(missing_keys)}", non_retryable=True)
 
     try:
-        # Initialize LlamaCloud Index
-
-        index = LlamaCloudIndex(
-            name="Trieoverflow General Index for All Frameworks", 
-            project_name="Trieoverflow",
-            organization_id="37ad34df-e1d9-481e-9007-9b194cf46e13",
-            api_key=required_keys["LLAMA_CLOUD_API_KEY"]
-        )
-
-        # Initialize LLMs
-        llm_anthropic = Anthropic(
-            model="claude-3-5-sonnet-20240620",
-            api_key=required_keys["ANTHROPIC_API_KEY"],
-            timeout=60
-        )
-
-       
-
-        # Setup retriever and query engine
-        response_synthesizer = get_response_synthesizer(llm=llm_anthropic)
-        retriever = index.as_retriever(
-            dense_similarity_top_k=5,
-            sparse_similarity_top_k=5,
-            alpha=0.5,
-            enable_reranking=True,
-            rerank_top_n=5
-        )
-
-        query_engine = RetrieverQueryEngine(
-            retriever=retriever,
-            response_synthesizer=response_synthesizer
-        )
-
+        # Reuse the pooled index / LLM / query engine instead of building them per call,
+        # building it on a cold cache is blocking so keep it off the event loop
         # Extract input parameters
         query = input.get("query")
-       
-
-        # Construct the query prompt
-        query_prompt = f"""
-        You are a helpful coding assistant. I have a question from a user that needs to be answered using relevant documentation and discussions.
-
-        User Question: {query}
-
-        Please provide a detailed and accurate response that:
-        1. Directly addresses the user's coding question
-        2. Includes relevant code examples when appropriate
-        3. Explains the reasoning behind the solution
-        4. References any best practices or important considerations
-        5. Cites specific documentation or discussions that support the answer
-
-        Format your response in a clear, structured way with:
-        - A direct answer to the question
-        - Code examples (if applicable)
-        - Explanation of key concepts
-        - Any important caveats or considerations
-        - References to supporting documentation
-
-        Base your response only on the most relevant information from the knowledge base.
-        """
-
-        # Execute query
-        response = query_engine.query(query_prompt)
-        
+        stream_id = input.get("stream_id")
+
+        engine = await run_blocking(get_engine, required_keys, streaming=bool(stream_id), fusion=input.get("fusion"))
+
+
+        # Retrieve and synthesize separately, so each goes through the resilience
+        # layer of its own provider.
+        # With the local fusion stage the per query timings are returned alongside the answer.
+        # The instructions are in the engine's prompt template, only the question is retrieved for
+        query_bundle = QueryBundle(query)
+        nodes, fusion_timings, from_cache = await retrieve_nodes(engine, query_bundle)
+
+        # Cached nodes were sent to Anthropic before, mark them for the prompt cache
+        query_engine = engine.synthesis_engine(repeated_context=from_cache)
+        response = await call_provider("anthropic", lambda: query_engine.asynthesize(query_bundle, nodes))
+
+        if stream_id:
+            response_text = await stream_response(response, stream_id)
+        else:
+            response_text = response.response
+
+        sources = [node.text for node in response.source_nodes]
+        prompt_tokens = RAG_ANSWER.token_counts(cache_context=from_cache, context_str="\n\n".join(sources), query_str=query)
+        log.info(f"RAG prompt tokens: {prompt_tokens}")
+
         return {
-            "response": response.response,
-            "sources": [node.text for node in response.source_nodes],
+            "response": response_text,
+            "sources": sources,
             "metadata": {
                 "query_timestamp": response.metadata.get("timestamp"),
-                "total_sources": len(response.source_nodes)
+                "total_sources": len(response.source_nodes),
+                "fusion_timings": fusion_timings,
+                "prompt_tokens": prompt_tokens
             }
         }
 
     except Exception as e:
         log.error(f"Error in llama_cloud_rag: {str(e)}")
-        raise FunctionFailure(f"Failed to process RAG query: {str(e)}", non_retryable=True) from e
\ No newline at end of file
+        raise provider_failure("Failed to process RAG query", e) from e
\ No newline at end of file
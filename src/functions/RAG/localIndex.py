@@ -0,0 +1,513 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+import fcntl
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from restack_ai.function import log
+
+from src.functions.cache.embeddings import EmbeddingService, embedding_service
+from src.functions.RAG.fusion import normalize_scores
+
+
+# Local alternative to the LlamaCloud index: a dense IVF index over a memory
+# mapped NumPy embedding matrix plus a BM25 sparse index, both kept on disk
+
+DEFAULT_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", os.path.join(os.getcwd(), ".cache", "local_index"))
+
+# Below this many documents a flat scan is faster than going through the IVF lists
+IVF_MIN_DOCUMENTS = 4096
+
+CURRENT_FILE = "CURRENT"
+# The live generation and the one before it, for processes still loading it
+KEEP_GENERATIONS = 2
+# How often a loaded index checks for a newer generation
+RELOAD_CHECK_SECONDS = float(os.getenv("LOCAL_INDEX_RELOAD_CHECK_SECONDS", "5"))
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall((text or "").lower())
+
+
+@dataclass
+class LocalDocument:
+    doc_id: str
+    text: str
+    metadata: dict = field(default_factory=dict)
+
+
+@dataclass
+class SearchHit:
+    document: LocalDocument
+    score: float
+    dense_score: float = 0.0
+    sparse_score: float = 0.0
+
+
+class BM25Index:
+    """Okapi BM25 over an in memory inverted index"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_lengths: List[int] = []
+        self.avg_length = 0.0
+
+    def build(self, texts: List[str]):
+        self.postings = {}
+        self.doc_lengths = []
+        for doc_index, text in enumerate(texts):
+            tokens = tokenize(text)
+            self.doc_lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                self.postings.setdefault(term, {})[doc_index] = count
+        self.avg_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0.0
+        return self
+
+    def scores(self, query: str) -> np.ndarray:
+        n_docs = len(self.doc_lengths)
+        scores = np.zeros(n_docs, dtype=np.float32)
+        if not n_docs:
+            return scores
+
+        lengths = np.asarray(self.doc_lengths, dtype=np.float32)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            doc_ids = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+            tf = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+            norm = self.k1 * (1 - self.b + self.b * lengths[doc_ids] / (self.avg_length or 1.0))
+            scores[doc_ids] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def to_dict(self) -> dict:
+        return {
+            "k1": self.k1,
+            "b": self.b,
+            "postings": {term: list(p.items()) for term, p in self.postings.items()},
+            "doc_lengths": self.doc_lengths,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BM25Index":
+        index = cls(k1=data["k1"], b=data["b"])
+        index.postings = {term: {int(d): c for d, c in p} for term, p in data["postings"].items()}
+        index.doc_lengths = data["doc_lengths"]
+        index.avg_length = sum(index.doc_lengths) / len(index.doc_lengths) if index.doc_lengths else 0.0
+        return index
+
+
+class IVFIndex:
+    """
+    Inverted file index over normalized embeddings.
+
+    The vectors are clustered with a few rounds of k-means, a query only
+    scans the vectors in its nprobe closest clusters.
+    """
+
+    def __init__(self, embeddings: np.ndarray, centroids: Optional[np.ndarray] = None, assignments: Optional[np.ndarray] = None, nprobe: int = 8):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.assignments = assignments
+        self.nprobe = nprobe
+        self._lists = None
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, n_lists: Optional[int] = None, iterations: int = 10, seed: int = 0) -> "IVFIndex":
+        n_docs = embeddings.shape[0]
+        if n_docs < IVF_MIN_DOCUMENTS:
+            return cls(embeddings)
+
+        n_lists = n_lists or int(math.sqrt(n_docs))
+        rng = np.random.default_rng(seed)
+        centroids = embeddings[rng.choice(n_docs, size=n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = np.argmax(embeddings @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = embeddings[assignments == c]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+
+        assignments = np.argmax(embeddings @ centroids.T, axis=1)
+        return cls(embeddings, centroids.astype(np.float32), assignments.astype(np.int32))
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            bounds = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, bounds)
+        return self._lists
+
+    def scores(self, query_vector: np.ndarray) -> np.ndarray:
+        """Dense scores for every document, -inf for documents outside the probed clusters"""
+        if self.centroids is None:
+            return self.embeddings @ query_vector
+
+        order, bounds = self._inverted_lists()
+        probes = np.argsort(-(self.centroids @ query_vector))[:self.nprobe]
+        candidates = np.concatenate([order[bounds[c]:bounds[c + 1]] for c in probes])
+
+        scores = np.full(self.embeddings.shape[0], -np.inf, dtype=np.float32)
+        scores[candidates] = self.embeddings[candidates] @ query_vector
+        return scores
+
+
+@dataclass(frozen=True)
+class _IndexState:
+    """One consistent version of the index, replaced as a whole and never changed in place"""
+    documents: List[LocalDocument]
+    ivf: IVFIndex
+    bm25: BM25Index
+
+
+def _current_generation(path: str) -> Optional[str]:
+    try:
+        with open(os.path.join(path, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _load_state(directory: str) -> _IndexState:
+    with open(os.path.join(directory, "documents.jsonl")) as f:
+        documents = [LocalDocument(**json.loads(line)) for line in f if line.strip()]
+
+    # Memory map the matrix, the OS pages in only the rows a query touches
+    embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+
+    ivf_path = os.path.join(directory, "ivf.npz")
+    if os.path.exists(ivf_path):
+        data = np.load(ivf_path)
+        ivf = IVFIndex(embeddings, data["centroids"], data["assignments"])
+    else:
+        ivf = IVFIndex(embeddings)
+
+    with open(os.path.join(directory, "bm25.json")) as f:
+        bm25 = BM25Index.from_dict(json.load(f))
+
+    return _IndexState(documents, ivf, bm25)
+
+
+def _prune_generations(path: str, keep: int):
+    # Processes that still map a removed generation keep reading it, the
+    # files go away when the last map is closed
+    generations = sorted(name for name in os.listdir(path) if name.startswith("gen-"))
+    for name in generations[:-keep]:
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+class LocalHybridIndex:
+    """
+    Dense + BM25 hybrid index saved in a directory. Every save writes a new
+    generation directory and then points CURRENT at it:
+
+        CURRENT           name of the live generation
+        gen-<ns>/
+            documents.jsonl   doc id, text and metadata
+            embeddings.npy    float32 matrix, opened memory mapped
+            ivf.npz           IVF centroids and assignments (large indexes only)
+            bm25.json         sparse index
+
+    Files are never rewritten in place, a process that has the previous
+    embeddings.npy mapped keeps reading it until it reloads. Loaded indexes
+    check CURRENT at most every RELOAD_CHECK_SECONDS and swap in the new
+    generation, so every worker picks up an ingestion.
+    """
+
+    def __init__(self, documents: List[LocalDocument], ivf: IVFIndex, bm25: BM25Index, embedder: EmbeddingService = embedding_service):
+        self._state = _IndexState(documents, ivf, bm25)
+        self.embedder = embedder
+        # Directory and generation this index was loaded from or saved to
+        self.path: Optional[str] = None
+        self.generation: Optional[str] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def documents(self) -> List[LocalDocument]:
+        return self._state.documents
+
+    @property
+    def ivf(self) -> IVFIndex:
+        return self._state.ivf
+
+    @property
+    def bm25(self) -> BM25Index:
+        return self._state.bm25
+
+    @classmethod
+    def build(cls, documents: List[LocalDocument], embedder: EmbeddingService = embedding_service, persist: bool = False) -> "LocalHybridIndex":
+        # Documents the precompute job (or an earlier ingestion) has seen come from the embedding store,
+        # persist adds the rest
+        embeddings = embedder.embed([d.text for d in documents], persist=persist)
+        return cls(
+            documents=documents,
+            ivf=IVFIndex.build(embeddings),
+            bm25=BM25Index().build([d.text for d in documents]),
+            embedder=embedder,
+        )
+
+    def save(self, path: str = DEFAULT_INDEX_DIR):
+        """Write the index as a new generation and make it the live one"""
+        state = self._state
+        os.makedirs(path, exist_ok=True)
+
+        generation = f"gen-{time.time_ns()}-{os.getpid()}"
+        staging = os.path.join(path, f".{generation}.tmp")
+        os.makedirs(staging)
+        with open(os.path.join(staging, "documents.jsonl"), "w") as f:
+            for d in state.documents:
+                f.write(json.dumps({"doc_id": d.doc_id, "text": d.text, "metadata": d.metadata}) + "\n")
+        np.save(os.path.join(staging, "embeddings.npy"), np.asarray(state.ivf.embeddings, dtype=np.float32))
+        if state.ivf.centroids is not None:
+            np.savez(os.path.join(staging, "ivf.npz"), centroids=state.ivf.centroids, assignments=state.ivf.assignments)
+        with open(os.path.join(staging, "bm25.json"), "w") as f:
+            json.dump(state.bm25.to_dict(), f)
+        os.replace(staging, os.path.join(path, generation))
+
+        pointer = os.path.join(path, f".{CURRENT_FILE}.{generation}.tmp")
+        with open(pointer, "w") as f:
+            f.write(generation)
+        os.replace(pointer, os.path.join(path, CURRENT_FILE))
+
+        # Serve the saved files from now on, the in memory matrix is dropped
+        with self._lock:
+            if self._state is state:
+                self._state = _load_state(os.path.join(path, generation))
+            self.path, self.generation = path, generation
+            self._checked_at = time.monotonic()
+
+        _prune_generations(path, keep=KEEP_GENERATIONS)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_INDEX_DIR, embedder: EmbeddingService = embedding_service, missing_ok: bool = False) -> "LocalHybridIndex":
+        """
+        The live generation in path. With missing_ok a directory without an
+        index gives an empty one, which picks up the first generation saved there.
+        """
+        index = cls([], IVFIndex(np.zeros((0, embedder.dim), dtype=np.float32)), BM25Index(), embedder)
+        index.path = path
+        if not index.reload() and not missing_ok:
+            raise FileNotFoundError(f"No local index in {path}")
+        return index
+
+    def reload(self) -> bool:
+        """Swap in the live generation if another process saved a newer one, True if the index is loaded"""
+        generation = _current_generation(self.path)
+        if generation is None:
+            # Indexes saved before generations, straight in the directory
+            if self.generation is None and os.path.exists(os.path.join(self.path, "documents.jsonl")):
+                self._state = _load_state(self.path)
+                self.generation = ""
+            return self.generation is not None
+
+        if generation != self.generation:
+            state = _load_state(os.path.join(self.path, generation))
+            with self._lock:
+                self._state, self.generation = state, generation
+        return True
+
+    def _maybe_reload(self):
+        if self.path is None or time.monotonic() - self._checked_at < RELOAD_CHECK_SECONDS:
+            return
+        self._checked_at = time.monotonic()
+        try:
+            self.reload()
+        except (OSError, ValueError) as e:
+            # Keep serving the generation already loaded
+            log.warning(f"Failed to reload the local index from {self.path}: {e}")
+
+    def upsert(self, documents: List[LocalDocument], persist: bool = False) -> "LocalHybridIndex":
+        """
+        Insert new documents and replace changed ones, only the new texts are embedded.
+
+        The BM25 and IVF structures are rebuilt from scratch, which is cheap
+        next to embedding, so call this with a whole batch at once. Searches
+        running meanwhile keep using the previous version, the new one is
+        swapped in as a whole.
+        """
+        with self._lock:
+            state = self._state
+            positions = {d.doc_id: i for i, d in enumerate(state.documents)}
+            merged = list(state.documents)
+            vectors = np.array(state.ivf.embeddings, dtype=np.float32)
+            appended = []
+
+            for document, vector in zip(documents, self.embedder.embed([d.text for d in documents], persist=persist)):
+                if document.doc_id in positions:
+                    merged[positions[document.doc_id]] = document
+                    vectors[positions[document.doc_id]] = vector
+                else:
+                    positions[document.doc_id] = len(merged)
+                    merged.append(document)
+                    appended.append(vector)
+
+            if appended:
+                vectors = np.vstack([vectors.reshape(-1, len(appended[0])), np.asarray(appended)])
+
+            self._state = _IndexState(merged, IVFIndex.build(vectors), BM25Index().build([d.text for d in merged]))
+        return self
+
+    def upsert_and_save(self, documents: List[LocalDocument], path: Optional[str] = None) -> "LocalHybridIndex":
+        """
+        upsert + save under an exclusive lock on the index directory, on top of
+        the latest generation, so concurrent ingestions don't drop each other's
+        documents. This is the ingestion path, the new vectors go to the embedding store.
+        """
+        path = path or self.path or DEFAULT_INDEX_DIR
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self.path == path:
+                    self.reload()
+                self.upsert(documents, persist=True)
+                self.save(path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return self
+
+    def search(self, query: str, dense_top_k: int = 5, sparse_top_k: int = 5, alpha: float = 0.5, top_k: Optional[int] = None) -> List[SearchHit]:
+        """
+        Hybrid search, same knobs as the LlamaCloud retriever.
+
+        The dense_top_k best dense and sparse_top_k best BM25 documents are
+        merged and ranked by alpha * dense + (1 - alpha) * sparse on min-max
+        normalized scores.
+
+        Returns:
+            List[SearchHit]: best first
+        """
+        self._maybe_reload()
+        # One version for the whole search, upsert and reload swap in a new one meanwhile
+        state = self._state
+        if not state.documents:
+            return []
+
+        query_vector = self.embedder.embed_one(query)
+        dense = state.ivf.scores(query_vector)
+        sparse = state.bm25.scores(query)
+
+        candidates = set()
+        if dense_top_k:
+            finite = np.where(np.isfinite(dense))[0]
+            if len(finite):
+                k = min(dense_top_k, len(finite))
+                best = finite[np.argpartition(-dense[finite], k - 1)[:k]]
+                candidates.update(best.tolist())
+        if sparse_top_k:
+            k = min(sparse_top_k, len(sparse))
+            best = np.argpartition(-sparse, k - 1)[:k]
+            candidates.update(i for i in best.tolist() if sparse[i] > 0)
+
+        if not candidates:
+            return []
+
+        ids = np.fromiter(candidates, dtype=np.int64)
+
+        # BM25 candidates may sit outside the probed IVF clusters, score every candidate exactly
+        candidate_dense = np.asarray(state.ivf.embeddings[ids] @ query_vector, dtype=np.float32)
+        candidate_sparse = sparse[ids]
+        blended = alpha * normalize_scores(candidate_dense) + (1 - alpha) * normalize_scores(candidate_sparse)
+
+        order = np.argsort(-blended)[: top_k or max(dense_top_k, sparse_top_k)]
+        return [
+            SearchHit(
+                document=state.documents[ids[i]],
+                score=float(blended[i]),
+                dense_score=float(candidate_dense[i]),
+                sparse_score=float(candidate_sparse[i]),
+            )
+            for i in order
+        ]
+
+
+_shared_indexes: Dict[str, LocalHybridIndex] = {}
+_shared_lock = threading.Lock()
+
+
+def shared_index(path: str = DEFAULT_INDEX_DIR) -> LocalHybridIndex:
+    """
+    The process wide index for a directory. Every engine and the ingestion
+    use this one object, so the embedding matrix is mapped once per process
+    and an upsert is seen by every retriever at once.
+
+    Empty until the first ingestion (or build_local_index) saves to the directory.
+    """
+    path = os.path.abspath(path)
+    with _shared_lock:
+        if path not in _shared_indexes:
+            _shared_indexes[path] = LocalHybridIndex.load(path, missing_ok=True)
+        return _shared_indexes[path]
+
+
+def documents_from_discord(documents) -> List[LocalDocument]:
+    """Index the same question/answer pairs that go into LlamaCloud"""
+    from src.functions.RAG.discordIngestion import extract_qa_pairs
+
+    return [LocalDocument(p.doc_id, p.text, p.metadata) for p in extract_qa_pairs(documents)]
+
+
+def document_from_drive_file(file: dict, data: Optional[dict]) -> Optional[LocalDocument]:
+    """A submitted answer downloaded from Drive as a document, None if it isn't one"""
+    if not data or "query" not in data:
+        return None
+    return LocalDocument(
+        doc_id=f"drive-{file['id']}",
+        text=f"Question: {data['query']}\n\nAnswer:\n{data.get('answer', '')}",
+        metadata={"source": "drive", "file_id": file["id"], "name": file["name"]},
+    )
+
+
+def documents_from_drive(folder_id: str) -> List[LocalDocument]:
+    """Index the submitted answers stored as JSON files in the Drive answers folder"""
+    from src.utils.google_drive import iter_files_in_folder, download_json_from_drive
+
+    documents = []
+    for file in iter_files_in_folder(folder_id):
+        if not file["name"].endswith(".json"):
+            continue
+        document = document_from_drive_file(file, download_json_from_drive(file["id"]))
+        if document is not None:
+            documents.append(document)
+    return documents
+
+
+def build_local_index(discord_path: Optional[str] = None, drive_folder_id: Optional[str] = None, path: str = DEFAULT_INDEX_DIR) -> LocalHybridIndex:
+    documents = []
+    if discord_path:
+        with open(discord_path) as f:
+            documents += documents_from_discord(json.load(f))
+    if drive_folder_id:
+        documents += documents_from_drive(drive_folder_id)
+
+    index = LocalHybridIndex.build(documents, persist=True)
+    index.save(path)
+    return index
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the local hybrid retrieval index")
+    parser.add_argument("--discord", help="generate_drive_documents() output JSON")
+    parser.add_argument("--drive-folder", help="Drive folder with submitted answers")
+    parser.add_argument("--out", default=DEFAULT_INDEX_DIR)
+    args = parser.parse_args()
+
+    built = build_local_index(args.discord, args.drive_folder, args.out)
+    print(f"Indexed {len(built.documents)} documents into {args.out}")
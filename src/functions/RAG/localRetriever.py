@@ -0,0 +1,55 @@
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from typing import List
+
+from src.functions.RAG.localIndex import LocalHybridIndex
+from src.utils.executor import run_blocking
+
+
+class LocalHybridRetriever(BaseRetriever):
+    """
+    llama_index retriever on top of LocalHybridIndex.
+
+    Takes the same arguments as LlamaCloudIndex.as_retriever so the two
+    backends are interchangeable in the engine cache. Reranking is not done
+    locally, rerank_top_n only caps the number of results.
+
+    The search is numpy work, aretrieve runs it in the shared thread pool
+    so it doesn't hold up the worker's event loop.
+    """
+
+    def __init__(
+        self,
+        index: LocalHybridIndex,
+        dense_similarity_top_k: int = 5,
+        sparse_similarity_top_k: int = 5,
+        alpha: float = 0.5,
+        enable_reranking: bool = False,
+        rerank_top_n: int = 5,
+        **kwargs
+    ):
+        self._index = index
+        self._dense_top_k = dense_similarity_top_k
+        self._sparse_top_k = sparse_similarity_top_k
+        self._alpha = alpha
+        self._top_n = rerank_top_n if enable_reranking else max(dense_similarity_top_k, sparse_similarity_top_k)
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        hits = self._index.search(
+            query_bundle.query_str,
+            dense_top_k=self._dense_top_k,
+            sparse_top_k=self._sparse_top_k,
+            alpha=self._alpha,
+            top_k=self._top_n,
+        )
+        return [
+            NodeWithScore(
+                node=TextNode(text=hit.document.text, id_=hit.document.doc_id, metadata=hit.document.metadata),
+                score=hit.score,
+            )
+            for hit in hits
+        ]
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return await run_blocking(self._retrieve, query_bundle)
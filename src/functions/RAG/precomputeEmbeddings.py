@@ -0,0 +1,159 @@
+from restack_ai.function import function, FunctionFailure, log
+from typing import List, Tuple
+import asyncio
+import json
+import os
+import time
+
+from src.functions.cache.embeddings import embedding_service, STORE_DIR
+from src.functions.RAG.ingestDocuments import DEFAULT_DISCORD_OUTPUT
+from src.functions.RAG.localIndex import document_from_drive_file, documents_from_discord
+from src.utils.executor import run_blocking
+from src.utils.google_drive import DEFAULT_FOLDER_ID, commit_folder_changes, download_json_from_drive, sync_folder_changes
+from src.utils.telemetry import instrument
+
+
+# Bulk job that fills the embedding store with every document the indexes
+# hold, the submitted answers in the Drive folder and the processed Discord
+# threads, so the local index build and the fusion stage find their vectors
+# instead of embedding them while a query waits.
+#
+# Drive is read with the changes API, only the first run lists the whole folder.
+# The changes API won't show a file again once the page token moved past it,
+# so files that fail to download are kept in a retry list for the next run.
+
+# The job's own page token, separate from the ingestion's
+DRIVE_STATE_DIR = os.path.join(STORE_DIR, "drive")
+DOWNLOAD_CONCURRENCY = 8
+
+
+def _retry_path(folder_id: str) -> str:
+    return os.path.join(DRIVE_STATE_DIR, f"{folder_id}.retry.json")
+
+
+def load_retry_files(folder_id: str) -> List[dict]:
+    path = _retry_path(folder_id)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_retry_files(folder_id: str, files: List[dict]):
+    path = _retry_path(folder_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(files, f)
+    os.replace(tmp_path, path)
+
+
+async def drive_texts(folder_id: str) -> Tuple[List[str], str]:
+    """
+    Texts of the answers added to or changed in the Drive folder since the
+    last run, and the page token to commit once they are embedded.
+    """
+    sync = await run_blocking(sync_folder_changes, folder_id, DRIVE_STATE_DIR)
+    if not sync['success']:
+        raise FunctionFailure(f"Failed to list the Drive folder: {sync['error']}")
+
+    # Files that failed last time, unless they changed again or were removed since
+    files = {f['id']: f for f in await run_blocking(load_retry_files, folder_id)}
+    files.update((f['id'], f) for f in sync['files'] if f['name'].endswith('.json'))
+    for file_id in sync['removed']:
+        files.pop(file_id, None)
+
+    semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    failed = []
+
+    async def download(file: dict):
+        async with semaphore:
+            data = await run_blocking(download_json_from_drive, file['id'])
+        if data is None:
+            failed.append(file)
+            return None
+        return document_from_drive_file(file, data)
+
+    documents = await asyncio.gather(*(download(f) for f in files.values()))
+    await run_blocking(save_retry_files, folder_id, failed)
+    if failed:
+        log.warning(f"{len(failed)} Drive files failed to download, retrying them on the next run")
+    return [d.text for d in documents if d is not None], sync['page_token']
+
+
+def discord_texts(documents_path: str) -> List[str]:
+    """Texts of the question/answer pairs the Discord ingestion puts in the index"""
+    if not os.path.exists(documents_path):
+        return []
+    with open(documents_path) as f:
+        return [d.text for d in documents_from_discord(json.load(f))]
+
+
+async def precompute(folder_id: str = DEFAULT_FOLDER_ID, documents_path: str = DEFAULT_DISCORD_OUTPUT, drive: bool = True, discord: bool = True) -> dict:
+    started = time.perf_counter()
+
+    texts = {"drive": [], "discord": []}
+    page_token = None
+    if drive:
+        texts["drive"], page_token = await drive_texts(folder_id)
+    if discord:
+        texts["discord"] = await run_blocking(discord_texts, documents_path)
+
+    unique = set(texts["drive"]) | set(texts["discord"])
+    stored_before = await run_blocking(len, embedding_service.store)
+    await run_blocking(embedding_service.embed, sorted(unique), persist=True)
+    stored = await run_blocking(len, embedding_service.store)
+
+    # Only now the Drive changes are in the store, a failed run reads them again
+    if page_token:
+        await run_blocking(commit_folder_changes, folder_id, page_token, DRIVE_STATE_DIR)
+
+    return {
+        "result": "success",
+        "drive_documents": len(texts["drive"]),
+        "discord_documents": len(texts["discord"]),
+        "embedded": stored - stored_before,
+        "already_stored": len(unique) - (stored - stored_before),
+        "stored": stored,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+@function.defn()
+@instrument
+async def precompute_embeddings(input: dict) -> dict:
+    """
+    Embed the Drive answers and the processed Discord threads into the
+    embedding store of the worker's host.
+
+    Input (all optional): folder_id, documents_path, drive and discord (set
+    either to false to skip that source).
+    """
+    input = input or {}
+    try:
+        result = await precompute(
+            folder_id=input.get("folder_id", DEFAULT_FOLDER_ID),
+            documents_path=input.get("documents_path", DEFAULT_DISCORD_OUTPUT),
+            drive=input.get("drive", True),
+            discord=input.get("discord", True),
+        )
+    except FunctionFailure:
+        raise
+    except (OSError, ValueError) as e:
+        raise FunctionFailure(f"Failed to precompute embeddings: {str(e)}", non_retryable=True) from e
+
+    log.info(f"Embedding precompute: {result}")
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fill this host's embedding store from Drive and the processed Discord threads")
+    parser.add_argument("--drive-folder", default=DEFAULT_FOLDER_ID, help="Drive folder with submitted answers")
+    parser.add_argument("--discord", default=DEFAULT_DISCORD_OUTPUT, help="generate_drive_documents() output JSON")
+    parser.add_argument("--skip-drive", action="store_true")
+    parser.add_argument("--skip-discord", action="store_true")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(precompute(args.drive_folder, args.discord, not args.skip_drive, not args.skip_discord)), indent=2))
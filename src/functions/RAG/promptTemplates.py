@@ -0,0 +1,165 @@
+from dataclasses import dataclass
+from typing import Dict
+import os
+
+from src.functions.RAG.contextBudget import count_tokens
+from src.utils.lazy import lazy_import
+
+ChatMessage = lazy_import("llama_index.core.llms", "ChatMessage")
+MessageRole = lazy_import("llama_index.core.llms", "MessageRole")
+ChatPromptTemplate = lazy_import("llama_index.core.prompts", "ChatPromptTemplate")
+
+
+# Prompts sent to Anthropic by the RAG functions. Every prompt is split into
+#
+#   prefix   the instructions, the same for every request, sent as the system prompt
+#   context  the retrieved sources
+#   suffix   the question (and the answer to check), different every time
+#
+# and sent in that order. A cache breakpoint costs a 25% premium on the
+# tokens before it when they are written and saves 90% only when a later
+# request reads them back, so breakpoints only go on parts that repeat:
+#
+#   - after the prefix, if the prefix alone is long enough for Anthropic to
+#     cache it (MIN_CACHEABLE_TOKENS; the current prefixes are well below)
+#   - after the context, when the caller knows the same sources come again:
+#     they came from the retrieval cache, or a batch answers several
+#     questions from one retrieval
+#
+# A unique question over freshly retrieved sources gets no breakpoint at all.
+#
+# Bump a prompt's version whenever its text changes, the version is logged
+# and returned with the token counts.
+
+PROMPT_CACHING = os.getenv("ANTHROPIC_PROMPT_CACHING", "1") != "0"
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Anthropic doesn't cache prefixes shorter than this, 1024 tokens for Sonnet
+# and Opus, 2048 for Haiku
+MIN_CACHEABLE_TOKENS = int(os.getenv("ANTHROPIC_MIN_CACHEABLE_TOKENS", "1024"))
+
+
+def _message(role, content: str, cache: bool = False):
+    additional_kwargs = {"cache_control": CACHE_CONTROL} if cache and PROMPT_CACHING else {}
+    return ChatMessage(role=role, content=content, additional_kwargs=additional_kwargs)
+
+
+@dataclass(frozen=True)
+class CachedPrompt:
+    name: str
+    version: int
+    prefix: str
+    context: str
+    suffix: str
+
+    @property
+    def prefix_cacheable(self) -> bool:
+        return count_tokens(self.prefix) >= MIN_CACHEABLE_TOKENS
+
+    def _messages(self, context: str, suffix: str, cache_context: bool) -> list:
+        return [
+            _message(MessageRole.SYSTEM, self.prefix, cache=self.prefix_cacheable),
+            _message(MessageRole.USER, context, cache=cache_context),
+            ChatMessage(role=MessageRole.USER, content=suffix),
+        ]
+
+    def messages(self, cache_context: bool = False, **values) -> list:
+        """
+        Chat messages with the placeholders of context and suffix filled in.
+
+        cache_context puts a breakpoint after the context, only pass it when
+        the same sources are sent again soon.
+        """
+        context = self.context.format(**values)
+        cache_context = cache_context and count_tokens(self.prefix) + count_tokens(context) >= MIN_CACHEABLE_TOKENS
+        return self._messages(context, self.suffix.format(**values), cache_context)
+
+    def chat_template(self, cache_context: bool = False):
+        """The prompt as a ChatPromptTemplate, for the response synthesizer"""
+        return ChatPromptTemplate(message_templates=self._messages(self.context, self.suffix, cache_context))
+
+    def token_counts(self, cache_context: bool = False, **values) -> Dict[str, object]:
+        """
+        Estimated tokens per part (see contextBudget.count_tokens), with the
+        placeholders filled in when values are given.
+
+        cacheable_tokens is what sits before the last cache breakpoint of the
+        request and is long enough to be cached: written to the cache by this
+        request or read from it if an earlier one wrote it. What was actually
+        read is in the cache_read_tokens of the LLM telemetry.
+        """
+        prefix = count_tokens(self.prefix)
+        context = count_tokens(self.context.format(**values) if values else self.context)
+        suffix = count_tokens(self.suffix.format(**values) if values else self.suffix)
+
+        cacheable = 0
+        if PROMPT_CACHING:
+            if cache_context and prefix + context >= MIN_CACHEABLE_TOKENS:
+                cacheable = prefix + context
+            elif prefix >= MIN_CACHEABLE_TOKENS:
+                cacheable = prefix
+
+        return {
+            "name": self.name,
+            "version": self.version,
+            "prefix_tokens": prefix,
+            "context_tokens": context,
+            "suffix_tokens": suffix,
+            "cache_context": cache_context,
+            "cacheable_tokens": cacheable,
+        }
+
+
+RAG_ANSWER = CachedPrompt(
+    name="rag_answer",
+    version=2,
+    prefix="""You are a helpful coding assistant. You answer questions from users using relevant documentation and discussions from the knowledge base.
+
+Provide a detailed and accurate response that:
+1. Directly addresses the user's coding question
+2. Includes relevant code examples when appropriate
+3. Explains the reasoning behind the solution
+4. References any best practices or important considerations
+5. Cites specific documentation or discussions that support the answer
+
+Format your response in a clear, structured way with:
+- A direct answer to the question
+- Code examples (if applicable)
+- Explanation of key concepts
+- Any important caveats or considerations
+- References to supporting documentation
+
+Base your response only on the most relevant information from the knowledge base below, not on prior knowledge.""",
+    context="""Knowledge base:
+---------------------
+{context_str}
+---------------------""",
+    suffix="User Question: {query_str}",
+)
+
+
+RAG_VALIDATION = CachedPrompt(
+    name="rag_validation",
+    version=2,
+    prefix="""You are a helpful coding assistant. You get a question from a user and a response that is about to be given to the user.
+Evaluate whether the response correctly answers the user's question, using only the sources as ground truth.
+
+Reply with only a JSON object, no other text:
+{"valid": true or false, "reason": "<one sentence explaining the verdict>"}
+
+Use "valid": false if the response doesn't address the question, contradicts the sources,
+or makes claims the sources don't support.""",
+    context="""Sources:
+{sources}""",
+    suffix="""User Question: {query}
+
+Response: {response}""",
+)
+
+
+PROMPTS = {prompt.name: prompt for prompt in (RAG_ANSWER, RAG_VALIDATION)}
+
+
+def prompt_report() -> Dict[str, dict]:
+    """Version and template token counts of every prompt, without any request values"""
+    return {name: prompt.token_counts() for name, prompt in PROMPTS.items()}
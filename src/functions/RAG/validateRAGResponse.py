@@ -1,105 +1,107 @@
 from restack_ai.function import function, FunctionFailure, log
-from llama_index.llms.anthropic import Anthropic
-from llama_index.indices.managed.llama_cloud import LlamaCloudIndex
-from llama_index.core import get_response_synthesizer
-from llama_index.core.query_engine import RetrieverQueryEngine
 from typing import Dict, List
+import json
 import os
+import re
+
+from src.functions.RAG.engineCache import get_engine, get_required_keys
+from src.functions.RAG.contextBudget import pack_context, DEFAULT_TOKEN_BUDGET
+from src.functions.RAG.llamaCloudRAG import retrieve_nodes
+from src.functions.RAG.promptTemplates import RAG_VALIDATION
+from src.utils.executor import run_blocking
+from src.utils.lazy import lazy_import
+from src.utils.resilience import call_provider, provider_failure
+from src.utils.telemetry import instrument
+
+QueryBundle = lazy_import("llama_index.core.schema", "QueryBundle")
+
+
+def parse_verdict(text: str) -> dict:
+    """
+    Pull the {"valid": ..., "reason": ...} verdict out of the model output.
+
+    Falls back to looking for a bare true/false if the model didn't return
+    clean JSON, and treats anything unreadable as not valid so the workflow
+    goes on to the other agents.
+    """
+    match = re.search(r"\{.*\}", text or "", re.DOTALL)
+    if match:
+        try:
+            verdict = json.loads(match.group(0))
+            return {
+                "valid": verdict.get("valid") is True or str(verdict.get("valid")).lower() == "true",
+                "reason": str(verdict.get("reason", "")),
+            }
+        except (json.JSONDecodeError, AttributeError):
+            pass
+
+    lowered = (text or "").lower()
+    if re.search(r"\bvalid\W+true\b", lowered) or lowered.strip().startswith("true"):
+        return {"valid": True, "reason": (text or "").strip()}
+    return {"valid": False, "reason": (text or "").strip()}
+
 
 @function.defn()
+@instrument
 async def validate_RAG_response(input: dict) -> dict:
     # Validate input and API keys
     if not input:
         raise FunctionFailure("Invalid input: input dictionary cannot be empty", non_retryable=True)
-    
-    required_keys = {
-        "LLAMA_CLOUD_API_KEY": os.getenv("LLAMA_CLOUD_API_KEY"),
-        "ANTHROPIC_API_KEY": os.getenv("ANTHROPIC_API_KEY"),
 
-    }
-    
+    required_keys = get_required_keys()
+
     missing_keys = [k for k, v in required_keys.items() if not v]
     if missing_keys:
         raise FunctionFailure(f"Missing required API keys: {', '.join(missing_keys)}", non_retryable=True)
 
     try:
-        # Initialize LlamaCloud Index
-
-        index = LlamaCloudIndex(
-            name="Trieoverflow General Index for All Frameworks", 
-            project_name="Trieoverflow",
-            organization_id="37ad34df-e1d9-481e-9007-9b194cf46e13",
-            api_key=required_keys["LLAMA_CLOUD_API_KEY"]
-        )
-
-        # Initialize LLMs
-        llm_anthropic = Anthropic(
-            model="claude-3-5-sonnet-20240620",
-            api_key=required_keys["ANTHROPIC_API_KEY"],
-            timeout=60
-        )
-
-       
-
-        # Setup retriever and query engine
-        response_synthesizer = get_response_synthesizer(llm=llm_anthropic)
-        retriever = index.as_retriever(
-            dense_similarity_top_k=5,
-            sparse_similarity_top_k=5,
-            alpha=0.5,
-            enable_reranking=True,
-            rerank_top_n=5
-        )
-
-        query_engine = RetrieverQueryEngine(
-            retriever=retriever,
-            response_synthesizer=response_synthesizer
-        )
+        # Reuse the pooled index / LLM / query engine instead of building them per call,
+        # building it on a cold cache is blocking so keep it off the event loop
+        engine = await run_blocking(get_engine, required_keys, fusion=input.get("fusion"))
 
         # Extract input parameters
         query = input.get("query")
         rag_response = input.get("response")
-       
+        sources = input.get("sources")
+        token_budget = input.get("token_budget", DEFAULT_TOKEN_BUDGET)
 
-        # Construct the query prompt
-        query_prompt = f"""
-        You are a helpful coding assistant. I have a question from a user that needs to be answered using relevant documentation and discussions.
+        # Check against the sources the RAG answer was built from, only retrieve
+        # again if the caller didn't pass them along
+        fusion_timings = None
+        if sources is None:
+            nodes, fusion_timings, _ = await retrieve_nodes(engine, QueryBundle(query))
+            sources = [node.text for node in nodes]
 
-        Below there is a response that I intend to give to the user, I want you to evaluate and tell me if the resposne answers the users query
+        # Rank and cut the sources so the prompt stays inside the token budget
+        packed = pack_context(query, rag_response, sources, budget=token_budget)
 
-        User Question: {query}
-
-        Response: {rag_response}
+        sources_block = "\n\n".join(
+            f"[Source {i + 1}]\n{source}" for i, source in enumerate(packed.sources)
+        )
 
-        Please provide a detailed and accurate response that:
-        1. Directly addresses the user's coding question
-        2. Includes relevant code examples when appropriate
-        3. Explains the reasoning behind the solution
-        4. References any best practices or important considerations
-        5. Cites specific documentation or discussions that support the answer
+        # Instructions first and the sources next, see promptTemplates.py. Every
+        # answer is validated once, so the sources don't get a cache breakpoint
+        messages = RAG_VALIDATION.messages(query=packed.query, response=packed.response, sources=sources_block)
+        prompt_tokens = RAG_VALIDATION.token_counts(query=packed.query, response=packed.response, sources=sources_block)
 
-        Format your response in a clear, structured way with:
-        - A direct answer to the question
-        - Code examples (if applicable)
-        - Explanation of key concepts
-        - Any important caveats or considerations
-        - References to supporting documentation
+        # Execute query
+        completion = await call_provider("anthropic", lambda: engine.llm.achat(messages))
+        verdict = parse_verdict(completion.message.content)
 
-        Base your response only on the most relevant information from the knowledge base.
-        """
+        log.info(f"RAG validation verdict: {verdict['valid']}, prompt tokens {prompt_tokens}")
 
-        # Execute query
-        response = query_engine.query(query_prompt)
-        
         return {
-            "response": response.response,
-            "sources": [node.text for node in response.source_nodes],
+            "valid": verdict["valid"],
+            "reason": verdict["reason"],
+            "response": completion.message.content,
             "metadata": {
-                "query_timestamp": response.metadata.get("timestamp"),
-                "total_sources": len(response.source_nodes)
+                **packed.metadata(),
+                "prompt_tokens": prompt_tokens,
+                "total_sources": len(sources),
+                "fusion_timings": fusion_timings,
             }
         }
 
     except Exception as e:
-        log.error(f"Error in llama_cloud_rag: {str(e)}")
-        raise FunctionFailure(f"Failed to process RAG query: {str(e)}", non_retryable=True) from e
\ No newline at end of file
+        log.error(f"Error in validate_RAG_response: {str(e)}")
+        raise provider_failure("Failed to validate RAG response", e) from e
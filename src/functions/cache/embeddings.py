@@ -0,0 +1,246 @@
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import fcntl
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from src.utils.telemetry import record_embeddings
+from src.utils.text import normalize_query
+
+
+# Local text embeddings shared by the semantic cache, the fusion stage and
+# the local index.
+#
+#     vectors = embedding_service.embed(texts)    # (len(texts), EMBEDDING_DIM) float32
+#
+# The model is a hashed bag of words + character trigrams, cheap but still
+# about a millisecond for a long document. EmbeddingService embeds a list of
+# texts in batches and reads known vectors from a content hash keyed store on
+# disk. Only the precompute job (see src/functions/RAG/precomputeEmbeddings.py)
+# and the ingestion write to the store, so a document is embedded once per
+# host and queries never take the store's lock.
+
+EMBEDDING_DIM = 512
+# Part of the store path, bump it when embed_batch changes its output
+MODEL_NAME = "hashed-v1"
+
+STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", os.path.join(os.getcwd(), ".cache", "embeddings"))
+# Texts per call to the embedding model
+DEFAULT_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+
+
+def _features(text: str) -> List[str]:
+    normalized = normalize_query(text)
+    padded = f" {normalized} "
+    return normalized.split() + [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+@lru_cache(maxsize=1 << 16)
+def _feature_slot(feature: str, dim: int) -> Tuple[int, float]:
+    # Words and trigrams repeat a lot between texts, hashing each once saves most of the work
+    digest = hashlib.md5(feature.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "little") % dim, (1.0 if digest[4] & 1 else -1.0)
+
+
+def embed_batch(texts: Sequence[str], dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """
+    Local hashed bag of words + character trigram embeddings.
+
+    Cheap enough to run on every query and needs no API key. It only has to
+    catch near identical rewordings of the same question ("How do I deploy
+    on the cloud?" vs "how do i deploy on the cloud"), not general semantic
+    similarity.
+
+    Args:
+        texts (Sequence[str]): Texts to embed
+        dim (int): Size of the vectors
+
+    Returns:
+        np.ndarray: (len(texts), dim) float32 matrix of L2 normalized rows
+    """
+    rows, buckets, signs = [], [], []
+    for row, text in enumerate(texts):
+        for feature in _features(text):
+            bucket, sign = _feature_slot(feature, dim)
+            rows.append(row)
+            buckets.append(bucket)
+            signs.append(sign)
+
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    np.add.at(matrix, (np.asarray(rows, dtype=np.int64), np.asarray(buckets, dtype=np.int64)), np.asarray(signs, dtype=np.float32))
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+class EmbeddingStore:
+    """
+    Append only store of embedding vectors keyed by the content hash of their text.
+
+        keys.txt      one content hash per line, line i is the key of row i
+        vectors.f32   float32 rows, read through a read only memory map
+        lock          taken exclusively by writers
+
+    Every worker process on a host shares the files. Vectors are written
+    before their keys, so a row only becomes visible once it is complete, and
+    a writer first cuts off whatever a crashed writer left half written.
+    """
+
+    def __init__(self, path: str, dim: int = EMBEDDING_DIM):
+        self.path = path
+        self.dim = dim
+        self._keys_path = os.path.join(path, "keys.txt")
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._lock_path = os.path.join(path, "lock")
+        self._rows: Dict[str, int] = {}
+        # Rows and bytes of keys.txt read so far
+        self._count = 0
+        self._keys_offset = 0
+        self._matrix: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    @property
+    def _row_bytes(self) -> int:
+        return self.dim * 4
+
+    def _refresh(self):
+        """Pick up the rows other processes appended since the last refresh"""
+        try:
+            size = os.path.getsize(self._keys_path)
+        except FileNotFoundError:
+            return
+        if size <= self._keys_offset:
+            return
+
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            data = f.read(size - self._keys_offset)
+
+        # A line without its newline is still being written (or was left by a crash)
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.decode("ascii").splitlines():
+            self._rows.setdefault(line, self._count)
+            self._count += 1
+        self._keys_offset += len(complete)
+
+        if self._count and (self._matrix is None or self._matrix.shape[0] < self._count):
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(self._count, self.dim))
+
+    def get(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        """Stored vectors for the keys that have one"""
+        with self._lock:
+            if any(key not in self._rows for key in keys):
+                self._refresh()
+            rows = {key: self._rows[key] for key in keys if key in self._rows}
+            if not rows:
+                return {}
+            # Copy out of the map, it is replaced when the store grows
+            vectors = np.array(self._matrix[list(rows.values())])
+        return dict(zip(rows, vectors))
+
+    def put(self, keys: Sequence[str], vectors: np.ndarray) -> int:
+        """Append the vectors whose keys aren't stored yet, returns how many were added"""
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                new = {}
+                for key, vector in zip(keys, vectors):
+                    if key not in self._rows and key not in new:
+                        new[key] = vector
+                if not new:
+                    return 0
+
+                # Drop a partial row or key line left by a writer that died
+                for path, length in ((self._vectors_path, self._count * self._row_bytes), (self._keys_path, self._keys_offset)):
+                    if os.path.exists(path) and os.path.getsize(path) > length:
+                        os.truncate(path, length)
+
+                with open(self._vectors_path, "ab") as f:
+                    f.write(np.asarray(list(new.values()), dtype=np.float32).tobytes())
+                with open(self._keys_path, "ab") as f:
+                    f.write("".join(f"{key}\n" for key in new).encode("ascii"))
+
+                self._refresh()
+                return len(new)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._rows)
+
+
+class EmbeddingService:
+    """
+    Embeds texts in batches and reuses the vectors in the store.
+
+    Only the precompute job and the ingestion pass persist=True, query time
+    callers just read, so a query never waits for the store's lock or a disk write.
+    """
+
+    def __init__(
+        self,
+        store: Optional[EmbeddingStore] = None,
+        embed: Callable[[Sequence[str]], np.ndarray] = embed_batch,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        dim: int = EMBEDDING_DIM,
+    ):
+        self.store = store
+        self.embed_batch = embed
+        self.batch_size = batch_size
+        self.dim = dim
+
+    def embed(self, texts: Sequence[str], persist: bool = False) -> np.ndarray:
+        """
+        Args:
+            texts (Sequence[str]): Texts to embed, duplicates are embedded once
+            persist (bool): Add the newly embedded vectors to the store
+
+        Returns:
+            np.ndarray: (len(texts), dim) float32 matrix, rows in the order of texts
+        """
+        keys = [content_hash(text) for text in texts]
+        unique = dict(zip(keys, texts))
+
+        vectors = {}
+        store_errors = 0
+        if self.store is not None:
+            try:
+                vectors = self.store.get(list(unique))
+            except OSError:
+                # A broken store only costs the embedding time
+                store_errors += 1
+
+        missing = [key for key in unique if key not in vectors]
+        for start in range(0, len(missing), self.batch_size):
+            chunk = missing[start:start + self.batch_size]
+            computed = self.embed_batch([unique[key] for key in chunk])
+            vectors.update(zip(chunk, computed))
+            if persist and self.store is not None:
+                try:
+                    self.store.put(chunk, computed)
+                except OSError:
+                    store_errors += 1
+
+        record_embeddings(len(unique) - len(missing), len(missing), store_errors)
+
+        if not keys:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.asarray([vectors[key] for key in keys], dtype=np.float32)
+
+    def embed_one(self, text: str, persist: bool = False) -> np.ndarray:
+        return self.embed([text], persist=persist)[0]
+
+
+embedding_service = EmbeddingService(EmbeddingStore(os.path.join(STORE_DIR, f"{MODEL_NAME}-{EMBEDDING_DIM}")))
+
@@ -0,0 +1,282 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from src.utils.text import normalize_query
+from src.utils.lazy import lazy_import
+from src.utils.telemetry import record_retrieval_cache
+
+NodeWithScore = lazy_import("llama_index.core.schema", "NodeWithScore")
+TextNode = lazy_import("llama_index.core.schema", "TextNode")
+
+
+# Cache of retrieval results, so asking the same thing twice doesn't go to
+# LlamaCloud (or the local index) twice.
+#
+# Keys are the normalized retrieval text, the engine's retriever settings
+# (index, retriever params, fusion settings) and the index version stamp.
+# Ingestion bumps the stamp of the index, which makes every earlier entry
+# unreachable in every worker process at once: the stamp lives in the SQLite
+# file next to the entries and is read on every lookup.
+#
+# Two tiers: a small per process LRU of recent results and the SQLite file
+# shared by all workers on the host. Documents uploaded to Drive only show up
+# in LlamaCloud after its next sync of the folder, so the upload schedules the
+# bump for after the sync delay instead (invalidate with delay_seconds). The
+# TTL bounds how long a result stays around if the sync takes longer.
+
+CACHE_PATH = os.getenv("RETRIEVAL_CACHE_PATH", os.path.join(os.getcwd(), ".cache", "retrieval_cache.sqlite3"))
+ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "1") != "0"
+TTL_SECONDS = int(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "3600"))
+MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "5000"))
+MEMORY_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MEMORY_ENTRIES", "256"))
+
+
+def serialize_nodes(nodes: list) -> str:
+    """NodeWithScore list as JSON, without embeddings"""
+    records = []
+    for node in nodes:
+        data = node.node.to_dict()
+        data.pop("embedding", None)
+        records.append({"node": data, "score": node.score})
+    return json.dumps(records, default=str)
+
+
+def deserialize_nodes(data: str) -> list:
+    return [
+        NodeWithScore(node=TextNode.from_dict(record["node"]), score=record["score"])
+        for record in json.loads(data)
+    ]
+
+
+@dataclass
+class RetrievalCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evicted: int = 0
+    invalidations: int = 0
+
+    def to_dict(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "stores": self.stores,
+            "evicted": self.evicted,
+            "invalidations": self.invalidations,
+        }
+
+
+class RetrievalCache:
+    """
+    Retrieval results keyed by query, retriever settings and index version.
+
+    Both tiers hold the serialized nodes, a hit builds fresh node objects so
+    callers can't change what another request gets back.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        ttl_seconds: int = TTL_SECONDS,
+        max_entries: int = MAX_ENTRIES,
+        memory_entries: int = MEMORY_ENTRIES,
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        # key -> (index, created_at, serialized nodes)
+        self._memory: "OrderedDict[str, Tuple[str, float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.stats = RetrievalCacheStats()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    index_name TEXT NOT NULL,
+                    nodes TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS index_versions (index_name TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS scheduled_invalidations (index_name TEXT NOT NULL, due_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _version(self, conn: sqlite3.Connection, index_name: str) -> int:
+        row = conn.execute("SELECT version FROM index_versions WHERE index_name = ?", (index_name,)).fetchone()
+        return row[0] if row else 0
+
+    def _bump(self, conn: sqlite3.Connection, index_name: str) -> int:
+        conn.execute(
+            "INSERT INTO index_versions (index_name, version) VALUES (?, 1) "
+            "ON CONFLICT(index_name) DO UPDATE SET version = version + 1",
+            (index_name,),
+        )
+        # The old entries can't be reached anymore, free the space right away
+        conn.execute("DELETE FROM entries WHERE index_name = ?", (index_name,))
+        for key in [k for k, entry in self._memory.items() if entry[0] == index_name]:
+            del self._memory[key]
+        self.stats.invalidations += 1
+        return self._version(conn, index_name)
+
+    def _apply_scheduled(self, conn: sqlite3.Connection, index_name: str, now: float):
+        """Bump the version once for every scheduled invalidation of the index that is due"""
+        # Only write when something is due: a DELETE opens a write transaction
+        # even if it matches nothing, and an uncommitted one keeps the file
+        # locked for every other worker until this connection writes again
+        due = conn.execute(
+            "SELECT 1 FROM scheduled_invalidations WHERE index_name = ? AND due_at <= ? LIMIT 1", (index_name, now)
+        ).fetchone()
+        if due is None:
+            return
+        conn.execute("DELETE FROM scheduled_invalidations WHERE index_name = ? AND due_at <= ?", (index_name, now))
+        self._bump(conn, index_name)
+        conn.commit()
+
+    def _key(self, conn: sqlite3.Connection, index_name: str, settings: str, query: str) -> str:
+        parts = [index_name, self._version(conn, index_name), settings, normalize_query(query)]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def lookup(self, index_name: str, settings: str, query: str) -> Tuple[Optional[list], str]:
+        """
+        Cached nodes for a retrieval.
+
+        Args:
+            index_name (str): Index the retriever reads from, versioned by ingestion
+            settings (str): Retriever params and fusion settings, see EngineEntry.retrieval_settings
+            query (str): The text that is retrieved for
+
+        Returns:
+            tuple: NodeWithScore list (None on a miss) and the key to store the
+            result of the retrieval under. The key carries the index version
+            seen here, so a result fetched while an ingestion ran is never
+            stored as the result for the new version
+        """
+        now = time.time()
+
+        with self._lock:
+            conn = self._connect()
+            self._apply_scheduled(conn, index_name, now)
+            key = self._key(conn, index_name, settings, query)
+
+            entry = self._memory.get(key)
+            if entry is not None and entry[1] >= now - self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                data, tier = entry[2], "memory"
+            else:
+                row = conn.execute(
+                    "SELECT nodes, created_at FROM entries WHERE key = ? AND created_at >= ?",
+                    (key, now - self.ttl_seconds),
+                ).fetchone()
+                if row is None:
+                    self._memory.pop(key, None)
+                    self.stats.misses += 1
+                    data, tier = None, "miss"
+                else:
+                    conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                    conn.commit()
+                    self._remember(key, index_name, row[1], row[0])
+                    self.stats.disk_hits += 1
+                    data, tier = row[0], "disk"
+
+        record_retrieval_cache(tier)
+        return (deserialize_nodes(data) if data is not None else None), key
+
+    def _remember(self, key: str, index_name: str, created_at: float, data: str):
+        self._memory[key] = (index_name, created_at, data)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def store(self, key: str, index_name: str, nodes: list):
+        """Cache the nodes under a key returned by lookup"""
+        data = serialize_nodes(nodes)
+        now = time.time()
+
+        with self._lock:
+            conn = self._connect()
+            self._remember(key, index_name, now, data)
+
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, index_name, nodes, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, index_name, data, now, now),
+            )
+            conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl_seconds,))
+
+            # LRU eviction
+            count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    "DELETE FROM entries WHERE key IN "
+                    "(SELECT key FROM entries ORDER BY last_access ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self.stats.evicted += overflow
+            conn.commit()
+            self.stats.stores += 1
+
+    def invalidate(self, index_name: str, delay_seconds: float = 0) -> int:
+        """
+        Bump the index version so nothing cached for the index is served anymore.
+
+        Args:
+            index_name (str): Index that got new documents
+            delay_seconds (float): Bump the version this much later instead,
+                for documents the index only picks up on its next sync
+
+        Returns:
+            int: the new version, the current one for a delayed bump
+        """
+        with self._lock:
+            conn = self._connect()
+            if delay_seconds > 0:
+                conn.execute(
+                    "INSERT INTO scheduled_invalidations (index_name, due_at) VALUES (?, ?)",
+                    (index_name, time.time() + delay_seconds),
+                )
+                version = self._version(conn, index_name)
+            else:
+                version = self._bump(conn, index_name)
+            conn.commit()
+
+        return version
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM entries")
+            conn.commit()
+            self._memory.clear()
+
+
+retrieval_cache = RetrievalCache()
+
+
+def get_retrieval_cache_stats() -> Dict[str, float]:
+    return retrieval_cache.stats.to_dict()
@@ -0,0 +1,322 @@
+from restack_ai.function import function, FunctionFailure, log
+from typing import Callable, List, Optional, Tuple
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from src.utils.text import normalize_query
+from src.utils.executor import run_blocking
+from src.utils.lazy import lazy_import
+from src.utils.telemetry import instrument, record_semantic_cache
+
+genai = lazy_import("google.genai")
+
+
+# Answer cache for repeated questions.
+#
+# A hit needs the same normalized question (case, punctuation and whitespace
+# don't matter). The hashed lexical embedding in embeddings.py can't tell
+# "enable retries" from "disable retries", so it is never used here.
+# Paraphrases are matched when SEMANTIC_CACHE_EMBEDDING_MODEL names a Gemini
+# embedding model (e.g. text-embedding-004), under a strict threshold.
+# Lookups, hits and evictions are exported as the semantic_cache_total metric.
+
+# Settings, all of them can be overridden from the environment
+
+CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", os.path.join(os.getcwd(), ".cache", "semantic_cache.sqlite3"))
+# Empty for exact matches only
+EMBEDDING_MODEL = os.getenv("SEMANTIC_CACHE_EMBEDDING_MODEL", "")
+# Only used with an embedding model, see SemanticCache
+SIMILARITY_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Expired answers are kept this much longer for when every provider failed, a stale answer beats none
+STALE_SECONDS = int(os.getenv("SEMANTIC_CACHE_STALE_SECONDS", str(7 * 24 * 3600)))
+MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+
+
+def cache_key(query: str) -> str:
+    return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+
+class GeminiEmbedding:
+    """L2 normalized question embeddings from the Gemini API, needs GEMINI_API_KEY"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._client = None
+
+    def __call__(self, text: str) -> List[float]:
+        if self._client is None:
+            self._client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+        result = self._client.models.embed_content(model=self.model, contents=text)
+        vector = np.asarray(result.embeddings[0].values, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+
+class SemanticCache:
+    """
+    Answer cache keyed by the normalized question, stored in a local SQLite file.
+
+    With embed, a function returning an L2 normalized semantic embedding of a
+    text, a question without an exact entry is also answered from the most
+    similar cached question at or above threshold. The embeddings are kept
+    as float32 blobs tagged with embedding_model, so vectors of another model
+    are never compared, and scanned as one matrix, reloaded only after a write.
+
+    Entries are served for ttl_seconds, kept for stale lookups stale_seconds
+    longer, and the least recently used ones are evicted once there are more
+    than max_entries.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        threshold: float = SIMILARITY_THRESHOLD,
+        ttl_seconds: int = TTL_SECONDS,
+        stale_seconds: int = STALE_SECONDS,
+        max_entries: int = MAX_ENTRIES,
+        embed: Optional[Callable[[str], List[float]]] = None,
+        embedding_model: str = "",
+    ):
+        self.path = path
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self.embed = embed
+        self.embedding_model = embedding_model
+        self._lock = threading.Lock()
+        self._conn = None
+        # (writes counter, keys, created_at, matrix) of the entries with an embedding
+        self._vectors = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    query TEXT NOT NULL,
+                    embedding BLOB,
+                    embedding_model TEXT,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _bump_writes(self, conn: sqlite3.Connection):
+        # Every process compares it to the version of its embedding matrix
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES ('writes', 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1"
+        )
+
+    def _expire(self, conn: sqlite3.Connection, now: float):
+        cursor = conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds - self.stale_seconds,))
+        if cursor.rowcount:
+            record_semantic_cache("expired", cursor.rowcount)
+            self._bump_writes(conn)
+
+    def _embedding_matrix(self, conn: sqlite3.Connection) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        row = conn.execute("SELECT value FROM counters WHERE name = 'writes'").fetchone()
+        version = row[0] if row else 0
+        if self._vectors is None or self._vectors[0] != version:
+            rows = conn.execute(
+                "SELECT key, created_at, embedding FROM answers WHERE embedding IS NOT NULL AND embedding_model = ?",
+                (self.embedding_model,),
+            ).fetchall()
+            keys = [row[0] for row in rows]
+            created_at = np.asarray([row[1] for row in rows], dtype=np.float64)
+            matrix = np.frombuffer(b"".join(row[2] for row in rows), dtype=np.float32).reshape(len(rows), -1) if rows else np.zeros((0, 0), dtype=np.float32)
+            self._vectors = (version, keys, created_at, matrix)
+        return self._vectors[1:]
+
+    def _similar(self, conn: sqlite3.Connection, embedding: np.ndarray, threshold: float, oldest: float) -> List[Tuple[str, float]]:
+        """(key, similarity) of every entry at or above the threshold, most similar first"""
+        keys, created_at, matrix = self._embedding_matrix(conn)
+        if not keys or matrix.shape[1] != embedding.shape[0]:
+            return []
+        similarities = matrix @ embedding
+        matches = np.where((similarities >= threshold) & (created_at >= oldest))[0]
+        matches = matches[np.argsort(-similarities[matches])]
+        return [(keys[i], float(similarities[i])) for i in matches]
+
+    def _embed(self, query: str) -> np.ndarray:
+        return np.asarray(self.embed(query), dtype=np.float32)
+
+    def lookup(self, query: str, threshold: Optional[float] = None, stale: bool = False) -> Optional[dict]:
+        """
+        Find the cached answer for a query.
+
+        Args:
+            query (str): The user query
+            threshold (float, optional): Minimum similarity of a paraphrase, defaults to the cache's threshold
+            stale (bool): Also serve answers past the TTL that weren't dropped yet
+
+        Returns:
+            dict or None: cached query, response, similarity (1.0 for the same
+            question) and whether the answer is stale on a hit, None on a miss
+        """
+        key = cache_key(query)
+        now = time.time()
+        oldest = now - self.ttl_seconds - (self.stale_seconds if stale else 0)
+        select = "SELECT query, response, created_at FROM answers WHERE key = ? AND created_at >= ?"
+
+        with self._lock:
+            conn = self._connect()
+            self._expire(conn, now)
+            conn.commit()
+            row = conn.execute(select, (key, oldest)).fetchone()
+
+        similarity, outcome = 1.0, "exact_hit"
+        if row is None and self.embed is not None:
+            # Only embed when the exact entry is missing, the model is a remote call
+            embedding = self._embed(query)
+            with self._lock:
+                conn = self._connect()
+                matches = self._similar(conn, embedding, self.threshold if threshold is None else threshold, oldest)
+                if matches:
+                    key, similarity = matches[0]
+                    row = conn.execute(select, (key, oldest)).fetchone()
+                    outcome = "similar_hit"
+
+        if row is None:
+            record_semantic_cache("miss")
+            return None
+
+        cached_query, response, created_at = row
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE answers SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+        record_semantic_cache(outcome)
+
+        return {
+            "query": cached_query,
+            "response": json.loads(response),
+            "similarity": similarity,
+            "stale": created_at < now - self.ttl_seconds,
+        }
+
+    def store(self, query: str, response: dict):
+        key = cache_key(query)
+        embedding = None
+        if self.embed is not None:
+            try:
+                embedding = self._embed(query).tobytes()
+            except Exception as e:
+                # Still served for the exact question
+                log.warning(f"Failed to embed '{query}' for the semantic cache: {str(e)}")
+        now = time.time()
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, query, embedding, embedding_model, response, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, query, embedding, self.embedding_model if embedding else None, json.dumps(response), now, now),
+            )
+
+            # LRU eviction
+            count = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    "DELETE FROM answers WHERE key IN "
+                    "(SELECT key FROM answers ORDER BY last_access ASC LIMIT ?)",
+                    (overflow,),
+                )
+                record_semantic_cache("evicted", overflow)
+            self._bump_writes(conn)
+            conn.commit()
+        record_semantic_cache("stored")
+
+    def invalidate(self, query: str) -> int:
+        """Drop every entry that would have been served for the query"""
+        embedding = self._embed(query) if self.embed is not None else None
+
+        with self._lock:
+            conn = self._connect()
+            keys = {cache_key(query)}
+            if embedding is not None:
+                keys.update(key for key, _ in self._similar(conn, embedding, self.threshold, 0.0))
+            cursor = conn.executemany("DELETE FROM answers WHERE key = ?", [(k,) for k in keys])
+            removed = cursor.rowcount
+            if removed:
+                self._bump_writes(conn)
+            conn.commit()
+
+        if removed:
+            record_semantic_cache("invalidated", removed)
+        return removed
+
+
+semantic_cache = SemanticCache(
+    embed=GeminiEmbedding(EMBEDDING_MODEL) if EMBEDDING_MODEL else None,
+    embedding_model=EMBEDDING_MODEL,
+)
+
+
+@function.defn()
+@instrument
+async def lookup_semantic_cache(input: dict) -> dict:
+    if not input or not input.get("query"):
+        raise FunctionFailure("Invalid input: query is required", non_retryable=True)
+
+    try:
+        hit = await run_blocking(semantic_cache.lookup, input["query"], input.get("threshold"), input.get("stale", False))
+        if hit is None:
+            return {"hit": False}
+
+        log.info(f"Semantic cache hit ({hit['similarity']:.3f}{', stale' if hit['stale'] else ''}) for: {input['query']}")
+        return {"hit": True, **hit}
+
+    except Exception as e:
+        # A broken cache should never fail the query, just go to the agents
+        log.error(f"Error in lookup_semantic_cache: {str(e)}")
+        return {"hit": False}
+
+
+@function.defn()
+@instrument
+async def store_semantic_cache(input: dict) -> dict:
+    if not input or not input.get("query") or "response" not in input:
+        raise FunctionFailure("Invalid input: query and response are required", non_retryable=True)
+
+    try:
+        await run_blocking(semantic_cache.store, input["query"], input["response"])
+        return {"result": "success"}
+
+    except Exception as e:
+        log.error(f"Error in store_semantic_cache: {str(e)}")
+        return {"result": "failed", "error": str(e)}
+
+
+@function.defn()
+@instrument
+async def invalidate_semantic_cache(input: dict) -> dict:
+    if not input or not input.get("query"):
+        raise FunctionFailure("Invalid input: query is required", non_retryable=True)
+
+    try:
+        removed = await run_blocking(semantic_cache.invalidate, input["query"])
+        log.info(f"Invalidated {removed} semantic cache entries for: {input['query']}")
+        return {"result": "success", "invalidated": removed}
+
+    except Exception as e:
+        log.error(f"Error in invalidate_semantic_cache: {str(e)}")
+        raise FunctionFailure(f"Failed to invalidate semantic cache: {str(e)}", non_retryable=True) from e
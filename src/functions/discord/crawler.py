@@ -0,0 +1,314 @@
+__all__ = ['DiscordCrawler', 'CrawlResult']
+
+from typing import Callable, Dict, List, Optional
+from dataclasses import dataclass, field
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+from restack_ai.function import log
+
+from src.functions.discord.messageProcessor import convert_js_to_python
+from src.utils.telemetry import record_http
+
+DISCORD_API_URL = 'https://discord.com/api/v9'
+PAGE_SIZE = 100
+
+# The checkpoint is saved every this many channel pages and thread fetches,
+# so a crawl that is stopped keeps what it already pulled
+CHECKPOINT_PAGES = 10
+CHECKPOINT_THREADS = 50
+
+# Where the checkpoint and the crawled messages are kept between runs
+DEFAULT_STATE_DIR = os.getenv("DISCORD_CRAWL_DIR", os.path.join(os.getcwd(), ".cache", "discord"))
+
+
+@dataclass
+class CrawlResult:
+    channel_id: str
+    messages: List[dict]
+    thread_messages: Dict[str, List[dict]]
+    new_messages: int = 0
+    new_thread_messages: int = 0
+    requests: int = 0
+    rate_limited: int = 0
+    seconds: float = 0.0
+
+    def stats(self) -> dict:
+        return {
+            'channel_id': self.channel_id,
+            'messages': len(self.messages),
+            'threads': len(self.thread_messages),
+            'new_messages': self.new_messages,
+            'new_thread_messages': self.new_thread_messages,
+            'requests': self.requests,
+            'rate_limited': self.rate_limited,
+            'seconds': round(self.seconds, 3),
+        }
+
+
+def _snowflake(message_id: Optional[str]) -> int:
+    return int(message_id) if message_id else 0
+
+
+class DiscordCrawler:
+    """
+    Crawl the full history of a Discord channel and its threads.
+
+    Pages forward through the channel with after cursors, fetches threads
+    concurrently under a bounded pool, waits out Discord rate limits and keeps
+    a checkpoint on disk so a rerun only pulls messages newer than the last
+    one. The checkpoint is saved while the crawl runs, a first crawl of a long
+    history that gets stopped continues from its last save.
+    """
+
+    def __init__(
+        self,
+        auth_token: str,
+        channel_id: str,
+        state_dir: str = DEFAULT_STATE_DIR,
+        max_concurrency: int = 5,
+        max_retries: int = 5,
+    ):
+        self.auth_token = auth_token
+        self.channel_id = channel_id
+        self.state_dir = state_dir
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+        self.checkpoint_path = os.path.join(state_dir, f"{channel_id}.checkpoint.json")
+        self.store_path = os.path.join(state_dir, f"{channel_id}.messages.json")
+
+        self._semaphore = None
+        self._requests = 0
+        self._rate_limited = 0
+
+    # -- state ----------------------------------------------------------------
+
+    def load_checkpoint(self) -> dict:
+        if not os.path.exists(self.checkpoint_path):
+            return {'last_message_id': None, 'threads': {}}
+        with open(self.checkpoint_path) as f:
+            return json.load(f)
+
+    def load_store(self) -> dict:
+        if not os.path.exists(self.store_path):
+            return {'messages': {}, 'threads': {}}
+        with open(self.store_path) as f:
+            return json.load(f)
+
+    def _save(self, checkpoint: dict, store: dict):
+        os.makedirs(self.state_dir, exist_ok=True)
+
+        # Write the messages first, a checkpoint without its messages would skip them on the next run
+        for path, data in ((self.store_path, store), (self.checkpoint_path, checkpoint)):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+
+    # -- http -----------------------------------------------------------------
+
+    async def _get(self, session: aiohttp.ClientSession, url: str, params: dict) -> List[dict]:
+        """GET with rate limit handling, returns [] when the resource can't be read"""
+        for attempt in range(self.max_retries):
+            async with self._semaphore:
+                self._requests += 1
+                started = time.perf_counter()
+                try:
+                    async with session.get(url, params=params) as response:
+                        status = response.status
+                        response_headers = response.headers
+                        payload = await response.json(content_type=None) if status in (200, 429) else None
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # Connection resets, timeouts and broken payloads are retried like a 5xx
+                    record_http("discord", "error", time.perf_counter() - started)
+                    log.warning(f"Request to {url} failed: {e}")
+                    status, response_headers = None, {}
+                else:
+                    record_http("discord", status, time.perf_counter() - started)
+
+                if status == 429:
+                    self._rate_limited += 1
+                    retry_after = float((payload or {}).get('retry_after') or response_headers.get('Retry-After', 1))
+                    await asyncio.sleep(retry_after)
+                    continue
+
+                # Wait for the bucket to refill before the next request instead of running into a 429,
+                # still holding the semaphore so the other fetches wait too
+                if response_headers.get('X-RateLimit-Remaining') == '0':
+                    await asyncio.sleep(float(response_headers.get('X-RateLimit-Reset-After', 0)))
+
+            if status == 200:
+                return convert_js_to_python(payload)
+
+            if status is None or status >= 500:
+                await asyncio.sleep(2 ** attempt)
+                continue
+
+            log.warning(f"Failed to fetch {url}: {status}")
+            return []
+
+        log.warning(f"Giving up on {url} after {self.max_retries} attempts")
+        return []
+
+    async def fetch_history(
+        self,
+        session: aiohttp.ClientSession,
+        channel_id: str,
+        after: Optional[str] = None,
+        on_page: Optional[Callable[[List[dict]], None]] = None,
+    ) -> List[dict]:
+        """
+        Fetch every message in a channel or thread, newest first.
+
+        Pages are read oldest first, so the crawl can checkpoint after any
+        page and continue from there.
+
+        Args:
+            channel_id (str): Channel or thread id
+            after (str, optional): Only fetch messages newer than this id, the whole history without it
+            on_page (callable, optional): Called with every page as it arrives
+
+        Returns:
+            List[dict]: the messages
+        """
+        url = f"{DISCORD_API_URL}/channels/{channel_id}/messages"
+        messages = []
+
+        cursor = after or '0'
+        while True:
+            page = await self._get(session, url, {'limit': PAGE_SIZE, 'after': cursor})
+            if not page:
+                break
+            messages.extend(page)
+            cursor = max(page, key=lambda m: _snowflake(m['id']))['id']
+            if on_page is not None:
+                on_page(page)
+            if len(page) < PAGE_SIZE:
+                break
+
+        messages.sort(key=lambda m: _snowflake(m['id']), reverse=True)
+        return messages
+
+    async def fetch_active_threads(self, session: aiohttp.ClientSession, checkpoint: dict) -> Optional[Dict[str, dict]]:
+        """
+        The channel's threads that are open right now, by id, from the guild's
+        active threads. None when Discord didn't say, the stored flags stay as they are.
+        """
+        guild_id = checkpoint.get('guild_id')
+        if not guild_id:
+            channel = await self._get(session, f"{DISCORD_API_URL}/channels/{self.channel_id}", {})
+            guild_id = channel.get('guild_id') if isinstance(channel, dict) else None
+            if not guild_id:
+                return None
+            checkpoint['guild_id'] = guild_id
+
+        listing = await self._get(session, f"{DISCORD_API_URL}/guilds/{guild_id}/threads/active", {})
+        if not isinstance(listing, dict) or 'threads' not in listing:
+            return None
+        return {thread['id']: thread for thread in listing['threads'] if thread.get('parent_id') == self.channel_id}
+
+    # -- crawl ----------------------------------------------------------------
+
+    async def crawl(self) -> CrawlResult:
+        """Pull everything new since the last checkpoint and return the full crawled channel"""
+        started = time.perf_counter()
+        checkpoint = self.load_checkpoint()
+        store = self.load_store()
+
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._requests = 0
+        self._rate_limited = 0
+
+        headers = {
+            'Authorization': self.auth_token,
+            'Content-Type': 'application/json'
+        }
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        pages = 0
+
+        def store_page(page: List[dict]):
+            nonlocal pages
+            for message in page:
+                store['messages'][message['id']] = message
+                # Threads started by new messages are fetched in full. They go
+                # into the checkpoint right away, a crawl stopped before they
+                # were fetched picks them up on the next run
+                thread = message.get('thread')
+                if thread:
+                    checkpoint['threads'].setdefault(thread['id'], {
+                        'last_message_id': None,
+                        'archived': thread.get('thread_metadata', {}).get('archived', False),
+                    })
+            checkpoint['last_message_id'] = max(store['messages'], key=_snowflake)
+
+            pages += 1
+            if pages % CHECKPOINT_PAGES == 0:
+                self._save(checkpoint, store)
+
+        new_thread_messages = 0
+
+        async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+            new_messages = await self.fetch_history(
+                session, self.channel_id, after=checkpoint.get('last_message_id'), on_page=store_page
+            )
+            # The parent message's copy of the thread is as old as the message, ask for the current state
+            active_threads = await self.fetch_active_threads(session, checkpoint)
+            self._save(checkpoint, store)
+
+            # Threads never fetched yet are fetched in full, known threads that
+            # are still open (or were until now, for their last messages) only
+            # need what was posted after their own checkpoint
+            thread_cursors = {}
+            for thread_id, state in checkpoint['threads'].items():
+                reopened = active_threads is not None and thread_id in active_threads
+                if state.get('last_message_id') is None or reopened or not state.get('archived'):
+                    thread_cursors[thread_id] = state.get('last_message_id')
+
+            thread_ids = list(thread_cursors)
+            for start in range(0, len(thread_ids), CHECKPOINT_THREADS):
+                batch = thread_ids[start:start + CHECKPOINT_THREADS]
+                fetched = await asyncio.gather(*[
+                    self.fetch_history(session, thread_id, after=thread_cursors[thread_id])
+                    for thread_id in batch
+                ])
+
+                for thread_id, thread_messages in zip(batch, fetched):
+                    known = store['threads'].setdefault(thread_id, {})
+                    for message in thread_messages:
+                        if message['id'] not in known:
+                            new_thread_messages += 1
+                        known[message['id']] = message
+
+                    if known:
+                        newest = max(known, key=_snowflake)
+                        if active_threads is not None:
+                            archived = thread_id not in active_threads
+                        else:
+                            thread_meta = store['messages'].get(thread_id, {}).get('thread', {})
+                            archived = checkpoint['threads'].get(thread_id, {}).get(
+                                'archived', thread_meta.get('thread_metadata', {}).get('archived', False)
+                            )
+                        checkpoint['threads'][thread_id] = {
+                            'last_message_id': newest,
+                            'archived': archived,
+                        }
+
+                self._save(checkpoint, store)
+
+        return CrawlResult(
+            channel_id=self.channel_id,
+            messages=sorted(store['messages'].values(), key=lambda m: _snowflake(m['id']), reverse=True),
+            thread_messages={
+                thread_id: sorted(messages.values(), key=lambda m: _snowflake(m['id']), reverse=True)
+                for thread_id, messages in store['threads'].items()
+            },
+            new_messages=len(new_messages),
+            new_thread_messages=new_thread_messages,
+            requests=self._requests,
+            rate_limited=self._rate_limited,
+            seconds=time.perf_counter() - started,
+        )
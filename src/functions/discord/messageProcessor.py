@@ -1,45 +1,67 @@
-__all__ = ['DiscordMessageProcessor', 'ThreadInfo']
+__all__ = ['DiscordMessageProcessor', 'ThreadInfo', 'MessageRecord']
 
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 import json
 import requests
-from dataclasses import dataclass, asdict
-from copy import deepcopy
+from dataclasses import dataclass
+
+_JS_LITERALS = {"null": None, "true": True, "false": False}
 
 def convert_js_to_python(data):
-    """Convert JavaScript format to Python format."""
-    if isinstance(data, dict):
-        return {key: convert_js_to_python(value) for key, value in data.items()}
-    elif isinstance(data, list):
-        return [convert_js_to_python(item) for item in data]
-    elif data == "null":
-        return None
-    elif data == "true":
-        return True
-    elif data == "false":
-        return False
-    else:
-        return data
+    """Convert JavaScript format to Python format.
+
+    Works in place on dicts and lists so a large payload isn't rebuilt,
+    and walks the structure with a stack instead of recursion.
+    """
+    if isinstance(data, str):
+        return _JS_LITERALS.get(data, data)
+
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            items = node.items()
+        elif isinstance(node, list):
+            items = enumerate(node)
+        else:
+            continue
+
+        for key, value in items:
+            if isinstance(value, str):
+                if value in _JS_LITERALS:
+                    node[key] = _JS_LITERALS[value]
+            elif isinstance(value, (dict, list)):
+                stack.append(value)
+
+    return data
 
 def fetch_thread_messages(thread_id: str, auth_token: str) -> List[dict]:
-    """Fetch all messages from a Discord thread."""
+    """Fetch all messages from a Discord thread, following the before cursor past the first page."""
     url = f'https://discord.com/api/v9/channels/{thread_id}/messages'
     headers = {
         'Authorization': auth_token,
         'Content-Type': 'application/json'
     }
-    
+
+    thread_messages = []
+    params = {'limit': 100}
+
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            thread_messages = response.json()
-            return convert_js_to_python(thread_messages)
-        else:
-            print(f"Failed to fetch thread messages: {response.status_code}")
-            return []
+        while True:
+            response = requests.get(url, headers=headers, params=params)
+            if response.status_code != 200:
+                print(f"Failed to fetch thread messages: {response.status_code}")
+                break
+
+            page = response.json()
+            thread_messages.extend(page)
+            if len(page) < params['limit']:
+                break
+            params['before'] = min(page, key=lambda m: int(m['id']))['id']
     except Exception as e:
         print(f"Error fetching thread messages: {e}")
-        return []
+
+    return convert_js_to_python(thread_messages)
 
 @dataclass
 class ThreadInfo:
@@ -47,22 +69,71 @@ class ThreadInfo:
     thread_metadata: dict
     messages: List[str]
 
+    def to_dict(self) -> dict:
+        # Same shape as dataclasses.asdict, without deep copying the metadata
+        return {
+            'thread_id': self.thread_id,
+            'thread_metadata': self.thread_metadata,
+            'messages': self.messages
+        }
+
+class MessageRecord:
+    """Compact processed message: the raw Discord payload plus its relationships.
+
+    The raw dict is shared, not copied. view() builds the dict used in the
+    documents once and every document that includes this message points at
+    that same object, so documents must be treated as read only.
+    """
+    __slots__ = ('id', 'data', 'references', 'children', '_view')
+
+    def __init__(self, data: dict):
+        self.id = data['id']
+        self.data = data
+        self.references: List[str] = []
+        self.children: List[str] = []
+        self._view = None
+
+    def __getitem__(self, key):
+        if key == 'references':
+            return self.references
+        if key == 'children':
+            return self.children
+        return self.data[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def view(self) -> dict:
+        if self._view is None:
+            self._view = {
+                **self.data,
+                'references': self.references,
+                'children': self.children
+            }
+        return self._view
+
 class DiscordMessageProcessor:
-    def __init__(self, messages: List[dict], auth_token: Optional[str] = None):
+    def __init__(
+        self,
+        messages: List[dict],
+        auth_token: Optional[str] = None,
+        thread_messages: Optional[Dict[str, List[dict]]] = None
+    ):
         self.auth_token = auth_token
         self.messages = convert_js_to_python(messages)  # Convert on initialization
-        self.processed_messages: Dict[str, dict] = {}
+        # Thread messages already fetched by the crawler, keyed by thread id
+        self.thread_messages = thread_messages or {}
+        self.processed_messages: Dict[str, MessageRecord] = {}
         self.threads: Dict[str, ThreadInfo] = {}
 
     def process_messages(self):
         """Process messages and organize them with their relationships."""
         # First pass: Create a map of all messages
         for message in self.messages:
-            self.processed_messages[message['id']] = {
-                **message,
-                'references': [],
-                'children': []
-            }
+            self.processed_messages[message['id']] = MessageRecord(message)
 
             # If message is part of a thread, organize it
             thread = message.get('thread')
@@ -73,16 +144,18 @@ class DiscordMessageProcessor:
                         thread_metadata=thread,
                         messages=[]
                     )
-                    # Fetch additional thread messages if auth token is provided
-                    if self.auth_token:
+                    # Use the crawled thread messages, or fetch them if auth token is provided
+                    if thread['id'] in self.thread_messages:
+                        thread_messages = self.thread_messages[thread['id']]
+                    elif self.auth_token:
                         thread_messages = fetch_thread_messages(thread['id'], self.auth_token)
+                    else:
+                        thread_messages = []
+
+                    if thread_messages:
                         for thread_msg in thread_messages:
                             if thread_msg['id'] not in self.processed_messages:
-                                self.processed_messages[thread_msg['id']] = {
-                                    **thread_msg,
-                                    'references': [],
-                                    'children': []
-                                }
+                                self.processed_messages[thread_msg['id']] = MessageRecord(thread_msg)
                                 self.threads[thread['id']].messages.append(thread_msg['id'])
                 
                 self.threads[thread['id']].messages.append(message['id'])
@@ -94,39 +167,43 @@ class DiscordMessageProcessor:
                 parent_id = message_reference.get('message_id')
                 parent_message = self.processed_messages.get(parent_id)
                 if parent_message:
-                    parent_message['children'].append(message['id'])
-                    message['references'].append(parent_id)
+                    parent_message.children.append(message.id)
+                    message.references.append(parent_id)
 
             referenced_message = message.get('referenced_message')
             if referenced_message:
-                message['references'].append(referenced_message['id'])
+                message.references.append(referenced_message['id'])
 
         return self
 
-    def build_message_document(self, message: dict) -> dict:
-        """Build a complete message document including references."""
-        doc = deepcopy(message)
+    def build_message_document(self, message: MessageRecord) -> dict:
+        """Build a complete message document including references.
+
+        Referenced and child messages are the shared views of those messages,
+        not copies, so a long reply chain doesn't get duplicated per message.
+        """
+        doc = dict(message.view())
         doc['referenced_messages'] = []
         doc['child_messages'] = []
 
         # Add referenced messages
-        for ref_id in message.get('references', []):
+        for ref_id in message.references:
             ref_message = self.processed_messages.get(ref_id)
             if ref_message:
-                doc['referenced_messages'].append(deepcopy(ref_message))
+                doc['referenced_messages'].append(ref_message.view())
 
         # Add child messages
-        for child_id in message.get('children', []):
+        for child_id in message.children:
             child_message = self.processed_messages.get(child_id)
             if child_message:
-                doc['child_messages'].append(deepcopy(child_message))
+                doc['child_messages'].append(child_message.view())
 
         return doc
 
     def build_thread_document(self, thread: ThreadInfo) -> dict:
         """Build a thread document with all related messages."""
         thread_doc = {
-            'thread_info': asdict(thread),
+            'thread_info': thread.to_dict(),
             'messages': []
         }
 
@@ -146,31 +223,61 @@ class DiscordMessageProcessor:
 
         return thread_doc
 
-    def generate_drive_documents(self) -> dict:
-        """Generate documents ready for Google Drive storage."""
-        message_documents = []
-        thread_documents = []
+    def iter_drive_documents(self) -> Iterator[dict]:
+        """Lazily yield the message documents and then the thread documents.
 
+        Only one document is built at a time, use this instead of
+        generate_drive_documents when the documents are consumed one by one.
+        """
         # Create individual message documents
         for message in self.processed_messages.values():
             # Only create individual documents for non-thread messages
             if not message.get('thread'):
-                message_documents.append({
+                yield {
                     'type': 'message',
                     'content': self.build_message_document(message)
-                })
+                }
 
         # Create thread documents
         for thread in self.threads.values():
-            thread_documents.append({
+            yield {
                 'type': 'thread',
                 'content': self.build_thread_document(thread)
-            })
+            }
+
+    def generate_drive_documents(self) -> dict:
+        """Generate documents ready for Google Drive storage."""
+        message_documents = []
+        thread_documents = []
+
+        for document in self.iter_drive_documents():
+            if document['type'] == 'message':
+                message_documents.append(document)
+            else:
+                thread_documents.append(document)
 
         return {
             'message_documents': message_documents,
             'thread_documents': thread_documents
         }
+
+    def write_drive_documents(self, fp):
+        """Stream the generate_drive_documents output as JSON without holding every document in memory."""
+        fp.write('{"message_documents": [')
+        section = 'message'
+        first = True
+        for document in self.iter_drive_documents():
+            if document['type'] != section:
+                fp.write('], "thread_documents": [')
+                section = document['type']
+                first = True
+            if not first:
+                fp.write(', ')
+            json.dump(document, fp)
+            first = False
+        if section == 'message':
+            fp.write('], "thread_documents": [')
+        fp.write(']}')
     
 
 
@@ -185,21 +292,16 @@ if __name__ == "__main__":
     #TODO: NEED TO GET THE PROCESSED MESSAGES TO GOOGLE DRIVE
 
     RESTACK_SUPPORT_CHANNEL="1293665802523902032"
-    
-    # Make Discord API request to get messages
-    response = requests.get(
-        f'https://discord.com/api/v9/channels/{RESTACK_SUPPORT_CHANNEL}/messages?limit=100',
-        headers={
-            'Authorization': AUTH_TOKEN,
-            'Content-Type': 'application/json'
-        }
-    )
 
-    raw_messages = response.json()
-    
-    
-    # Process messages with auth token for thread fetching
-    processor = DiscordMessageProcessor(raw_messages, AUTH_TOKEN)
+    import asyncio
+    from src.functions.discord.crawler import DiscordCrawler
+
+    # Crawl the full channel history and its threads, reruns only pull new messages
+    crawl = asyncio.run(DiscordCrawler(AUTH_TOKEN, RESTACK_SUPPORT_CHANNEL).crawl())
+    print(crawl.stats())
+
+    # Process messages with the crawled thread messages
+    processor = DiscordMessageProcessor(crawl.messages, AUTH_TOKEN, thread_messages=crawl.thread_messages)
     result = processor.process_messages().generate_drive_documents()
     
     # Save to file
@@ -1,17 +1,167 @@
-from restack_ai.function import function, log
+from restack_ai.function import function, FunctionFailure, log
 from pydantic import BaseModel
+from typing import List, Optional
+import json
+import os
+import re
+import threading
+import time
+
+from src.functions.discord.crawler import DEFAULT_STATE_DIR, CrawlResult, DiscordCrawler
+from src.functions.discord.messageProcessor import DiscordMessageProcessor
+from src.utils.executor import run_blocking
+from src.utils.telemetry import instrument
+
+
+RESTACK_SUPPORT_CHANNEL = "1293665802523902032"
+
+# How many matching threads to hand back to the workflow
+MAX_RESULTS = 5
+
+# Latest channel messages kept in the snapshot for queries without a question
+RECENT_MESSAGES = 100
+
+# The agent only reads the snapshot crawl_discord_channel writes, the crawl
+# runs on a schedule (discord_crawl_workflow, see schedule_discord_crawl.py)
+# instead of inside the query's time budget.
+
+
+def _terms(text: str) -> set:
+    return set(re.findall(r"\w{3,}", (text or "").lower()))
+
+
+def _thread_text(thread: dict) -> str:
+    return " ".join([thread.get('title') or ''] + [m.get('content') or '' for m in thread['messages']])
+
+
+def snapshot_path(channel_id: str, state_dir: str = DEFAULT_STATE_DIR) -> str:
+    return os.path.join(state_dir, f"{channel_id}.threads.json")
+
+
+def build_snapshot(crawl: CrawlResult) -> dict:
+    """The crawled channel as the threads the agent searches, processed once per crawl"""
+    processor = DiscordMessageProcessor(crawl.messages, thread_messages=crawl.thread_messages)
+    documents = processor.process_messages().generate_drive_documents()
+
+    threads = []
+    for document in documents['thread_documents']:
+        thread_doc = document['content']
+        threads.append({
+            "thread_id": thread_doc['thread_info']['thread_id'],
+            "title": thread_doc['thread_info']['thread_metadata'].get('name'),
+            "messages": [
+                {
+                    "author": m.get('author', {}).get('username'),
+                    "content": m.get('content'),
+                    "timestamp": m.get('timestamp'),
+                }
+                for m in thread_doc['messages']
+            ],
+        })
+
+    return {
+        "channel_id": crawl.channel_id,
+        "crawled_at": time.time(),
+        "messages": crawl.messages[:RECENT_MESSAGES],
+        "threads": threads,
+    }
+
+
+def save_snapshot(path: str, snapshot: dict):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+# path -> (mtime_ns, snapshot, terms of every thread)
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def load_snapshot(path: str) -> Optional[tuple]:
+    """The snapshot and its thread terms, read again only when the crawl replaced the file"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with _snapshots_lock:
+        cached = _snapshots.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path) as f:
+                snapshot = json.load(f)
+            cached = _snapshots[path] = (mtime, snapshot, [_terms(_thread_text(t)) for t in snapshot['threads']])
+        return cached[1], cached[2]
+
+
+def search_threads(snapshot: dict, thread_terms: List[set], query: str, limit: int = MAX_RESULTS) -> List[dict]:
+    """Rank the threads by how many of the query terms they share"""
+    query_terms = _terms(query)
+    scored = []
+    for thread, terms in zip(snapshot['threads'], thread_terms):
+        overlap = len(query_terms & terms)
+        if overlap:
+            scored.append((overlap, thread))
+
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return [thread for _, thread in scored[:limit]]
 
 
 @function.defn()
-async def discordAgent() -> str:
+@instrument
+async def discordAgent(input: dict = None) -> list:
     try:
         log.info("discordAgent function started")
 
-        discordMessages= [{"type":18,"content":"Problems running `modus dev` with assemblyscript/examples/simple","mentions":[],"mention_roles":[],"attachments":[],"embeds":[],"timestamp":"2025-01-12T22:02:11.409000+00:00","edited_timestamp":None,"flags":32,"components":[],"id":"1328121879604625418","channel_id":"1292948253796466730","author":{"id":"535416794295566358","username":"gmlewis","avatar":"a3dd8fc27b833334b5ca433efa11a0a9","discriminator":"0","public_flags":0,"flags":0,"banner":None,"accent_color":None,"global_name":"Glenn","avatar_decoration_data":None,"banner_color":None,"clan":None,"primary_guild":None},"pinned":False,"mention_everyone":False,"tts":False,"message_reference":{"type":0,"channel_id":"1328121879604625418","guild_id":"1267579648657850441"},"thread":{"id":"1328121879604625418","type":11,"last_message_id":"1328169152174886944","flags":0,"guild_id":"1267579648657850441","name":"Problems running `modus dev` with assemblyscript/examples/simple","parent_id":"1292948253796466730","rate_limit_per_user":0,"bitrate":64000,"user_limit":0,"rtc_region":None,"owner_id":"535416794295566358","thread_metadata":{"archived":False,"archive_timestamp":"2025-01-12T22:02:11.409000+00:00","auto_archive_duration":10080,"locked":False,"create_timestamp":"2025-01-12T22:02:11.409000+00:00"},"message_count":24,"member_count":2,"total_message_sent":24,"member_ids_preview":["535416794295566358","689915733009891363"]},"position":0},{"type":18,"content":"Hypermode Model Errors","mentions":[],"mention_roles":[],"attachments":[],"embeds":[],"timestamp":"2025-01-12T19:06:22.237000+00:00","edited_timestamp":None,"flags":0,"components":[],"id":"1328077633170182179","channel_id":"1292948253796466730","author":{"id":"689915733009891363","username":"mattjohnsonpint","avatar":"0ac66b3f0faa67fff7ed437da96fcdb0","discriminator":"0","public_flags":0,"flags":0,"banner":None,"accent_color":None,"global_name":"Matt Johnson-Pint","avatar_decoration_data":None,"banner_color":None,"clan":None,"primary_guild":None},"pinned":False,"mention_everyone":False,"tts":False,"message_reference":{"type":0,"channel_id":"1328073667925774448","guild_id":"1267579648657850441"},"position":0}]
+        input = input or {}
+        channel_id = input.get("channel_id") or os.getenv("DISCORD_CHANNEL_ID", RESTACK_SUPPORT_CHANNEL)
+
+        loaded = await run_blocking(load_snapshot, snapshot_path(channel_id))
+        if loaded is None:
+            log.error(f"discordAgent has no crawl of channel {channel_id} yet, schedule discord_crawl_workflow")
+            return []
+        snapshot, thread_terms = loaded
+
+        query = input.get("query")
+        if not query:
+            return snapshot['messages']
+
+        discordMessages = search_threads(snapshot, thread_terms, query)
 
         return discordMessages
-    
+
 
     except Exception as e:
         log.error("discordAgent function failed", error=e)
         raise e
+
+
+@function.defn()
+@instrument
+async def crawl_discord_channel(input: dict = None) -> dict:
+    """
+    Incremental crawl of a channel, then write the snapshot discordAgent searches.
+
+    Input (all optional): channel_id, defaults to DISCORD_CHANNEL_ID or the Restack support channel.
+    """
+    input = input or {}
+    auth_token = os.getenv("DISCORD_AUTH_TOKEN")
+    channel_id = input.get("channel_id") or os.getenv("DISCORD_CHANNEL_ID", RESTACK_SUPPORT_CHANNEL)
+
+    if not auth_token:
+        raise FunctionFailure("DISCORD_AUTH_TOKEN is not set", non_retryable=True)
+
+    try:
+        # Only messages newer than the checkpoint hit the Discord API
+        crawl = await DiscordCrawler(auth_token, channel_id).crawl()
+        snapshot = await run_blocking(build_snapshot, crawl)
+        await run_blocking(save_snapshot, snapshot_path(channel_id), snapshot)
+    except Exception as e:
+        log.error("crawl_discord_channel failed", error=e)
+        raise FunctionFailure(f"Failed to crawl Discord channel {channel_id}: {str(e)}") from e
+
+    stats = {**crawl.stats(), "snapshot_threads": len(snapshot['threads'])}
+    log.info("Discord crawl finished", **stats)
+    return stats
@@ -1,10 +1,13 @@
 from restack_ai.function import function, log
 from pydantic import BaseModel
 
+from src.utils.telemetry import instrument
+
 class WelcomeInput(BaseModel):
     name: str
 
 @function.defn()
+@instrument
 async def welcome(input: WelcomeInput) -> str:
     try:
         log.info("welcome function started", input=input)
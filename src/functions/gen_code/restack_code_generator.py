@@ -1,13 +1,21 @@
 from restack_ai.function import function, log
 from pydantic import BaseModel
-from google import genai
-from google.genai import types
 import subprocess
+import time
+
+from src.utils.executor import run_blocking
+from src.utils.lazy import lazy_import
+from src.utils.resilience import call_provider
+from src.utils.telemetry import instrument, record_http, record_llm
+
+genai = lazy_import("google.genai")
+types = lazy_import("google.genai.types")
 
 
 import os
 
 @function.defn()
+@instrument
 def use_cli(command: str) -> str:
     """Generates workflow or function based on the 
 
@@ -45,6 +53,7 @@ def use_cli(command: str) -> str:
 
 
 @function.defn()
+@instrument
 async def restack_code_gen(input):
     try:
         log.info("gemini_multi_function_call function started", input=input)
@@ -63,17 +72,26 @@ async def restack_code_gen(input):
         Example: "workflow data_pipeline" or "function process_image"
         """
         
-        response = client.models.generate_content(
+        started = time.perf_counter()
+        response = await call_provider("gemini", lambda: client.aio.models.generate_content(
             model='gemini-2.0-flash-exp',
             contents=prompt,
             config=types.GenerateContentConfig(tools=[use_cli])
+        ))
+        usage = getattr(response, "usage_metadata", None)
+        record_llm(
+            'gemini-2.0-flash-exp',
+            getattr(usage, "prompt_token_count", None) or 0,
+            getattr(usage, "candidates_token_count", None) or 0,
+            time.perf_counter() - started
         )
         
         # Use the model's response to call use_cli
         command = response.text.strip()
         result={}
         if command!=False:
-            result = use_cli(command)
+            # The CLI is a subprocess, run it in the bounded pool instead of blocking the loop
+            result = await run_blocking(use_cli, command)
         
         log.info("gemini_multi_function_call function completed", response=result)
         return {"command": command, "result": result}
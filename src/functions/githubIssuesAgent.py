@@ -1,8 +1,11 @@
 from restack_ai.function import function, log
 from pydantic import BaseModel
 
+from src.utils.telemetry import instrument
+
 
 @function.defn()
+@instrument
 async def githubIssuesAgent() -> str:
     try:
         log.info("githubIssuesAgent function started")
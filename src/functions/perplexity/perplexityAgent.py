@@ -2,26 +2,33 @@ from restack_ai.function import function, log
 from pydantic import BaseModel
 import os
 
-from llama_index.core.llms import ChatMessage
-from llama_index.llms.perplexity import Perplexity
+from src.utils.lazy import lazy_import
+from src.utils.token_stream import open_stream
+from src.utils.telemetry import instrument, install_llama_index_handler
+
+ChatMessage = lazy_import("llama_index.core.llms", "ChatMessage")
+Perplexity = lazy_import("llama_index.llms.perplexity", "Perplexity")
 
 
 @function.defn()
+@instrument
 async def perplexityAgent(input) -> str:
     try:
         log.info("perplexityAgent function started")
 
         query = input.get("query")
+        stream_id = input.get("stream_id")
 
 
         pplx_api_key = os.getenv("PERPLEXITY_API_KEY")
+        install_llama_index_handler()
         perplixty_llm = Perplexity(
             api_key=pplx_api_key,
             model="mixtral-8x7b-instruct",
             temperature=0.5
         )
 
-        # perplexityMessage = perplixty_llm.complete(query).text
+        # perplexityMessage = (await perplixty_llm.acomplete(query)).text
 
         perplexityMessage = """The search results don't contain specific information about deploying a Next.js application with Restack. However, I can provide you with the general steps to deploy a Next.js application:
         First, ensure your Next.js application is properly set up with the required scripts in your package.json1:
@@ -55,7 +62,20 @@ async def perplexityAgent(input) -> str:
 
         try:
             # Call the Perplexity LLM with the messages
-            # perplexityMessage = perplixty_llm.chat(messages).message.content
+            # Use the async API so a slow Perplexity call doesn't block the other functions on this worker
+            # perplexityMessage = (await perplixty_llm.achat(messages)).message.content
+
+            if stream_id:
+                # Streaming mode, push the tokens to the frontend while they come in
+                with open_stream(stream_id) as stream:
+                    # chunks = []
+                    # async for chunk in await perplixty_llm.astream_chat(messages):
+                    #     chunks.append(chunk.delta)
+                    #     stream.publish("perplexity_response", chunk.delta)
+                    # perplexityMessage = "".join(chunks)
+                    stream.publish("perplexity_response", perplexityMessage)
+                    stream.finish("perplexity_response")
+
             return perplexityMessage
         except Exception as e:
             log.error("Perplexity API call failed", error=str(e))
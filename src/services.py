@@ -1,18 +1,30 @@
 import asyncio
+import contextlib
 import os
+import signal
+import time
+from datetime import timedelta
+from typing import Optional
 from src.functions.function import welcome
 from src.client import client
 
 
 
 # Functions
-from src.functions.discordAgent import discordAgent
+from src.functions.discordAgent import discordAgent, crawl_discord_channel
 from src.functions.githubIssuesAgent import githubIssuesAgent
 from src.functions.perplexity.perplexityAgent import perplexityAgent
 from src.functions.RAG.llamaCloudRAG import llama_cloud_rag
 from src.functions.RAG.validateRAGResponse import validate_RAG_response
 from src.functions.gen_code.restack_code_generator import restack_code_gen
-from src.functions.RAG.ingestDocuments import ingest_documents_to_rag
+from src.functions.RAG.ingestDocuments import ingest_documents_to_rag, create_questions_from_processed_discord_messages
+from src.functions.RAG.batchQuery import plan_query_batch, answer_query_batch
+from src.functions.RAG.precomputeEmbeddings import precompute_embeddings
+from src.functions.RAG.engineCache import warm_up_engines
+from src.utils import lifecycle
+from src.utils.executor import run_blocking
+from src.utils.telemetry import setup_telemetry
+from src.functions.cache.semanticCache import lookup_semantic_cache, store_semantic_cache, invalidate_semantic_cache
 
 from src.workflows.submit_answer_workflow import submit_answer_workflow
 
@@ -20,29 +32,178 @@ from src.workflows.submit_answer_workflow import submit_answer_workflow
 # Workflows
 
 from src.workflows.query_question_workflow import query_question_workflow
+from src.workflows.batch_query_workflow import batch_query_workflow
+from src.workflows.discord_crawl_workflow import discord_crawl_workflow
 
-
-
-from watchfiles import run_process
-
-
+from src.services_config import SERVICES_CONFIG, ServicesConfig
+from restack_ai.restack import ServiceOptions
+from temporalio.worker import Worker
 
 
 
-
-async def main():
-
-    await client.start_service(
-        workflows=[query_question_workflow, submit_answer_workflow],
-        functions=[discordAgent, githubIssuesAgent, perplexityAgent, llama_cloud_rag, validate_RAG_response,restack_code_gen, ingest_documents_to_rag]
+from watchfiles import run_process
+import multiprocessing
+
+
+
+WORKFLOWS = [query_question_workflow, submit_answer_workflow, batch_query_workflow, discord_crawl_workflow]
+
+FUNCTIONS = [discordAgent, githubIssuesAgent, perplexityAgent, llama_cloud_rag, validate_RAG_response, restack_code_gen, ingest_documents_to_rag, create_questions_from_processed_discord_messages,
+             lookup_semantic_cache, store_semantic_cache, invalidate_semantic_cache, plan_query_batch, answer_query_batch,
+             precompute_embeddings, crawl_discord_channel]
+
+HEARTBEAT_SECONDS = float(os.getenv("WORKER_HEARTBEAT_SECONDS", "5"))
+
+# The RAG engine is only worth warming up in processes that run these
+RAG_FUNCTIONS = {"llama_cloud_rag", "validate_RAG_response", "create_questions_from_processed_discord_messages", "answer_query_batch"}
+
+
+def service_specs(config: ServicesConfig, process_index: int = 0) -> list:
+    """start_service arguments for every service the given worker process runs"""
+    functions_by_name = {f.__name__: f for f in FUNCTIONS}
+    config.validate(functions_by_name)
+
+    specs = []
+    if process_index < config.workflow_processes:
+        queued = {name for queue in config.queues.values() for name in queue.functions}
+        spec = {
+            "workflows": WORKFLOWS,
+            "functions": [f for f in FUNCTIONS if f.__name__ not in queued],
+        }
+        if config.workflow_options:
+            spec["options"] = ServiceOptions(**config.workflow_options)
+        specs.append(spec)
+
+    for queue in config.queues.values():
+        if process_index >= queue.processes or not queue.functions:
+            continue
+        spec = {
+            "functions": [functions_by_name[name] for name in queue.functions],
+            "task_queue": queue.name,
+        }
+        if queue.options:
+            spec["options"] = ServiceOptions(**queue.options)
+        specs.append(spec)
+
+    return specs
+
+
+async def create_worker(spec: dict) -> Worker:
+    """
+    The Temporal worker client.start_service would run for a spec, with a
+    graceful shutdown timeout: once shut down it stops polling and gives the
+    runs in flight DRAIN_SECONDS to finish before cancelling them.
+    """
+    service = await client.create_service(**{"options": ServiceOptions(), **spec})
+    config = service.config()
+    config["graceful_shutdown_timeout"] = timedelta(seconds=lifecycle.DRAIN_SECONDS)
+    return Worker(**config)
+
+
+async def main(process_index: int = 0, layout_index: Optional[int] = None, stop: Optional[asyncio.Event] = None):
+    """
+    Run the services of one worker process. layout_index picks the queues from
+    services.toml (defaults to process_index), the supervisor's shared mode
+    runs layout 0, which serves everything, in every process.
+
+    Runs until stop is set, then shuts the workers down gracefully and returns.
+    """
+    specs = service_specs(SERVICES_CONFIG, process_index if layout_index is None else layout_index)
+
+    # Metrics endpoint and LLM call tracking, before any function runs
+    setup_telemetry(process_index)
+
+    workers = [await create_worker(spec) for spec in specs]
+    services = [asyncio.ensure_future(client.run_service(worker)) for worker in workers]
+
+    # Build the shared RAG query engine (and import llama_index) in the
+    # background, so the worker registers with Restack right away and the
+    # first RAG task waits for the build instead of every worker start
+    if any(f.__name__ in RAG_FUNCTIONS for spec in specs for f in spec["functions"]):
+        services.append(asyncio.ensure_future(run_blocking(warm_up_engines)))
+
+    running = asyncio.ensure_future(asyncio.gather(*services))
+    if stop is None:
+        await running
+        return
+
+    stopping = asyncio.ensure_future(stop.wait())
+    await asyncio.wait({running, stopping}, return_when=asyncio.FIRST_COMPLETED)
+    if running.done():
+        stopping.cancel()
+        running.result()
+        return
+
+    print(f"Worker {process_index} stopping with {lifecycle.in_flight()} runs in flight")
+    # Returns once the runs finished, or were cancelled after the graceful shutdown timeout
+    await asyncio.gather(*(worker.shutdown() for worker in workers))
+    print(f"Worker {process_index} stopped")
+    running.cancel()
+
+async def _heartbeat(beat):
+    while True:
+        beat.value = time.time()
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+
+
+async def serve(process_index: int = 0, layout_index: Optional[int] = None, beat=None):
+    """
+    Body of a worker process: run main until SIGTERM or SIGINT, then drain.
+    beat is a shared double the supervisor watches, refreshed every
+    HEARTBEAT_SECONDS while the process is alive.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    heartbeat = asyncio.ensure_future(_heartbeat(beat)) if beat is not None else None
+    try:
+        # Returns once the workers shut down after stop is set
+        await main(process_index, layout_index, stop)
+        if not stop.is_set():
+            # The service is not supposed to return, let the supervisor restart us
+            raise RuntimeError("Restack service stopped on its own")
+    finally:
+        if heartbeat is not None:
+            heartbeat.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await heartbeat
+
+
+def run_worker(process_index: int = 0, layout_index: Optional[int] = None, beat=None):
+    asyncio.run(serve(process_index, layout_index, beat))
+
+
+def start_worker_process(context, process_index: int, layout_index: Optional[int] = None, beat=None) -> multiprocessing.Process:
+    """Spawn one worker process, used by run_services and by the supervisor"""
+    process = context.Process(
+        target=run_worker,
+        args=(process_index, layout_index, beat),
+        name=f"restack-worker-{process_index}",
     )
+    process.start()
+    return process
 
 def run_services():
+    processes = SERVICES_CONFIG.host_processes
+    if processes == 1:
+        run_worker()
+        return
+
+    # One process per index, process N serves every queue configured with more than N processes
+    context = multiprocessing.get_context("spawn")
+    workers = [start_worker_process(context, i) for i in range(processes)]
     try:
-        asyncio.run(main())
+        for worker in workers:
+            worker.join()
     except KeyboardInterrupt:
-        print("Service interrupted by user. Exiting gracefully.")
+        # The workers got the SIGINT too and are draining their in-flight runs
+        print("Service interrupted by user, waiting for the workers to stop.")
+        for worker in workers:
+            worker.join()
 
+# Development reloader, production hosts run `poetry run supervisor` (src/supervisor.py)
 def watch_services():
     watch_path = os.getcwd()
     print(f"Watching {watch_path} and its subdirectories for changes...")
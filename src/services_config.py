@@ -0,0 +1,103 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+import os
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    # Python 3.10
+    import tomli as tomllib
+
+
+# Which task queue every function runs on, with how many worker processes and
+# which ServiceOptions. Without a config file everything runs in one service
+# on the default queue, like before.
+SERVICES_CONFIG_PATH = os.getenv("SERVICES_CONFIG", os.path.join(os.getcwd(), "services.toml"))
+
+
+@dataclass
+class QueueConfig:
+    name: str
+    functions: List[str]
+    # Worker processes on this host that serve the queue
+    processes: int = 1
+    # Passed to ServiceOptions as is, e.g. max_concurrent_function_runs and rate_limit
+    options: Dict[str, object] = field(default_factory=dict)
+
+
+@dataclass
+class ServicesConfig:
+    # The workflows and every function not listed in a queue run on the default queue
+    workflow_processes: int = 1
+    workflow_options: Dict[str, object] = field(default_factory=dict)
+    queues: Dict[str, QueueConfig] = field(default_factory=dict)
+
+    def task_queue_for(self, function_name: str) -> Optional[str]:
+        for queue in self.queues.values():
+            if function_name in queue.functions:
+                return queue.name
+        return None
+
+    @property
+    def host_processes(self) -> int:
+        return max([self.workflow_processes] + [q.processes for q in self.queues.values()])
+
+    def validate(self, known_functions: Iterable[str]) -> "ServicesConfig":
+        """Fail at startup on typos instead of silently leaving a queue without workers"""
+        known = set(known_functions)
+        seen = {}
+        for queue in self.queues.values():
+            if queue.processes < 1:
+                raise ValueError(f"Queue '{queue.name}' needs at least one process")
+            for name in queue.functions:
+                if name not in known:
+                    raise ValueError(f"Queue '{queue.name}' lists unknown function '{name}'")
+                if name in seen:
+                    raise ValueError(f"Function '{name}' is in both '{seen[name]}' and '{queue.name}'")
+                seen[name] = queue.name
+        if self.workflow_processes < 1:
+            raise ValueError("The workflows need at least one process")
+        return self
+
+
+def load_services_config(path: str = SERVICES_CONFIG_PATH) -> ServicesConfig:
+    """
+    Read the service layout from a TOML file.
+
+        [workflows]
+        processes = 1
+
+        [queues.llm]
+        functions = ["llama_cloud_rag", "validate_RAG_response"]
+        processes = 2
+        options = { max_concurrent_function_runs = 8, rate_limit = 4 }
+    """
+    if not os.path.exists(path):
+        return ServicesConfig()
+
+    with open(path, "rb") as f:
+        data = tomllib.load(f)
+
+    workflows = data.get("workflows", {})
+    return ServicesConfig(
+        workflow_processes=workflows.get("processes", 1),
+        workflow_options=workflows.get("options", {}),
+        queues={
+            name: QueueConfig(
+                name=name,
+                functions=list(queue.get("functions", [])),
+                processes=queue.get("processes", 1),
+                options=queue.get("options", {}),
+            )
+            for name, queue in data.get("queues", {}).items()
+        },
+    )
+
+
+SERVICES_CONFIG = load_services_config()
+
+
+def step_options(function) -> dict:
+    """Extra workflow.step arguments that send the function to its task queue"""
+    task_queue = SERVICES_CONFIG.task_queue_for(function.__name__)
+    return {"task_queue": task_queue} if task_queue else {}
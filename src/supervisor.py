@@ -0,0 +1,207 @@
+"""
+Production entry point: supervise several Restack worker processes.
+
+    poetry run supervisor                     # one worker per config layout slot
+    poetry run supervisor --workers 4 --shared
+
+In the default partitioned mode the workers follow services.toml, worker N
+serves every queue configured with more than N processes. With --shared
+every worker serves the workflows and all queues.
+
+The supervisor restarts workers that exit or stop sending heartbeats (with
+backoff), serves /healthz and /readyz on HEALTH_PORT and on SIGTERM has
+every worker stop polling and finish its in-flight function runs before it exits.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from src import services
+from src.services_config import SERVICES_CONFIG
+from src.utils import lifecycle
+
+
+# Workers beat every services.HEARTBEAT_SECONDS, a worker without a
+# heartbeat for this long is considered hung and restarted
+HEARTBEAT_TIMEOUT_SECONDS = float(os.getenv("WORKER_HEARTBEAT_TIMEOUT_SECONDS", "60"))
+# Importing the SDKs and warming the engine happens before the first heartbeat
+STARTUP_GRACE_SECONDS = float(os.getenv("WORKER_STARTUP_GRACE_SECONDS", "180"))
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8080"))
+
+RESTART_BACKOFF_MAX_SECONDS = 60
+# A worker that ran this long before crashing starts its backoff from scratch
+STABLE_SECONDS = 120
+
+
+class WorkerSlot:
+    """One supervised worker, restarted in place when it dies"""
+
+    def __init__(self, index: int, layout_index: int, context):
+        self.index = index
+        self.layout_index = layout_index
+        self.context = context
+        self.process: Optional[multiprocessing.Process] = None
+        self.beat = context.Value("d", 0.0)
+        self.started_at = 0.0
+        self.restarts = 0
+        self.backoff = 1.0
+        self.restart_at: Optional[float] = None
+
+    def start(self):
+        self.beat.value = 0.0
+        self.process = services.start_worker_process(self.context, self.index, self.layout_index, self.beat)
+        self.started_at = time.time()
+        self.restart_at = None
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def healthy(self, now: float) -> bool:
+        if not self.alive():
+            return False
+        if self.beat.value == 0.0:
+            return now - self.started_at < STARTUP_GRACE_SECONDS
+        return now - self.beat.value < HEARTBEAT_TIMEOUT_SECONDS
+
+    def ready(self) -> bool:
+        return self.alive() and self.beat.value > 0.0
+
+    def status(self, now: float) -> dict:
+        return {
+            "worker": self.index,
+            "pid": self.process.pid if self.process else None,
+            "alive": self.alive(),
+            "healthy": self.healthy(now),
+            "ready": self.ready(),
+            "restarts": self.restarts,
+            "heartbeat_age_seconds": round(now - self.beat.value, 1) if self.beat.value else None,
+        }
+
+
+class Supervisor:
+    def __init__(self, layout: List[int]):
+        self.context = multiprocessing.get_context("spawn")
+        self.slots = [WorkerSlot(i, layout_index, self.context) for i, layout_index in enumerate(layout)]
+        self.stopping = threading.Event()
+        self.last_check = time.time()
+
+    def check(self):
+        """Restart dead or hung workers, with exponential backoff for crash loops"""
+        now = time.time()
+        self.last_check = now
+        for slot in self.slots:
+            if slot.restart_at is not None:
+                if now >= slot.restart_at:
+                    slot.start()
+                continue
+
+            if slot.healthy(now):
+                continue
+
+            if slot.alive():
+                print(f"Worker {slot.index} missed its heartbeat, killing it")
+                slot.process.kill()
+                slot.process.join(5)
+            else:
+                print(f"Worker {slot.index} exited with code {slot.process.exitcode}")
+
+            if now - slot.started_at > STABLE_SECONDS:
+                slot.backoff = 1.0
+            slot.restarts += 1
+            slot.restart_at = now + slot.backoff
+            print(f"Restarting worker {slot.index} in {slot.backoff:.0f}s")
+            slot.backoff = min(slot.backoff * 2, RESTART_BACKOFF_MAX_SECONDS)
+
+    def shutdown(self):
+        """SIGTERM every worker, give them the drain time and kill what is left"""
+        for slot in self.slots:
+            if slot.alive():
+                slot.process.terminate()
+
+        deadline = time.time() + lifecycle.DRAIN_SECONDS + 10
+        for slot in self.slots:
+            if slot.process is not None:
+                slot.process.join(max(0.0, deadline - time.time()))
+                if slot.process.is_alive():
+                    print(f"Worker {slot.index} did not drain in time, killing it")
+                    slot.process.kill()
+                    slot.process.join()
+
+    def serve_health(self, port: int) -> ThreadingHTTPServer:
+        supervisor = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                import json
+
+                now = time.time()
+                workers = [slot.status(now) for slot in supervisor.slots]
+                if self.path.startswith("/healthz"):
+                    # Liveness is about the supervisor loop, replacing workers is its own job
+                    ok = not supervisor.stopping.is_set() and now - supervisor.last_check < 30
+                elif self.path.startswith("/readyz"):
+                    ok = not supervisor.stopping.is_set() and all(w["ready"] for w in workers)
+                else:
+                    self.send_error(404)
+                    return
+
+                body = json.dumps({"ok": ok, "workers": workers}).encode("utf-8")
+                self.send_response(200 if ok else 503)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), HealthHandler)
+        threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+        return server
+
+    def run(self, health_port: int = HEALTH_PORT):
+        signal.signal(signal.SIGTERM, lambda *_: self.stopping.set())
+        signal.signal(signal.SIGINT, lambda *_: self.stopping.set())
+
+        server = self.serve_health(health_port) if health_port else None
+        for slot in self.slots:
+            slot.start()
+        print(f"Supervising {len(self.slots)} workers, health on :{health_port}")
+
+        while not self.stopping.wait(1.0):
+            self.check()
+
+        print("Stopping, draining workers")
+        self.shutdown()
+        if server is not None:
+            server.shutdown()
+
+
+def run_supervisor():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKER_PROCESSES", "0")),
+                        help="number of worker processes, defaults to the services.toml layout (or CPU count with --shared)")
+    parser.add_argument("--shared", action="store_true", default=os.getenv("WORKER_QUEUES", "") == "shared",
+                        help="every worker serves all task queues instead of the services.toml partition")
+    parser.add_argument("--health-port", type=int, default=HEALTH_PORT, help="0 disables the health endpoint")
+    args = parser.parse_args()
+
+    if args.shared:
+        workers = args.workers or os.cpu_count() or 1
+        # Layout slot 0 serves the workflows and every queue
+        layout = [0] * workers
+    else:
+        workers = args.workers or SERVICES_CONFIG.host_processes
+        # Extra workers beyond the configured layout repeat it
+        layout = [i % SERVICES_CONFIG.host_processes for i in range(workers)]
+
+    Supervisor(layout).run(args.health_port)
+
+
+if __name__ == "__main__":
+    run_supervisor()
@@ -2,21 +2,26 @@ import streamlit as st
 from restack_ai import Restack
 import asyncio
 import time
-import requests
-import tomli
+import hashlib
+import sys
 from pathlib import Path
 
+# Make the src package importable when the app is started with `streamlit run`
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from src.utils.token_stream import read_stream
+from src.utils.singleflight import SingleFlight
+from src.utils.text import normalize_query
+from src.temp_frontend.restack_api import RestackApiClient, RestackApiError
 
 
-# API configuration
-API_BASE_URL = st.secrets["restack"]["RESTACK_ENGINE_API_ADDRESS"]
-if not API_BASE_URL.startswith("http"):
-    API_BASE_URL = f"https://{API_BASE_URL}"
 
-headers = {
-    "Content-Type": "application/json",
-    "X-API-Key": st.secrets["restack"]["RESTACK_ENGINE_API_KEY"]
-}
+@st.cache_resource
+def get_api_client() -> RestackApiClient:
+    """Pooled Restack API client shared by every browser session"""
+    return RestackApiClient(
+        st.secrets["restack"]["RESTACK_ENGINE_API_ADDRESS"],
+        st.secrets["restack"]["RESTACK_ENGINE_API_KEY"],
+    )
 
 # Custom CSS
 st.markdown("""
@@ -81,37 +86,92 @@ st.title("🔍 TrieOverflow")
 st.markdown("_Powered by Snowflake_")
 st.markdown('</div>', unsafe_allow_html=True)
 
-def process_query(query: str) -> dict:
-    """Process a query using the query_question_workflow"""
-    
+STREAM_SOURCES = {
+    "rag_results": "#### 📚 Snowflake RAG Response",
+    "perplexity_response": "#### 🤖 Perplexity Response",
+}
+
+@st.cache_resource
+def get_inflight_queries() -> SingleFlight:
+    """Shared by every browser session, so identical queries submitted together run one workflow"""
+    return SingleFlight()
+
+def query_key(query: str) -> str:
+    return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+def render_stream(workflow_id: str, is_done):
+    """Render partial tokens from the token stream until is_done() returns True"""
+    col1, col2 = st.columns(2)
+    placeholders = {}
+    with col1:
+        st.markdown(STREAM_SOURCES["perplexity_response"])
+        placeholders["perplexity_response"] = st.empty()
+    with col2:
+        st.markdown(STREAM_SOURCES["rag_results"])
+        placeholders["rag_results"] = st.empty()
+
+    texts = {source: "" for source in STREAM_SOURCES}
+    offset = 0
+
+    while True:
+        # Check before reading so the events written just before the request returned are still shown
+        finished = is_done()
+
+        events, offset = read_stream(workflow_id, offset)
+        changed = set()
+        for event in events:
+            if event["source"] in texts and event.get("delta"):
+                texts[event["source"]] += event["delta"]
+                changed.add(event["source"])
+
+        for source in changed:
+            placeholders[source].markdown(texts[source] + " ▌")
+
+        if finished:
+            break
+        time.sleep(0.1)
+
+def process_query(query: str, stream: bool = True) -> dict:
+    """
+    Process a query using the query_question_workflow.
+
+    If the same query (after normalization) is already running for another
+    user, attach to that workflow's token stream and API request instead of
+    starting a new workflow. The request runs on the shared client's loop, so
+    it finishes for every session even if the one that started it is stopped.
+    """
+    inflight = get_inflight_queries()
     workflow_id = f"{int(time.time() * 1000)}-query_question_workflow"
-    
-    # Prepare the request payload
-    payload = {
-        "workflow_id": workflow_id,
-        "input": {
-            "query": query
-        }
-    }
-    
-    # Send POST request to the query workflow endpoint
-    response = requests.post(
-        f"{API_BASE_URL}/api/workflows/query_question_workflow",
-        headers=headers,
-        json=payload
+
+    call, leader = inflight.share(
+        query_key(query),
+        lambda: start_query_workflow(query, workflow_id, stream),
+        info=workflow_id,
     )
-    
-    if response.status_code != 200:
-        return {
-            'error': f"Error: {response.status_code} - {response.text}"
-        }
-    
-    result = response.json()
+    if stream:
+        render_stream(call.info, call.done)
+
+    try:
+        result = call.wait()
+    except Exception as e:
+        return {'error': f"Error: {e}", 'coalesced': not leader}
+
     return {
-        'workflow_id': workflow_id,
-        'result': result
+        'workflow_id': call.info,
+        'result': result,
+        'coalesced': not leader,
     }
 
+def start_query_workflow(query: str, workflow_id: str, stream: bool = True):
+    """Start the query_question_workflow, returns the Future of its result"""
+
+    workflow_input = {"query": query}
+    if stream:
+        # The functions write their tokens to a stream named after the workflow
+        workflow_input["stream_id"] = workflow_id
+
+    return get_api_client().run_workflow("query_question_workflow", workflow_id, workflow_input)
+
 def submit_answer(answer: str) -> str:
     """Submit an answer using the submit_answer_workflow"""
     if not st.session_state.last_query:
@@ -122,31 +182,21 @@ No query has been submitted yet! Please submit a query first before providing an
 
     workflow_id = f"{int(time.time() * 1000)}-submit_answer_workflow"
     
-    # Prepare the request payload
-    payload = {
-        "workflow_id": workflow_id,
-        "input": {
-            "query": st.session_state.last_query,
-            "answer": answer
-        }
+    workflow_input = {
+        "query": st.session_state.last_query,
+        "answer": answer
     }
-    
+
     try:
-        # Send POST request to the submit answer workflow endpoint
-        response = requests.post(
-            f"{API_BASE_URL}/api/workflows/submit_answer_workflow",
-            headers=headers,
-            json=payload
-        )
-        
-        if response.status_code != 200:
+        request = get_api_client().run_workflow("submit_answer_workflow", workflow_id, workflow_input)
+        try:
+            result = request.result()
+        except RestackApiError as e:
             return f"""
 ### ❌ Error
-Failed to submit answer: {response.text}
+Failed to submit answer: {e.text}
 """
         
-        result = response.json()
-        
         return f"""
 ### ✅ Submission Status
 Your answer has been successfully submitted and stored! Thank you for contributing.
@@ -178,15 +228,28 @@ query = st.text_area(
 
 if st.button("🚀 Submit Query"):
     if query:
-        with st.spinner('🔄 Processing your query... Please wait.'):
+        # Tokens are rendered as they stream in, the full result replaces them when the workflow is done
+        stream_area = st.empty()
+        with stream_area.container():
             response = process_query(query)
-            st.session_state.current_response = response
-            st.session_state.has_response = True
-            
-            
+        stream_area.empty()
+        st.session_state.current_response = response
+        st.session_state.has_response = True
+
+
     else:
         st.error("Please enter a query first!")
 
+coalescing_stats = get_inflight_queries().stats
+st.sidebar.caption(
+    f"In-flight queries: {coalescing_stats.in_flight} · "
+    f"started: {coalescing_stats.leaders} · coalesced: {coalescing_stats.coalesced}"
+)
+api_stats = get_api_client().stats
+st.sidebar.caption(
+    f"API requests: {api_stats['requests']} · retries: {api_stats['retries']} · failures: {api_stats['failures']}"
+)
+
 # Display response if exists
 if st.session_state.has_response and st.session_state.current_response:
     response_data = st.session_state.current_response.get('result', {})
@@ -0,0 +1,107 @@
+from concurrent.futures import Future
+from typing import Optional
+import asyncio
+import os
+import random
+import threading
+
+import httpx
+
+
+# Client for the Restack engine HTTP API used by the Streamlit frontend.
+#
+# One instance is shared by every browser session (st.cache_resource), so all
+# users reuse the same keep-alive connections instead of a TLS handshake per
+# request. Requests run on a private event loop thread. The Streamlit script
+# thread gets a Future back and can keep rendering the token stream while the
+# workflow runs, polling Future.done() instead of blocking on the socket.
+
+# Starting a workflow returns when the workflow is done, so the read timeout
+# has to cover a whole query
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("RESTACK_API_TIMEOUT", "300"))
+CONNECT_TIMEOUT_SECONDS = float(os.getenv("RESTACK_API_CONNECT_TIMEOUT", "5"))
+MAX_CONNECTIONS = int(os.getenv("RESTACK_API_MAX_CONNECTIONS", "100"))
+MAX_RETRIES = int(os.getenv("RESTACK_API_RETRIES", "3"))
+BACKOFF_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+
+# Only failures where the engine can't have started the workflow are retried,
+# anything else could run the same workflow twice
+RETRY_STATUS_CODES = {429, 503}
+RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class RestackApiError(Exception):
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"{status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+class RestackApiClient:
+    def __init__(self, base_url: str, api_key: str, max_retries: int = MAX_RETRIES):
+        if not base_url.startswith("http"):
+            base_url = f"https://{base_url}"
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.stats = {"requests": 0, "retries": 0, "failures": 0}
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="restack-api", daemon=True)
+        self._thread.start()
+
+        headers = {"Content-Type": "application/json", "X-API-Key": api_key}
+        self._client: httpx.AsyncClient = self._call(self._make_client(headers)).result()
+
+    async def _make_client(self, headers: dict) -> httpx.AsyncClient:
+        # Created on the private loop, the client's connections belong to it
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=headers,
+            timeout=httpx.Timeout(REQUEST_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS // 5 or 1),
+        )
+
+    def _call(self, coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def _post(self, path: str, payload: dict) -> dict:
+        self.stats["requests"] += 1
+        attempt = 0
+        while True:
+            try:
+                response = await self._client.post(path, json=payload)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    break
+            except RETRY_EXCEPTIONS:
+                if attempt >= self.max_retries:
+                    self.stats["failures"] += 1
+                    raise
+            except httpx.HTTPError:
+                self.stats["failures"] += 1
+                raise
+
+            # Exponential backoff with full jitter, so many sessions don't retry in lockstep
+            attempt += 1
+            self.stats["retries"] += 1
+            await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_SECONDS * 2 ** attempt)))
+
+        if response.status_code != 200:
+            self.stats["failures"] += 1
+            raise RestackApiError(response.status_code, response.text)
+        return response.json()
+
+    def run_workflow(self, workflow_name: str, workflow_id: str, input: dict) -> Future:
+        """
+        Start a workflow and wait for its result on the client's loop.
+
+        Returns:
+            Future: resolves to the workflow result, or raises RestackApiError / httpx.HTTPError
+        """
+        payload = {"workflow_id": workflow_id, "input": input}
+        return self._call(self._post(f"/api/workflows/{workflow_name}", payload))
+
+    def close(self, timeout: Optional[float] = 5):
+        self._call(self._client.aclose()).result(timeout)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
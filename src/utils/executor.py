@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import os
+import time
+
+from src.utils.telemetry import record_blocking_queue
+
+
+# Blocking SDK calls that have no async API run here instead of on the event loop.
+# The pool is bounded so a burst of slow calls can't spawn unlimited threads.
+MAX_BLOCKING_WORKERS = int(os.getenv("MAX_BLOCKING_WORKERS", "16"))
+
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=MAX_BLOCKING_WORKERS,
+            thread_name_prefix="blocking-io"
+        )
+    return _executor
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """
+    Run a blocking callable in the shared bounded thread pool.
+
+    Args:
+        fn: The blocking function to call
+        *args, **kwargs: Arguments passed to fn
+
+    Returns:
+        Whatever fn returns
+    """
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+
+    def call():
+        record_blocking_queue(time.perf_counter() - submitted)
+        return fn(*args, **kwargs)
+
+    # Carry the context over so telemetry recorded in the thread lands on the calling function
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), functools.partial(context.run, call))
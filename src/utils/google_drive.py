@@ -1,181 +1,397 @@
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from restack_ai.function import log
+from typing import Iterator, Optional
+import io
 import os
 from dotenv import load_dotenv
 import json
-import tempfile
+import threading
 import time
 
+import httplib2
+
+from src.utils.lazy import lazy_import
+from src.utils.telemetry import record_http
+
+# The Google client libraries are imported on first Drive request
+service_account = lazy_import("google.oauth2.service_account")
+Request = lazy_import("google.auth.transport.requests", "Request")
+build = lazy_import("googleapiclient.discovery", "build")
+MediaFileUpload = lazy_import("googleapiclient.http", "MediaFileUpload")
+MediaIoBaseUpload = lazy_import("googleapiclient.http", "MediaIoBaseUpload")
+AuthorizedHttp = lazy_import("google_auth_httplib2", "AuthorizedHttp")
+
 load_dotenv()
 
+DEFAULT_FOLDER_ID = "1l-wV54W5S6b8cTMD-qbGp4hlkNN7txvh"
+
+# Payloads under this size are uploaded from memory in a single request,
+# bigger ones use a resumable upload
+SIMPLE_UPLOAD_MAX_BYTES = 5 * 1024 * 1024
+
+_credentials = None
+_credentials_lock = threading.Lock()
+
+# googleapiclient service objects share one httplib2.Http which isn't thread safe,
+# so every thread builds its own service once and keeps it
+_local = threading.local()
+
 def get_credentials():
     """Get Google Drive credentials from environment JSON string"""
     service_account_json = os.getenv('GOOGLE_SERVICE_JSON')
     if not service_account_json:
         raise ValueError("GOOGLE_SERVICE_JSON not found in environment variables")
-    
+
     # Parse the JSON string
     service_account_info = json.loads(service_account_json)
-    
+
     # Create credentials from the parsed JSON
     credentials = service_account.Credentials.from_service_account_info(
         service_account_info,
         scopes=['https://www.googleapis.com/auth/drive.file']
     )
-    
+
     return credentials
 
-def upload_file_to_drive(file_path: str, folder_id: str = "1l-wV54W5S6b8cTMD-qbGp4hlkNN7txvh", mime_type: str = None) -> dict:
+def get_cached_credentials():
+    """Parse the service account once and refresh the access token when it expires"""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials = get_credentials()
+
+        # Refresh under the lock so concurrent callers don't all hit the token endpoint
+        if not _credentials.valid:
+            _credentials.refresh(Request())
+
+        return _credentials
+
+class _TimedHttp(httplib2.Http):
+    """httplib2.Http that reports the latency of every Drive request"""
+
+    def request(self, uri, method="GET", *args, **kwargs):
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response, content = super().request(uri, method, *args, **kwargs)
+            status = response.status
+            return response, content
+        finally:
+            record_http("drive", status, time.perf_counter() - started)
+
+def get_drive_service():
+    """
+    Get a Drive API service for the current thread.
+
+    The credentials are shared by every thread, the service (and its HTTP
+    connection) is built once per thread and reused.
+
+    Returns:
+        Resource: Drive v3 service
+    """
+    credentials = get_cached_credentials()
+
+    service = getattr(_local, 'service', None)
+    if service is None or getattr(_local, 'credentials', None) is not credentials:
+        http = AuthorizedHttp(credentials, http=_TimedHttp(timeout=60))
+        service = build('drive', 'v3', http=http, cache_discovery=False)
+        _local.service = service
+        _local.credentials = credentials
+
+    return service
+
+def reset_drive_service():
+    """Drop the cached credentials and services, e.g. after GOOGLE_SERVICE_JSON changed"""
+    global _credentials
+    with _credentials_lock:
+        _credentials = None
+    _local.__dict__.clear()
+
+def _json_filename(filename: Optional[str]) -> str:
+    # If no filename provided, use timestamp
+    if not filename:
+        timestamp = int(time.time())
+        return f"data_{timestamp}.json"
+    if not filename.endswith('.json'):
+        return filename + '.json'
+    return filename
+
+def _upload_bytes(service, payload: bytes, filename: str, folder_id: str, mime_type: str) -> dict:
+    # Prepare the file metadata
+    file_metadata = {
+        'name': filename,
+        'parents': [folder_id],
+        'mimeType': mime_type
+    }
+
+    # Small payloads go up from memory in one request, no temp file and no resumable session
+    media = MediaIoBaseUpload(
+        io.BytesIO(payload),
+        mimetype=mime_type,
+        resumable=len(payload) > SIMPLE_UPLOAD_MAX_BYTES
+    )
+
+    # Execute the upload
+    file = service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields='id, name, webViewLink'
+    ).execute()
+
+    return {
+        'success': True,
+        'file_id': file.get('id'),
+        'name': file.get('name'),
+        'web_link': file.get('webViewLink')
+    }
+
+def upload_file_to_drive(file_path: str, folder_id: str = DEFAULT_FOLDER_ID, mime_type: str = None) -> dict:
     """
     Upload a file to a specific Google Drive folder using service account credentials.
-    
+
     Args:
         file_path (str): Path to the file to upload
         folder_id (str): ID of the Google Drive folder to upload to
         mime_type (str, optional): MIME type of the file. If None, will be guessed
-        
+
     Returns:
         dict: Response from Google Drive API containing file details
     """
     try:
-        # Get credentials using the JSON string from environment
-        credentials = get_credentials()
-        
-        # Build the Drive API service
-        service = build('drive', 'v3', credentials=credentials)
-        
+        service = get_drive_service()
+
         # Prepare the file metadata
         file_metadata = {
             'name': os.path.basename(file_path),
             'parents': [folder_id]
         }
-        
-        # Create the media file upload object
+
+        # Create the media file upload object, only files too big for one request need a resumable upload
         media = MediaFileUpload(
             file_path,
             mimetype=mime_type,
-            resumable=True
+            resumable=os.path.getsize(file_path) > SIMPLE_UPLOAD_MAX_BYTES
         )
-        
+
         # Execute the upload
         file = service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id, name, webViewLink'
         ).execute()
-        
+
         return {
             'success': True,
             'file_id': file.get('id'),
             'name': file.get('name'),
             'web_link': file.get('webViewLink')
         }
-        
+
     except Exception as e:
         return {
             'success': False,
             'error': str(e)
         }
 
+# Only ask Drive for the fields we use, the default response carries a lot more
+FILE_FIELDS = "id, name, mimeType, webViewLink, createdTime, modifiedTime, parents"
+
+# Where the changes API start page token is kept between runs
+DELTA_STATE_DIR = os.getenv("DRIVE_DELTA_STATE_DIR", os.path.join(os.getcwd(), ".cache", "drive"))
+
+def iter_files_in_folder(folder_id: str, page_size: int = 1000, fields: str = FILE_FIELDS) -> Iterator[dict]:
+    """
+    Stream every file in a Google Drive folder, one page at a time.
+
+    Args:
+        folder_id (str): ID of the Google Drive folder
+        page_size (int): Files per page, Drive caps this at 1000
+        fields (str): Field mask for each file
+
+    Yields:
+        dict: file details
+    """
+    service = get_drive_service()
+    page_token = None
+
+    while True:
+        results = service.files().list(
+            q=f"'{folder_id}' in parents and trashed = false",
+            pageSize=page_size,
+            pageToken=page_token,
+            fields=f"nextPageToken, files({fields})"
+        ).execute()
+
+        yield from results.get('files', [])
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
 def list_files_in_folder(folder_id: str) -> dict:
     """
     List all files in a specific Google Drive folder.
-    
+
     Args:
         folder_id (str): ID of the Google Drive folder
-        
+
     Returns:
         dict: List of files with their details
     """
     try:
-        # Get credentials using the JSON string from environment
-        credentials = get_credentials()
-        
-        service = build('drive', 'v3', credentials=credentials)
-        
-        # Query files in the specified folder
-        results = service.files().list(
-            q=f"'{folder_id}' in parents",
-            pageSize=100,
-            fields="files(id, name, mimeType, webViewLink, createdTime)"
+        # Follow every page, a single page used to drop everything past the first 100 files
+        return {
+            'success': True,
+            'files': list(iter_files_in_folder(folder_id))
+        }
+
+    except Exception as e:
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+def _delta_state_path(folder_id: str, state_dir: str = None) -> str:
+    return os.path.join(state_dir or DELTA_STATE_DIR, f"{folder_id}.page_token.json")
+
+def _save_page_token(path: str, page_token: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'page_token': page_token, 'saved_at': time.time()}, f)
+    os.replace(tmp_path, path)
+
+def iter_folder_changes(folder_id: str, page_token: str, fields: str = FILE_FIELDS):
+    """
+    Stream the changes to files in a folder since page_token with the Drive changes API.
+
+    Yields:
+        tuple: ('change', file) or ('removed', file_id) for every change, then ('token', new_start_page_token)
+    """
+    service = get_drive_service()
+
+    while page_token:
+        results = service.changes().list(
+            pageToken=page_token,
+            pageSize=1000,
+            includeRemoved=True,
+            spaces='drive',
+            fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({fields}, trashed))"
         ).execute()
-        
+
+        for change in results.get('changes', []):
+            file = change.get('file') or {}
+            if change.get('removed') or file.get('trashed'):
+                yield 'removed', change['fileId']
+            elif folder_id in file.get('parents', []):
+                yield 'change', file
+
+        if results.get('newStartPageToken'):
+            yield 'token', results['newStartPageToken']
+        page_token = results.get('nextPageToken')
+
+def sync_folder_changes(folder_id: str, state_dir: str = None) -> dict:
+    """
+    Return only the files added or changed in a folder since the last committed token.
+
+    Without a committed token the whole folder is listed, after that only the
+    changes API is read. Nothing is saved here: once the caller has handled
+    the files it passes the returned page_token to commit_folder_changes, so
+    a run that fails halfway sees the same changes again.
+
+    Args:
+        folder_id (str): ID of the Google Drive folder
+        state_dir (str, optional): Where the page token is stored
+
+    Returns:
+        dict: changed files, removed file ids, whether it was a full listing
+        and the page_token to commit
+    """
+    path = _delta_state_path(folder_id, state_dir)
+
+    try:
+        page_token = None
+        if os.path.exists(path):
+            with open(path) as f:
+                page_token = json.load(f).get('page_token')
+
+        if not page_token:
+            # Take the token before listing so nothing added during the listing is missed
+            start_token = get_drive_service().changes().getStartPageToken().execute()['startPageToken']
+            files = list(iter_files_in_folder(folder_id))
+            return {
+                'success': True,
+                'full_sync': True,
+                'files': files,
+                'removed': [],
+                'page_token': start_token
+            }
+
+        changed, removed = {}, []
+        new_token = page_token
+        for kind, value in iter_folder_changes(folder_id, page_token):
+            if kind == 'change':
+                changed[value['id']] = value
+            elif kind == 'removed':
+                # Drive doesn't tell us the parents of removed files, the caller filters by id
+                changed.pop(value, None)
+                removed.append(value)
+            else:
+                new_token = value
+
         return {
             'success': True,
-            'files': results.get('files', [])
+            'full_sync': False,
+            'files': list(changed.values()),
+            'removed': removed,
+            'page_token': new_token
         }
-        
+
     except Exception as e:
         return {
             'success': False,
             'error': str(e)
         }
 
-def upload_json_to_drive(json_data: dict, folder_id: str="1l-wV54W5S6b8cTMD-qbGp4hlkNN7txvh", filename: str = None) -> dict:
+def commit_folder_changes(folder_id: str, page_token: str, state_dir: str = None):
+    """Save the page_token of a sync_folder_changes result, call it after its files were handled"""
+    _save_page_token(_delta_state_path(folder_id, state_dir), page_token)
+
+def download_json_from_drive(file_id: str) -> Optional[dict]:
+    """
+    Download and parse a JSON file from Google Drive.
+
+    Args:
+        file_id (str): ID of the file
+
+    Returns:
+        dict or None: the parsed JSON, None if it couldn't be read
+    """
+    try:
+        service = get_drive_service()
+        content = service.files().get_media(fileId=file_id).execute()
+        return json.loads(content)
+
+    except Exception as e:
+        log.error(f"Error downloading {file_id} from Drive: {e}")
+        return None
+
+def upload_json_to_drive(json_data: dict, folder_id: str = DEFAULT_FOLDER_ID, filename: str = None) -> dict:
     """
     Upload JSON data directly to a specific Google Drive folder.
-    
+
     Args:
         json_data (dict): The JSON data to upload
         folder_id (str): ID of the Google Drive folder to upload to
         filename (str, optional): Name for the file. If None, uses timestamp
-        
+
     Returns:
         dict: Response from Google Drive API containing file details
     """
     try:
-        # Get credentials using the JSON string from environment
-        credentials = get_credentials()
-        
-        # Build the Drive API service
-        service = build('drive', 'v3', credentials=credentials)
-        
-        # Create a temporary file with the JSON data
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp_file:
-            json.dump(json_data, temp_file, indent=2)
-            temp_file_path = temp_file.name
-        
-        try:
-            # If no filename provided, use timestamp
-            if not filename:
-                timestamp = int(time.time())
-                filename = f"data_{timestamp}.json"
-            elif not filename.endswith('.json'):
-                filename += '.json'
-            
-            # Prepare the file metadata
-            file_metadata = {
-                'name': filename,
-                'parents': [folder_id],
-                'mimeType': 'application/json'
-            }
-            
-            # Create the media file upload object
-            media = MediaFileUpload(
-                temp_file_path,
-                mimetype='application/json',
-                resumable=True
-            )
-            
-            # Execute the upload
-            file = service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id, name, webViewLink'
-            ).execute()
-            
-            return {
-                'success': True,
-                'file_id': file.get('id'),
-                'name': file.get('name'),
-                'web_link': file.get('webViewLink')
-            }
-            
-        finally:
-            # Clean up the temporary file
-            os.unlink(temp_file_path)
-            
+        service = get_drive_service()
+        payload = json.dumps(json_data, indent=2).encode('utf-8')
+        return _upload_bytes(service, payload, _json_filename(filename), folder_id, 'application/json')
+
     except Exception as e:
         return {
             'success': False,
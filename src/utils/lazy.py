@@ -0,0 +1,64 @@
+from typing import Dict, Optional
+import importlib
+import threading
+import time
+
+
+# Provider SDKs (llama_index, google.genai, googleapiclient, ...) take seconds
+# to import, and a worker only needs the ones its task queues use. Modules
+# keep module level names for them, so call sites and mock.patch.object stay
+# the same, but the import happens on first use:
+#
+#     Anthropic = lazy_import("llama_index.llms.anthropic", "Anthropic")
+#     genai = lazy_import("google.genai")
+#
+# Classes that subclass an SDK class can't be deferred this way, those
+# modules are imported inside the functions that need them instead.
+
+_lock = threading.RLock()
+_import_seconds: Dict[str, float] = {}
+
+
+class LazyImport:
+    """Stand-in for a module, or a name in a module, imported on first attribute access or call"""
+
+    def __init__(self, module: str, name: Optional[str] = None):
+        self._module = module
+        self._name = name
+        self._target = None
+
+    def resolve(self):
+        if self._target is None:
+            with _lock:
+                if self._target is None:
+                    started = time.perf_counter()
+                    target = importlib.import_module(self._module)
+                    if self._name:
+                        target = getattr(target, self._name)
+                    _import_seconds.setdefault(self._module, time.perf_counter() - started)
+                    self._target = target
+        return self._target
+
+    def __getattr__(self, attribute):
+        # Only called for attributes the proxy itself doesn't have
+        if attribute.startswith("__"):
+            raise AttributeError(attribute)
+        return getattr(self.resolve(), attribute)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        target = f"{self._module}.{self._name}" if self._name else self._module
+        state = "loaded" if self._target is not None else "not loaded"
+        return f"<lazy {target} ({state})>"
+
+
+def lazy_import(module: str, name: Optional[str] = None) -> LazyImport:
+    return LazyImport(module, name)
+
+
+def lazy_import_seconds() -> Dict[str, float]:
+    """Seconds spent importing each deferred module on first use, in this process"""
+    with _lock:
+        return dict(_import_seconds)
@@ -0,0 +1,32 @@
+from contextlib import contextmanager
+import os
+import threading
+
+
+# Worker process state used for graceful shutdown. On shutdown a worker stops
+# polling its task queues (see src/services.py), so new runs go to the other
+# workers, and the runs already in flight get DRAIN_SECONDS to finish before
+# they are cancelled. The count of in-flight runs is kept here for the logs.
+
+# Seconds a worker may take to finish its in-flight runs after SIGTERM
+DRAIN_SECONDS = float(os.getenv("WORKER_DRAIN_SECONDS", "60"))
+
+_lock = threading.Lock()
+_in_flight = 0
+
+
+def in_flight() -> int:
+    return _in_flight
+
+
+@contextmanager
+def function_run(name: str):
+    """Count the run as in flight"""
+    global _in_flight
+    with _lock:
+        _in_flight += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _in_flight -= 1
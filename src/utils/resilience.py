@@ -0,0 +1,292 @@
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+import asyncio
+import os
+import random
+import threading
+import time
+
+from restack_ai.function import FunctionFailure
+
+from src.utils.telemetry import record_circuit_state, record_provider_call
+
+
+# Shared resilience layer for calls to external providers (Anthropic,
+# LlamaCloud, Perplexity, Gemini).
+#
+#     nodes = await call_provider("llamacloud", lambda: retriever.aretrieve(bundle), hedge=True)
+#
+# Every call goes through the provider's circuit breaker, transient errors
+# (429, 5xx, timeouts, dropped connections) are retried with exponential
+# backoff and full jitter, and idempotent calls can be hedged: when the first
+# attempt is slower than hedge_after_seconds a second one is started and the
+# first to succeed wins. Errors that survive all of that end up as a
+# FunctionFailure that is only marked non retryable when retrying can't help.
+#
+# Provider SDKs aren't imported here, errors are classified by their status
+# code and class names so the layer works for every client library.
+
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504, 529}
+
+_RETRYABLE_ERROR_NAMES = {
+    "RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError",
+    "OverloadedError", "ServiceUnavailableError", "ServerError",
+    "TimeoutException", "ConnectError", "ReadTimeout", "ConnectTimeout", "RemoteProtocolError",
+    "ServerDisconnectedError", "ClientConnectorError", "ClientOSError",
+}
+
+# Turns hedging off everywhere, e.g. when a provider bills per request
+HEDGING_ENABLED = os.getenv("PROVIDER_HEDGING", "1") != "0"
+
+
+@dataclass(frozen=True)
+class ProviderPolicy:
+    # Attempts in this function call, including the first one
+    attempts: int = 3
+    backoff_seconds: float = 0.5
+    backoff_max_seconds: float = 10.0
+    # Start a second identical request when the first one is slower than this,
+    # only for calls made with hedge=True. None disables hedging
+    hedge_after_seconds: Optional[float] = None
+    # Consecutive transient failures that open the circuit
+    failure_threshold: int = 5
+    # How long an open circuit rejects calls before it lets one trial through
+    reset_seconds: float = 30.0
+
+
+PROVIDER_POLICIES: Dict[str, ProviderPolicy] = {
+    "anthropic": ProviderPolicy(attempts=3, backoff_seconds=1.0),
+    "llamacloud": ProviderPolicy(attempts=3, hedge_after_seconds=float(os.getenv("LLAMACLOUD_HEDGE_SECONDS", "2.0"))),
+    "perplexity": ProviderPolicy(attempts=2, backoff_seconds=1.0),
+    "gemini": ProviderPolicy(attempts=2, backoff_seconds=1.0),
+}
+
+
+def policy_for(provider: str) -> ProviderPolicy:
+    return PROVIDER_POLICIES.get(provider, ProviderPolicy())
+
+
+# -- error classification -------------------------------------------------------
+
+def _status_code(error: BaseException) -> Optional[int]:
+    for holder in (error, getattr(error, "response", None)):
+        for name in ("status_code", "status"):
+            value = getattr(holder, name, None)
+            if isinstance(value, int):
+                return value
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """True for errors that are likely to go away on their own (rate limits, overload, timeouts)"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+
+    if any(cls.__name__ in _RETRYABLE_ERROR_NAMES for cls in type(error).__mro__):
+        return True
+
+    # llama_index and the SDKs like to wrap the interesting error
+    cause = error.__cause__ or error.__context__
+    return cause is not None and cause is not error and is_retryable(cause)
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """The Retry-After header of a 429 / 503 response, if the error carries one"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(policy: ProviderPolicy, attempt: int) -> float:
+    """Full jitter: uniform between 0 and the exponential backoff for this attempt"""
+    return random.uniform(0, min(policy.backoff_max_seconds, policy.backoff_seconds * 2 ** attempt))
+
+
+# -- circuit breaker ------------------------------------------------------------
+
+class CircuitOpenError(Exception):
+    def __init__(self, provider: str, retry_in: float):
+        super().__init__(f"{provider} circuit is open, retry in {retry_in:.1f}s")
+        self.provider = provider
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Per process breaker for one provider.
+
+    closed: calls go through, consecutive transient failures are counted.
+    open: calls fail fast with CircuitOpenError for reset_seconds.
+    half_open: one trial call goes through, its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, provider: str, policy: ProviderPolicy):
+        self.provider = provider
+        self.policy = policy
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        self.state = state
+        record_circuit_state(self.provider, state)
+
+    def before_call(self) -> bool:
+        """Raises CircuitOpenError if the call can't go through, True if it is the half open trial"""
+        with self._lock:
+            if self.state == "closed":
+                return False
+            retry_in = self.opened_at + self.policy.reset_seconds - time.monotonic()
+            if self.state == "open" and retry_in <= 0:
+                self._set_state("half_open")
+            if self.state == "half_open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            raise CircuitOpenError(self.provider, max(retry_in, 0.0))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.trial_running = False
+            if self.state != "closed":
+                self._set_state("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == "half_open" or self.failures >= self.policy.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state("open")
+
+    def abandon_trial(self):
+        """The call ended without an outcome (cancelled), let the next call be the trial"""
+        with self._lock:
+            self.trial_running = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider: str, policy: Optional[ProviderPolicy] = None) -> CircuitBreaker:
+    """The provider's breaker, created with the given (or registered) policy on first use"""
+    with _breakers_lock:
+        breaker = _breakers.get(provider)
+        if breaker is None:
+            breaker = _breakers[provider] = CircuitBreaker(provider, policy or policy_for(provider))
+        return breaker
+
+
+def circuit_states() -> Dict[str, str]:
+    with _breakers_lock:
+        return {provider: breaker.state for provider, breaker in _breakers.items()}
+
+
+# -- calls ----------------------------------------------------------------------
+
+async def _hedged(provider: str, call: Callable[[], Awaitable], hedge_after: Optional[float]):
+    first = asyncio.ensure_future(call())
+    if hedge_after is None:
+        return await first
+
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if done:
+            return first.result()
+
+        record_provider_call(provider, "hedged")
+        tasks.add(asyncio.ensure_future(call()))
+
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # The slower request (or both, if we were cancelled) isn't needed anymore
+        for task in tasks:
+            task.cancel()
+
+
+async def call_provider(provider: str, call: Callable[[], Awaitable], hedge: bool = False, policy: Optional[ProviderPolicy] = None):
+    """
+    Await call() with the provider's circuit breaker, retries and optional hedging.
+
+    Args:
+        provider (str): Provider name, picks the policy and the breaker
+        call (Callable): Returns a new awaitable on every invocation
+        hedge (bool): The call is idempotent and may run twice at once
+        policy (ProviderPolicy, optional): Overrides PROVIDER_POLICIES
+
+    Returns:
+        Whatever the awaitable returns
+    """
+    policy = policy or policy_for(provider)
+    breaker = get_breaker(provider, policy)
+    hedge_after = policy.hedge_after_seconds if hedge and HEDGING_ENABLED else None
+
+    attempt = 0
+    while True:
+        try:
+            trial = breaker.before_call()
+        except CircuitOpenError:
+            record_provider_call(provider, "circuit_open")
+            raise
+
+        try:
+            result = await _hedged(provider, call, hedge_after)
+        except Exception as e:
+            retryable = is_retryable(e)
+            if retryable:
+                breaker.record_failure()
+            else:
+                # The provider answered, it just didn't like the request
+                breaker.record_success()
+
+            attempt += 1
+            if not retryable or attempt >= policy.attempts:
+                record_provider_call(provider, "error")
+                raise
+
+            record_provider_call(provider, "retry")
+            # A Retry-After of minutes would outlive the step, never wait longer than the backoff cap
+            delay = retry_after_seconds(e)
+            await asyncio.sleep(min(delay, policy.backoff_max_seconds) if delay is not None else backoff_delay(policy, attempt))
+            continue
+        except BaseException:
+            # Cancelled, a half open circuit would otherwise wait forever for this trial
+            if trial:
+                breaker.abandon_trial()
+            raise
+
+        breaker.record_success()
+        record_provider_call(provider, "ok")
+        return result
+
+
+def provider_failure(message: str, error: BaseException) -> FunctionFailure:
+    """
+    FunctionFailure for an error that made it through call_provider.
+
+    Transient errors stay retryable so Restack retries the step (the workflow's
+    timeouts bound how long), everything else, including an open circuit, fails
+    the step right away so the workflow can fall back to another source.
+    """
+    return FunctionFailure(f"{message}: {str(error)}", non_retryable=not is_retryable(error))
@@ -0,0 +1,147 @@
+from concurrent.futures import CancelledError, Future
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+import threading
+import time
+
+
+@dataclass
+class SingleFlightStats:
+    # Requests that did the work themselves
+    leaders: int = 0
+    # Requests that attached to an in-flight call instead
+    coalesced: int = 0
+    failures: int = 0
+    in_flight: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+        }
+
+
+class Call:
+    """One in-flight call, shared by the leader and every caller that attached to it"""
+
+    def __init__(self, key: str, info: Any = None):
+        self.key = key
+        # Whatever the leader wants followers to know, e.g. the workflow id to stream from
+        self.info = info
+        self.started_at = time.time()
+        self.followers = 0
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> Any:
+        """Block until the leader finishes and return its result, or raise its error"""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"In-flight call '{self.key}' did not finish within {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """
+    Thread safe single-flight deduplication.
+
+    The first caller for a key becomes the leader and does the work, callers
+    that arrive while it is running get the same Call and wait for its result.
+    Once the leader completes the key is released, so the next caller starts
+    a fresh call.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, Call] = {}
+        self._lock = threading.Lock()
+        self.stats = SingleFlightStats()
+
+    def begin(self, key: str, info: Any = None) -> Tuple[Call, bool]:
+        """
+        Join the in-flight call for key or start a new one.
+
+        Returns:
+            Tuple[Call, bool]: the call and whether this caller is its leader
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                self.stats.coalesced += 1
+                return call, False
+
+            call = Call(key, info)
+            self._calls[key] = call
+            self.stats.leaders += 1
+            self.stats.in_flight = len(self._calls)
+            return call, True
+
+    def complete(self, call: Call, result: Any = None, error: Optional[BaseException] = None):
+        """Publish the leader's result to the followers and release the key"""
+        call.result = result
+        call.error = error
+        with self._lock:
+            if self._calls.get(call.key) is call:
+                del self._calls[call.key]
+            if error is not None:
+                self.stats.failures += 1
+            self.stats.in_flight = len(self._calls)
+        call._done.set()
+
+    def share(self, key: str, start: Callable[[], Future], info: Any = None) -> Tuple[Call, bool]:
+        """
+        Like begin, but the leader's work is a Future returned by start().
+
+        The call completes when the Future does, on whatever thread resolves
+        it, so followers don't depend on the leader's thread staying around
+        until the result arrives.
+
+        Returns:
+            Tuple[Call, bool]: the call and whether this caller is its leader
+        """
+        call, leader = self.begin(key, info)
+        if not leader:
+            return call, False
+
+        try:
+            future = start()
+        except BaseException as e:
+            self.complete(call, error=e)
+            raise
+
+        def resolved(future: Future):
+            if future.cancelled():
+                self.complete(call, error=CancelledError())
+            elif future.exception() is not None:
+                self.complete(call, error=future.exception())
+            else:
+                self.complete(call, result=future.result())
+
+        future.add_done_callback(resolved)
+        return call, True
+
+    def do(self, key: str, fn: Callable[[], Any], info: Any = None) -> Tuple[Any, bool]:
+        """
+        Run fn once for all concurrent callers with the same key.
+
+        Returns:
+            Tuple[Any, bool]: the result and whether it came from another caller's call
+        """
+        call, leader = self.begin(key, info)
+        if not leader:
+            return call.wait(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self.complete(call, error=e)
+            raise
+        self.complete(call, result=result)
+        return result, False
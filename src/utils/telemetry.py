@@ -0,0 +1,486 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+from opentelemetry import trace
+from opentelemetry.trace import NonRecordingSpan, SpanContext, Status, StatusCode, TraceFlags
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from src.utils import lifecycle
+
+
+# Cross-cutting instrumentation for the Restack functions.
+#
+# Every @function.defn is wrapped with @instrument, which times the call, reads
+# how long it sat in the task queue and opens an OpenTelemetry span. Anything
+# that happens inside the call (LLM requests, retrievals, HTTP requests,
+# waits for the blocking thread pool) reports to the call through a context
+# variable, so the metrics are labelled with the function they belong to.
+#
+# Spans of one workflow share a trace id derived from the workflow id, so a
+# tracing backend shows all functions of one answer in one trace. Spans are
+# only exported when an OpenTelemetry SDK is configured (e.g. with
+# opentelemetry-instrument and the OTEL_* environment variables).
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# USD per million tokens. cache_read / cache_write are the Anthropic prompt
+# cache, billed at 0.1x and 1.25x the input price when not listed. Models
+# that aren't listed get no cost, add or override prices with e.g.
+# LLM_PRICES='{"claude-3-5-haiku-20241022": {"input": 0.8, "output": 4}}'
+LLM_PRICES = {
+    "claude-3-5-sonnet-20240620": {"input": 3.0, "output": 15.0, "cache_read": 0.3, "cache_write": 3.75},
+    "gemini-2.0-flash-exp": {"input": 0.1, "output": 0.4},
+    **json.loads(os.getenv("LLM_PRICES", "{}")),
+}
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+FUNCTION_SECONDS = Histogram(
+    "restack_function_seconds", "Wall time of a Restack function call",
+    ["function", "status"], buckets=_LATENCY_BUCKETS,
+)
+FUNCTION_QUEUED_SECONDS = Histogram(
+    "restack_function_queued_seconds", "Time between the workflow scheduling the function and a worker starting it",
+    ["function"], buckets=_LATENCY_BUCKETS,
+)
+FUNCTION_IN_PROGRESS = Gauge(
+    "restack_function_in_progress", "Function calls currently executing on this worker", ["function"],
+)
+BLOCKING_QUEUE_SECONDS = Histogram(
+    "blocking_pool_queue_seconds", "Time a blocking call waited for a free thread in the shared pool",
+    ["function"], buckets=_LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "LLM tokens by direction (input / output, cache_read / cache_write for prompt caching)",
+    ["function", "model", "direction"],
+)
+LLM_COST = Counter(
+    "llm_cost_usd_total", "Estimated LLM spend in USD, the recorded token usage priced with LLM_PRICES",
+    ["function", "model"],
+)
+LLM_SECONDS = Histogram(
+    "llm_request_seconds", "Latency of one LLM request", ["function", "model"], buckets=_LATENCY_BUCKETS,
+)
+RETRIEVAL_HITS = Histogram(
+    "rag_retrieval_hits", "Nodes returned by one retrieval, kind is candidates (before fusion) or returned",
+    ["function", "kind"], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+HTTP_SECONDS = Histogram(
+    "external_http_seconds", "Latency of requests to external services",
+    ["function", "service", "status"], buckets=_LATENCY_BUCKETS,
+)
+RETRIEVAL_CACHE = Counter(
+    "rag_retrieval_cache_total", "Retrieval cache lookups by tier that answered (memory, disk) or miss",
+    ["function", "tier"],
+)
+SEMANTIC_CACHE = Counter(
+    "semantic_cache_total",
+    "Semantic cache lookups by outcome (exact_hit, similar_hit, miss) and entries stored, evicted, expired or invalidated",
+    ["function", "event"],
+)
+RAG_ENGINE_CACHE = Counter(
+    "rag_engine_cache_total", "Query engine cache lookups by outcome (hit, miss) and engines dropped (invalidated)",
+    ["function", "event"],
+)
+RAG_ENGINE_BUILD_SECONDS = Histogram(
+    "rag_engine_build_seconds", "Time to build one RAG query engine", buckets=_LATENCY_BUCKETS,
+)
+RAG_ENGINES = Gauge(
+    "rag_engines_cached", "Query engines held by the engine cache of this worker",
+)
+RAG_FUSION_SECONDS = Histogram(
+    "rag_fusion_stage_seconds", "Time spent in one stage of the local fusion (retrieve, normalize, blend, mmr, fusion)",
+    ["function", "stage"], buckets=_LATENCY_BUCKETS,
+)
+EMBEDDINGS = Counter(
+    "embeddings_total", "Texts embedded by the embedding service, reused from the store or computed, and store errors",
+    ["function", "source"],
+)
+PROVIDER_CALLS = Counter(
+    "provider_calls_total", "Calls through the resilience layer by outcome (ok, retry, hedged, error, circuit_open)",
+    ["function", "provider", "outcome"],
+)
+PROVIDER_CIRCUIT_STATE = Gauge(
+    "provider_circuit_state", "Circuit breaker state per provider, 0 closed, 1 half open, 2 open", ["provider"],
+)
+
+tracer = trace.get_tracer("trieoverflow")
+
+
+@dataclass
+class CallTelemetry:
+    """What one function call has used so far, ends up on its span"""
+
+    function: str
+    workflow_id: Optional[str] = None
+    span: object = None
+    llm_input_tokens: int = 0
+    llm_output_tokens: int = 0
+    llm_cache_read_tokens: int = 0
+    llm_cache_write_tokens: int = 0
+    llm_seconds: float = 0.0
+    llm_cost_usd: float = 0.0
+    retrieval_hits: int = 0
+    http_requests: int = 0
+    http_seconds: float = 0.0
+    blocking_queue_seconds: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, **amounts):
+        # Blocking calls report from pool threads, so the updates need the lock
+        with self._lock:
+            for name, amount in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+    def attributes(self) -> Dict[str, float]:
+        return {
+            "llm.input_tokens": self.llm_input_tokens,
+            "llm.output_tokens": self.llm_output_tokens,
+            "llm.cache_read_tokens": self.llm_cache_read_tokens,
+            "llm.cache_write_tokens": self.llm_cache_write_tokens,
+            "llm.seconds": round(self.llm_seconds, 4),
+            "llm.cost_usd": round(self.llm_cost_usd, 6),
+            "rag.retrieval_hits": self.retrieval_hits,
+            "http.requests": self.http_requests,
+            "http.seconds": round(self.http_seconds, 4),
+            "blocking_pool.queue_seconds": round(self.blocking_queue_seconds, 4),
+        }
+
+
+_current_call: ContextVar[Optional[CallTelemetry]] = ContextVar("current_call", default=None)
+
+
+def current_call() -> Optional[CallTelemetry]:
+    return _current_call.get()
+
+
+def _function_label() -> str:
+    call = _current_call.get()
+    return call.function if call else "none"
+
+
+def _activity_info():
+    """Temporal activity info of the running function, None when called outside a worker"""
+    try:
+        from temporalio import activity
+        return activity.info()
+    except Exception:
+        return None
+
+
+def _workflow_parent(workflow_id: Optional[str]):
+    """Remote parent context whose trace id is derived from the workflow id"""
+    if not workflow_id:
+        return None
+    digest = hashlib.sha256(workflow_id.encode("utf-8")).digest()
+    parent = SpanContext(
+        trace_id=int.from_bytes(digest[:16], "big") or 1,
+        span_id=int.from_bytes(digest[16:24], "big") or 1,
+        is_remote=True,
+        trace_flags=TraceFlags(TraceFlags.SAMPLED),
+    )
+    return trace.set_span_in_context(NonRecordingSpan(parent))
+
+
+@contextmanager
+def _function_call(name: str):
+    info = _activity_info()
+    workflow_id = getattr(info, "workflow_id", None)
+
+    if info is not None and info.started_time and info.current_attempt_scheduled_time:
+        queued = (info.started_time - info.current_attempt_scheduled_time).total_seconds()
+        FUNCTION_QUEUED_SECONDS.labels(name).observe(max(queued, 0.0))
+
+    with tracer.start_as_current_span(f"function {name}", context=_workflow_parent(workflow_id)) as span:
+        call = CallTelemetry(function=name, workflow_id=workflow_id, span=span)
+        if info is not None:
+            span.set_attribute("workflow.id", info.workflow_id)
+            span.set_attribute("workflow.run_id", info.workflow_run_id)
+            span.set_attribute("function.attempt", info.attempt)
+
+        token = _current_call.set(call)
+        FUNCTION_IN_PROGRESS.labels(name).inc()
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            yield call
+        except BaseException as e:
+            status = "error"
+            span.record_exception(e)
+            span.set_status(Status(StatusCode.ERROR, str(e)))
+            raise
+        finally:
+            FUNCTION_SECONDS.labels(name, status).observe(time.perf_counter() - started)
+            FUNCTION_IN_PROGRESS.labels(name).dec()
+            span.set_attributes(call.attributes())
+            _current_call.reset(token)
+
+
+def instrument(fn):
+    """
+    Wrap a Restack function with timing, queue time, metrics and a span.
+    Also counts the run as in flight for the shutdown logs, see src/utils/lifecycle.py.
+
+    Goes right below @function.defn() so the registered function keeps its
+    name and signature.
+    """
+    name = fn.__name__
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with lifecycle.function_run(name), _function_call(name):
+                return await fn(*args, **kwargs)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with lifecycle.function_run(name), _function_call(name):
+                return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def _child_span(name: str, seconds: float, attributes: dict):
+    """Span for something that already happened, started `seconds` ago"""
+    end = time.time_ns()
+    span = tracer.start_span(name, start_time=end - int(seconds * 1e9), attributes=attributes)
+    span.end(end_time=end)
+
+
+def llm_cost(model: str, input_tokens: int, output_tokens: int, cache_read_tokens: int = 0, cache_write_tokens: int = 0) -> Optional[float]:
+    """USD cost of one request from LLM_PRICES, None when the model has no price"""
+    prices = LLM_PRICES.get(model)
+    if prices is None:
+        return None
+    input_price = prices["input"]
+    return (
+        input_tokens * input_price
+        + output_tokens * prices["output"]
+        + cache_read_tokens * prices.get("cache_read", input_price * 0.1)
+        + cache_write_tokens * prices.get("cache_write", input_price * 1.25)
+    ) / 1_000_000
+
+
+def record_llm(model: str, input_tokens: int, output_tokens: int, seconds: float, cache_read_tokens: int = 0, cache_write_tokens: int = 0):
+    """
+    input_tokens are the uncached prompt tokens, Anthropic reports the ones
+    read from or written to the prompt cache separately
+    """
+    function = _function_label()
+    LLM_TOKENS.labels(function, model, "input").inc(input_tokens)
+    LLM_TOKENS.labels(function, model, "output").inc(output_tokens)
+    if cache_read_tokens:
+        LLM_TOKENS.labels(function, model, "cache_read").inc(cache_read_tokens)
+    if cache_write_tokens:
+        LLM_TOKENS.labels(function, model, "cache_write").inc(cache_write_tokens)
+    LLM_SECONDS.labels(function, model).observe(seconds)
+    cost = llm_cost(model, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens)
+    if cost is not None:
+        LLM_COST.labels(function, model).inc(cost)
+
+    call = _current_call.get()
+    if call is not None:
+        call.add(
+            llm_input_tokens=input_tokens, llm_output_tokens=output_tokens, llm_seconds=seconds,
+            llm_cache_read_tokens=cache_read_tokens, llm_cache_write_tokens=cache_write_tokens,
+            llm_cost_usd=cost or 0.0,
+        )
+    attributes = {
+        "llm.model": model, "llm.input_tokens": input_tokens, "llm.output_tokens": output_tokens,
+        "llm.cache_read_tokens": cache_read_tokens, "llm.cache_write_tokens": cache_write_tokens,
+    }
+    if cost is not None:
+        attributes["llm.cost_usd"] = round(cost, 6)
+    _child_span(f"llm {model}", seconds, attributes)
+
+
+def record_retrieval(returned: int, candidates: Optional[int] = None):
+    function = _function_label()
+    RETRIEVAL_HITS.labels(function, "returned").observe(returned)
+    if candidates is not None:
+        RETRIEVAL_HITS.labels(function, "candidates").observe(candidates)
+
+    call = _current_call.get()
+    if call is not None:
+        call.add(retrieval_hits=returned)
+
+
+def record_retrieval_cache(tier: str):
+    RETRIEVAL_CACHE.labels(_function_label(), tier).inc()
+
+
+def record_semantic_cache(event: str, count: int = 1):
+    SEMANTIC_CACHE.labels(_function_label(), event).inc(count)
+
+
+def record_engine_cache(event: str, count: int = 1):
+    RAG_ENGINE_CACHE.labels(_function_label(), event).inc(count)
+
+
+def record_engine_build(seconds: float):
+    RAG_ENGINE_BUILD_SECONDS.observe(seconds)
+
+
+def record_engines(count: int):
+    RAG_ENGINES.set(count)
+
+
+def record_fusion(timings: Dict[str, float]):
+    """timings are the per stage milliseconds of a FusionResult"""
+    function = _function_label()
+    for stage, ms in timings.items():
+        RAG_FUSION_SECONDS.labels(function, stage.removesuffix("_ms")).observe(ms / 1000)
+
+
+def record_embeddings(reused: int, computed: int, store_errors: int = 0):
+    function = _function_label()
+    if reused:
+        EMBEDDINGS.labels(function, "reused").inc(reused)
+    if computed:
+        EMBEDDINGS.labels(function, "computed").inc(computed)
+    if store_errors:
+        EMBEDDINGS.labels(function, "store_error").inc(store_errors)
+
+
+def record_http(service: str, status, seconds: float):
+    HTTP_SECONDS.labels(_function_label(), service, str(status)).observe(seconds)
+
+    call = _current_call.get()
+    if call is not None:
+        call.add(http_requests=1, http_seconds=seconds)
+    _child_span(f"http {service}", seconds, {"http.service": service, "http.status": str(status)})
+
+
+_CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def record_provider_call(provider: str, outcome: str):
+    PROVIDER_CALLS.labels(_function_label(), provider, outcome).inc()
+
+
+def record_circuit_state(provider: str, state: str):
+    PROVIDER_CIRCUIT_STATE.labels(provider).set(_CIRCUIT_STATES[state])
+
+
+def record_blocking_queue(seconds: float):
+    BLOCKING_QUEUE_SECONDS.labels(_function_label()).observe(seconds)
+
+    call = _current_call.get()
+    if call is not None:
+        call.add(blocking_queue_seconds=seconds)
+
+
+# -- llama_index ---------------------------------------------------------------
+
+def _usage_tokens(raw) -> Optional[tuple]:
+    """
+    (input, output, cache read, cache write) tokens from an Anthropic / OpenAI
+    style raw response, None if it has no usage
+    """
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if usage is None:
+        return None
+
+    def read(*names):
+        for name in names:
+            value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+            if value is not None:
+                return int(value)
+        return 0
+
+    return (
+        read("input_tokens", "prompt_tokens"),
+        read("output_tokens", "completion_tokens"),
+        read("cache_read_input_tokens"),
+        read("cache_creation_input_tokens"),
+    )
+
+
+_llama_index_handler_installed = False
+_llama_index_handler_lock = threading.Lock()
+
+
+def install_llama_index_handler():
+    """
+    Report every llama_index LLM call (including the ones made inside the
+    response synthesizer) through record_llm.
+
+    Token counts come from the provider's usage block, streamed responses
+    that don't carry one are estimated from the text.
+
+    Called wherever a llama_index LLM is created rather than at startup, so
+    workers that never use one don't import llama_index.
+    """
+    global _llama_index_handler_installed
+    if _llama_index_handler_installed:
+        return
+    with _llama_index_handler_lock:
+        if not _llama_index_handler_installed:
+            _install_llama_index_handler()
+            _llama_index_handler_installed = True
+
+
+def _install_llama_index_handler():
+
+    from llama_index.core.instrumentation import get_dispatcher
+    from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+    from llama_index.core.instrumentation.events.llm import (
+        LLMChatEndEvent, LLMChatStartEvent, LLMCompletionEndEvent, LLMCompletionStartEvent,
+    )
+
+    from src.functions.RAG.contextBudget import count_tokens
+
+    started: Dict[str, tuple] = {}
+    lock = threading.Lock()
+
+    class TelemetryEventHandler(BaseEventHandler):
+        @classmethod
+        def class_name(cls) -> str:
+            return "TelemetryEventHandler"
+
+        def handle(self, event, **kwargs):
+            if isinstance(event, (LLMCompletionStartEvent, LLMChatStartEvent)):
+                with lock:
+                    started[event.span_id] = (time.perf_counter(), (event.model_dict or {}).get("model", "unknown"))
+                return
+
+            if not isinstance(event, (LLMCompletionEndEvent, LLMChatEndEvent)):
+                return
+
+            with lock:
+                begin, model = started.pop(event.span_id, (None, "unknown"))
+            seconds = time.perf_counter() - begin if begin is not None else 0.0
+
+            response = event.response
+            tokens = _usage_tokens(getattr(response, "raw", None) or {})
+            if tokens is None:
+                if isinstance(event, LLMChatEndEvent):
+                    prompt = "\n".join(str(m.content) for m in event.messages)
+                    text = str(response.message.content) if response is not None else ""
+                else:
+                    prompt = event.prompt
+                    text = response.text if response is not None else ""
+                tokens = (count_tokens(prompt), count_tokens(text), 0, 0)
+
+            record_llm(model, tokens[0], tokens[1], seconds, cache_read_tokens=tokens[2], cache_write_tokens=tokens[3])
+
+    get_dispatcher().add_event_handler(TelemetryEventHandler())
+
+
+def setup_telemetry(process_index: int = 0):
+    """
+    Serve /metrics when METRICS_PORT is set.
+
+    Worker process N serves on METRICS_PORT + N so several workers can share a host.
+    """
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT + process_index)
@@ -0,0 +1,11 @@
+import re
+
+
+# Text helpers without third party imports, safe to use from the Streamlit
+# frontend and the schedule scripts as well as from the workers.
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace so trivial variations map to the same text"""
+    query = re.sub(r"[^\w\s]", " ", (query or "").lower())
+    return " ".join(query.split())
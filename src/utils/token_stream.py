@@ -0,0 +1,110 @@
+import json
+import os
+import re
+import threading
+import time
+
+
+# Side channel used to push partial tokens from the functions to the frontend while
+# the workflow is still running. Every stream is an append only JSONL file, so the
+# writer (the worker) and the reader (Streamlit) only need to share STREAM_DIR.
+STREAM_DIR = os.getenv("TOKEN_STREAM_DIR", os.path.join(os.getcwd(), ".cache", "streams"))
+
+# Streams older than this are removed the next time a stream is opened
+STREAM_MAX_AGE_SECONDS = int(os.getenv("TOKEN_STREAM_MAX_AGE_SECONDS", "3600"))
+
+_lock = threading.Lock()
+
+
+def _stream_path(stream_id: str, stream_dir: str = None) -> str:
+    safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", stream_id)
+    return os.path.join(stream_dir or STREAM_DIR, f"{safe_id}.jsonl")
+
+
+def _cleanup(stream_dir: str):
+    cutoff = time.time() - STREAM_MAX_AGE_SECONDS
+    for name in os.listdir(stream_dir):
+        path = os.path.join(stream_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+class TokenStream:
+    """
+    Writer side of a token stream.
+
+    Each event is one JSON line: {"source": ..., "delta": ..., "done": ...}.
+    Lines are flushed as soon as they are written so the reader sees tokens
+    with no extra buffering delay.
+    """
+
+    def __init__(self, stream_id: str, stream_dir: str = None):
+        self.stream_dir = stream_dir or STREAM_DIR
+        os.makedirs(self.stream_dir, exist_ok=True)
+        with _lock:
+            _cleanup(self.stream_dir)
+        self.path = _stream_path(stream_id, self.stream_dir)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _write(self, event: dict):
+        with _lock:
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+
+    def publish(self, source: str, delta: str):
+        if delta:
+            self._write({"source": source, "delta": delta, "done": False})
+
+    def finish(self, source: str, error: str = None):
+        event = {"source": source, "delta": "", "done": True}
+        if error:
+            event["error"] = error
+        self._write(event)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_stream(stream_id: str):
+    """Return a TokenStream for this id, or None when streaming wasn't requested"""
+    if not stream_id:
+        return None
+    return TokenStream(stream_id)
+
+
+def read_stream(stream_id: str, offset: int = 0, stream_dir: str = None):
+    """
+    Read the events written since the last call.
+
+    Args:
+        stream_id (str): Id the workflow was started with
+        offset (int): Byte offset returned by the previous call
+
+    Returns:
+        tuple: (list of events, new offset)
+    """
+    path = _stream_path(stream_id, stream_dir)
+    if not os.path.exists(path):
+        return [], offset
+
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        f.seek(offset)
+        while True:
+            line = f.readline()
+            # A partial line means the writer is in the middle of it, pick it up next time
+            if not line or not line.endswith("\n"):
+                break
+            events.append(json.loads(line))
+            offset = f.tell()
+
+    return events, offset
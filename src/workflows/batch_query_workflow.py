@@ -0,0 +1,121 @@
+
+import asyncio
+from datetime import timedelta
+from restack_ai.workflow import workflow, log, import_functions
+
+
+
+
+with import_functions():
+    from src.functions.RAG.batchQuery import plan_query_batch, answer_query_batch
+    # Sends every step to the task queue its function is served on, see services.toml
+    from src.services_config import step_options
+
+
+
+# Chunks (answer_query_batch steps) running at the same time
+DEFAULT_CONCURRENCY = 8
+
+# One chunk is about BATCH_CHUNK_SIZE queries answered by the RAG pipeline
+CHUNK_TIMEOUT = timedelta(minutes=15)
+
+
+@workflow.defn()
+class batch_query_workflow:
+    """
+    Answer many queries in one run, e.g. to backfill historical Discord questions.
+
+    Input:
+        batch_id: names the JSONL output, starting a batch again with the same
+            id skips every query that already has an answer there
+        queries / queries_path: the queries, a list or a .txt / .jsonl / .json file
+        concurrency: chunks answered at the same time (default 8)
+        chunk_size, output_path, use_cache, fusion: optional
+
+    Returns the batch counters and the throughput in queries per minute, the
+    answers themselves go to the JSONL output.
+    """
+
+    @workflow.run
+    async def run(self, input):
+        batch_id = input["batch_id"]
+
+        plan = await workflow.step(
+            plan_query_batch,
+            {
+                "batch_id": batch_id,
+                "queries": input.get("queries"),
+                "queries_path": input.get("queries_path"),
+                "output_path": input.get("output_path"),
+                **({"chunk_size": input["chunk_size"]} if "chunk_size" in input else {}),
+            },
+            start_to_close_timeout=timedelta(minutes=5),
+            **step_options(plan_query_batch)
+        )
+
+        concurrency = max(1, input.get("concurrency", DEFAULT_CONCURRENCY))
+        totals = {"answered": 0, "failed": 0, "from_cache": 0, "retrievals": 0, "retrieval_reused": 0}
+        failed_chunks = 0
+
+        # The workflow event loop clock is deterministic, so it is safe to use for the throughput
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        def collect(done):
+            nonlocal failed_chunks
+            for task in done:
+                chunk_queries = running.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    # The queries of a failed chunk have no answer lines, a rerun picks them up
+                    log.error(f"Batch {batch_id}: chunk failed: {str(e)}")
+                    failed_chunks += 1
+                    totals["failed"] += chunk_queries
+                    continue
+                for key in totals:
+                    totals[key] += result.get(key, 0)
+
+            log.info(f"Batch {batch_id}: {totals['answered']} answered, {totals['failed']} failed of {plan['pending']}")
+
+        # Bounded fan out: at most `concurrency` chunk steps in flight
+        running = {}
+        for chunk in plan["chunks"]:
+            if len(running) >= concurrency:
+                done, _ = await asyncio.wait(set(running), return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+
+            step = workflow.step(
+                answer_query_batch,
+                {
+                    "batch_id": batch_id,
+                    "queries": chunk,
+                    "output_path": plan["output_path"],
+                    "use_cache": input.get("use_cache", True),
+                    "fusion": input.get("fusion"),
+                },
+                start_to_close_timeout=CHUNK_TIMEOUT,
+                **step_options(answer_query_batch)
+            )
+            running[asyncio.ensure_future(step)] = len(chunk)
+
+        if running:
+            done, _ = await asyncio.wait(set(running))
+            collect(done)
+
+        elapsed = loop.time() - started
+        summary = {
+            "batch_id": batch_id,
+            "output_path": plan["output_path"],
+            "total": plan["total"],
+            "unique": plan["unique"],
+            "duplicates": plan["duplicates"],
+            "already_done": plan["already_done"],
+            "chunks": len(plan["chunks"]),
+            "failed_chunks": failed_chunks,
+            **totals,
+            "elapsed_seconds": round(elapsed, 3),
+            "queries_per_minute": round(totals["answered"] * 60 / elapsed, 2) if elapsed > 0 else None,
+        }
+        log.info(f"Batch {batch_id} done", summary=summary)
+        return summary
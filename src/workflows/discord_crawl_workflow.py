@@ -0,0 +1,42 @@
+from datetime import timedelta
+from restack_ai.workflow import workflow, log, import_functions
+
+
+
+
+with import_functions():
+    from src.functions.discordAgent import crawl_discord_channel
+    # Sends every step to the task queue its function is served on, see services.toml
+    from src.services_config import step_options
+
+
+
+# The first crawl of a channel walks its whole history
+CRAWL_TIMEOUT = timedelta(minutes=30)
+# Attempts that fit in the step's overall deadline. The crawler checkpoints
+# as it goes, so a retry continues where the failed attempt stopped
+CRAWL_ATTEMPTS = 3
+
+
+@workflow.defn()
+class discord_crawl_workflow:
+    """
+    Bring the Discord snapshot discordAgent answers from up to date, run on a
+    schedule by schedule_discord_crawl.py.
+
+    Input (optional): channel_id
+    """
+
+    @workflow.run
+    async def run(self, input):
+        stats = await workflow.step(
+            crawl_discord_channel,
+            input or {},
+            start_to_close_timeout=CRAWL_TIMEOUT,
+            # workflow.step defaults to 2 minutes for all attempts together
+            schedule_to_close_timeout=CRAWL_TIMEOUT * CRAWL_ATTEMPTS,
+            **step_options(crawl_discord_channel)
+        )
+
+        log.info(f"Discord crawl: {stats}")
+        return stats
@@ -15,9 +15,12 @@ with import_functions():
     from src.functions.perplexity.perplexityAgent import perplexityAgent
     from src.functions.RAG.llamaCloudRAG import llama_cloud_rag
     from src.functions.RAG.validateRAGResponse import validate_RAG_response
+    from src.functions.cache.semanticCache import lookup_semantic_cache, store_semantic_cache
+    # Sends every step to the task queue its function is served on, see services.toml
+    from src.services_config import step_options
     # from src.functions.gen_code.restack_code_generator import restack_code_gen
 
-    
+
 
 
 
@@ -26,57 +29,231 @@ with import_functions():
 #     pass
 
 
+# Fan out settings, all of them can be overridden from the workflow input
 
-@workflow.defn()
-class query_question_workflow:
-    @workflow.run
-    async def run(self, input):
+# "fan_out" runs every source at the same time, "sequential" is the old RAG then Perplexity path
+DEFAULT_MODE = "fan_out"
 
+# "gather_all" waits for every source up to gather_timeout_seconds,
+# "first_good" returns as soon as one source gives back a usable answer
+DEFAULT_POLICY = "gather_all"
+DEFAULT_GATHER_TIMEOUT_SECONDS = 120
 
-        # First go through RAG and if you cant find similar questions anywhere,
-        #  than go through the other agents
+# Check the RAG answer against its sources before trusting it
+DEFAULT_VALIDATE = True
 
-        # For the discord message, formatting, you should definetely process the discord messages before you
-        # something with them esspecially using the "reference_message" field in the json to connect the dots
+# Per source timeouts in seconds
+DEFAULT_SOURCE_TIMEOUTS = {
+    "rag_results": 120,
+    "perplexity_response": 120,
+    "discord_response": 30,
+    "github_response": 30,
+}
 
-        # You also need to look into how to extract the threads in the messages!
 
+# The semantic cache is only a shortcut, give up on it quickly rather than
+# holding the query for the default two minute schedule_to_close
+CACHE_STEP_TIMEOUT = timedelta(seconds=10)
+CACHE_STEP_DEADLINE = timedelta(seconds=20)
 
 
-        # ANOTHER APPRIOACH
+# The answers in fallback order: Claude (RAG), then Perplexity, then an
+# expired cached answer to the same question when neither came back
+ANSWER_KEYS = ("rag_results", "perplexity_response")
 
-        # DO THE RAG else
 
-        # Use different agents and go through:
-        #  - Docs
-        #  - Perplexity
-        #  - Discord
-        #  - Github Issues
+def _is_good_answer(value) -> bool:
+    if isinstance(value, str):
+        return bool(value.strip())
+    return bool(value)
 
 
+def _is_cacheable(final_response: dict) -> bool:
+    if final_response.get("fallback") or final_response.get("rag_valid") is not True:
+        return False
+    if not _is_good_answer(final_response.get("rag_results")):
+        return False
+    return not any(status in ("cancelled", "timeout") for status in final_response.get("sources_status", {}).values())
 
-        log.info("AND IT STARTS!")
 
-        user_query = input.get("query")
+@workflow.defn()
+class query_question_workflow:
+
+    def _sources(self, user_query: str, stream_id: str = None) -> dict:
+        """Map each final_response key to the function that fills it and its input"""
+        llm_input = {"query": user_query}
+        if stream_id:
+            llm_input["stream_id"] = stream_id
+
+        return {
+            "rag_results": (llama_cloud_rag, llm_input),
+            "perplexity_response": (perplexityAgent, llm_input),
+            "discord_response": (discordAgent, {"query": user_query}),
+            "github_response": (githubIssuesAgent, None),
+        }
+
+    async def _run_source(self, name: str, function, function_input, timeout_seconds: int):
+        timeout = timedelta(seconds=timeout_seconds)
+
+        if function_input is None:
+            step = workflow.step(function, start_to_close_timeout=timeout, **step_options(function))
+        else:
+            step = workflow.step(function, function_input, start_to_close_timeout=timeout, **step_options(function))
+
+        return await asyncio.wait_for(step, timeout=timeout_seconds)
+
+    async def _validate(self, user_query: str, rag_results: dict, final_response: dict) -> bool:
+        """Run validate_RAG_response on the RAG answer and record the verdict in final_response"""
+        validate_RAG_response_input={
+            "query": user_query,
+            "response": rag_results["response"],
+            "sources": rag_results.get("sources", [])
+        }
 
+        try:
+            validated_response = await workflow.step(
+                validate_RAG_response,
+                validate_RAG_response_input,
+                start_to_close_timeout=timedelta(minutes=2),
+                **step_options(validate_RAG_response)
+            )
+        except Exception as e:
+            # Can't tell if the answer is good, let the other agents weigh in
+            log.error(f"RAG validation failed: {str(e)}")
+            final_response["rag_valid"] = None
+            return False
+
+        log.info(f"RAG validation: {validated_response['valid']} - {validated_response['reason']}")
+
+        final_response["rag_valid"] = validated_response["valid"]
+        final_response["rag_validation_reason"] = validated_response["reason"]
+        return validated_response["valid"]
+
+    async def _cached_fallback(self, user_query: str, final_response: dict) -> bool:
+        """Last resort when every provider failed, serve the cached answer even if it expired"""
+        try:
+            cached = await workflow.step(
+                lookup_semantic_cache,
+                {"query": user_query, "stale": True},
+                start_to_close_timeout=CACHE_STEP_TIMEOUT,
+                schedule_to_close_timeout=CACHE_STEP_DEADLINE,
+                **step_options(lookup_semantic_cache)
+            )
+        except Exception as e:
+            log.error(f"Cached fallback failed: {str(e)}")
+            return False
+
+        if not cached.get("hit"):
+            return False
+
+        log.info(f"Providers failed, answering from the cache, similarity {cached['similarity']}, stale {cached['stale']}")
+        for key in ANSWER_KEYS:
+            if cached["response"].get(key):
+                final_response[key] = cached["response"][key]
+        final_response["fallback"] = {
+            "source": "cache",
+            "query": cached["query"],
+            "similarity": cached["similarity"],
+            "stale": cached["stale"],
+        }
+        return True
+
+    async def _fan_out(self, user_query: str, policy: str, gather_timeout: int, source_timeouts: dict, enabled_sources, validate: bool, stream_id: str = None) -> dict:
+        final_response = {}
+        sources_status = {}
+        rag_results = None
+
+        tasks = {}
+        for name, (function, function_input) in self._sources(user_query, stream_id).items():
+            if enabled_sources and name not in enabled_sources:
+                continue
+            tasks[asyncio.ensure_future(
+                self._run_source(name, function, function_input, source_timeouts.get(name, gather_timeout))
+            )] = name
+
+        pending = set(tasks)
+        remaining = gather_timeout
+        # The workflow event loop clock is deterministic, so it is safe to use for the overall budget
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                break
+
+            found_good = False
+            for task in done:
+                name = tasks[task]
+                try:
+                    result = task.result()
+
+                    # The RAG function returns a dict, the UI only needs the answer text
+                    if name == "rag_results" and isinstance(result, dict):
+                        rag_results = result
+                        result = result.get("response")
+
+                    final_response[name] = result
+                    sources_status[name] = "ok"
+                    found_good = found_good or _is_good_answer(result)
+                    log.info(f"{name} finished")
+                except asyncio.TimeoutError:
+                    sources_status[name] = "timeout"
+                    log.error(f"{name} timed out")
+                except Exception as e:
+                    sources_status[name] = f"error: {str(e)}"
+                    log.error(f"{name} failed: {str(e)}")
+
+            if policy == "first_good" and found_good:
+                break
+
+            remaining = gather_timeout - (loop.time() - started)
+            if remaining <= 0:
+                break
+
+        # Whatever is still running is too slow, keep the partial results we have
+        for task in pending:
+            task.cancel()
+            sources_status[tasks[task]] = "cancelled"
+
+        final_response["sources_status"] = sources_status
+
+        if validate and rag_results and rag_results.get("response"):
+            await self._validate(user_query, rag_results, final_response)
+
+        return final_response
+
+    async def _sequential(self, user_query: str, validate: bool, stream_id: str = None) -> dict:
         RAG_QUERY_INPUT= {
             "query":user_query
         }
+        if stream_id:
+            RAG_QUERY_INPUT["stream_id"] = stream_id
 
 
         final_response = {}
+        sources_status = {}
 
 
-        # Call llama_cloud_rag with a sample query
-        rag_results = await workflow.step(
-            llama_cloud_rag,
-            RAG_QUERY_INPUT,
-            start_to_close_timeout=timedelta(minutes=2)
-        )
+        # Call llama_cloud_rag with a sample query, if it fails Perplexity answers instead
+        try:
+            rag_results = await workflow.step(
+                llama_cloud_rag,
+                RAG_QUERY_INPUT,
+                start_to_close_timeout=timedelta(minutes=2),
+                **step_options(llama_cloud_rag)
+            )
+            sources_status["rag_results"] = "ok"
+        except Exception as e:
+            log.error(f"RAG failed, falling back to Perplexity: {str(e)}")
+            sources_status["rag_results"] = f"error: {str(e)}"
+            rag_results = None
 
-        log.info(f"RAG Response: {rag_results['response']}")
+        if rag_results:
+            log.info(f"RAG Response: {rag_results['response']}")
 
-        final_response["rag_results"]=rag_results['response']
+            final_response["rag_results"]=rag_results['response']
 
         # Testing
 
@@ -87,42 +264,126 @@ class query_question_workflow:
 
         # VALIDATE THE RAG RESPONSE
 
-        # FIXME: MOST LIKELY EXCEED THE TOKEN LIMIT FOR THE INPUT 
+        # The sources are packed into a token budget inside the function, so this
+        # no longer blows the input limit
 
-        # validate_RAG_response_input={
-        #     "query": RAG_QUERY_INPUT["query"],
-        #     "response": rag_results["response"]
-        # }
+        rag_valid = False
+        if validate and rag_results:
+            rag_valid = await self._validate(user_query, rag_results, final_response)
 
-        # validated_response = await workflow.step(
-        #     validate_RAG_response,
-        #     validate_RAG_response_input,
-        #     start_to_close_timeout=timedelta(minutes=2)
-        # )
 
+        if not rag_valid:
 
+            # Call perplexity agent and the other agents
+            perplexity_input = {
+                "query": RAG_QUERY_INPUT["query"],
+                "stream_id": stream_id
+            }
 
+            try:
+                perplexity_response = await workflow.step(
+                    perplexityAgent,
+                    perplexity_input,
+                    start_to_close_timeout=timedelta(minutes=2),
+                    **step_options(perplexityAgent)
+                )
+                sources_status["perplexity_response"] = "ok"
 
+                log.info(f"Perplexity Response: {perplexity_response}")
 
-        # TODO: make the return from validated_response be True or False later
+                final_response["perplexity_response"] = perplexity_response
+            except Exception as e:
+                log.error(f"Perplexity failed: {str(e)}")
+                sources_status["perplexity_response"] = f"error: {str(e)}"
+
+        final_response["sources_status"] = sources_status
+        return final_response
 
+    @workflow.run
+    async def run(self, input):
+
+
+        # First go through RAG and if you cant find similar questions anywhere,
+        #  than go through the other agents
+
+        # For the discord message, formatting, you should definetely process the discord messages before you
+        # something with them esspecially using the "reference_message" field in the json to connect the dots
+
+        # You also need to look into how to extract the threads in the messages!
 
-        if(True):
 
-            # Call perplexity agent and the other agents
-            perplexity_input = {
-                "query": RAG_QUERY_INPUT["query"]
-            }
 
-            perplexity_response = await workflow.step(
-                perplexityAgent,
-                perplexity_input,
-                start_to_close_timeout=timedelta(minutes=2)
+        # ANOTHER APPRIOACH
+
+        # DO THE RAG else
+
+        # Use different agents and go through:
+        #  - Docs
+        #  - Perplexity
+        #  - Discord
+        #  - Github Issues
+
+
+
+        log.info("AND IT STARTS!")
+
+        user_query = input.get("query")
+
+        use_cache = input.get("use_cache", True)
+
+        # Serve repeated questions straight from the semantic cache
+        if use_cache:
+            try:
+                cached = await workflow.step(
+                    lookup_semantic_cache,
+                    {"query": user_query},
+                    start_to_close_timeout=CACHE_STEP_TIMEOUT,
+                    schedule_to_close_timeout=CACHE_STEP_DEADLINE,
+                    **step_options(lookup_semantic_cache)
+                )
+            except Exception as e:
+                # A broken cache must not fail the query, ask the agents instead
+                log.error(f"Semantic cache lookup failed: {str(e)}")
+                cached = {"hit": False}
+
+            if cached.get("hit"):
+                log.info(f"Answered from semantic cache, similarity {cached['similarity']}")
+                return {
+                    **cached["response"],
+                    "cache": {
+                        "hit": True,
+                        "query": cached["query"],
+                        "similarity": cached["similarity"],
+                    },
+                }
+
+        mode = input.get("mode", DEFAULT_MODE)
+        validate = input.get("validate", DEFAULT_VALIDATE)
+
+        # When the frontend passes a stream_id the LLM steps also push their tokens
+        # through the token stream side channel, the final result is unchanged
+        stream_id = input.get("stream_id")
+
+        if mode == "sequential":
+            final_response = await self._sequential(user_query, validate, stream_id)
+        else:
+            # Start every source agent at once so the latency is the slowest
+            # source (bounded by the timeouts) instead of the sum of all of them
+            final_response = await self._fan_out(
+                user_query,
+                policy=input.get("policy", DEFAULT_POLICY),
+                gather_timeout=input.get("gather_timeout_seconds", DEFAULT_GATHER_TIMEOUT_SECONDS),
+                source_timeouts={**DEFAULT_SOURCE_TIMEOUTS, **input.get("source_timeouts", {})},
+                enabled_sources=input.get("sources"),
+                validate=validate,
+                stream_id=stream_id,
             )
 
-            log.info(f"Perplexity Response: {perplexity_response}")
 
-            final_response["perplexity_response"] = perplexity_response
+
+        # Neither Claude nor Perplexity came back, try the cache before giving up
+        if use_cache and not any(_is_good_answer(final_response.get(key)) for key in ANSWER_KEYS):
+            await self._cached_fallback(user_query, final_response)
 
 
 
@@ -138,7 +399,7 @@ class query_question_workflow:
 
         #     code_gen_response = await workflow.step(
         #         restack_code_gen,
-        #         code_gen_input, 
+        #         code_gen_input,
         #         start_to_close_timeout=timedelta(minutes=2),
         #         # retry_policy=RetryPolicy(maximum_attempts=2)
         #     )
@@ -149,6 +410,22 @@ class query_question_workflow:
 
 
 
+        # Only cache RAG answers that passed validation, from a run where no
+        # source was cut short: a first_good or timed out run would be served
+        # without the sources it never waited for
+        if use_cache and _is_cacheable(final_response):
+            cacheable = {k: v for k, v in final_response.items() if k != "sources_status"}
+            try:
+                await workflow.step(
+                    store_semantic_cache,
+                    {"query": user_query, "response": cacheable},
+                    start_to_close_timeout=CACHE_STEP_TIMEOUT,
+                    schedule_to_close_timeout=CACHE_STEP_DEADLINE,
+                    **step_options(store_semantic_cache)
+                )
+            except Exception as e:
+                # The answer is ready, not caching it only costs the next asker
+                log.error(f"Semantic cache store failed: {str(e)}")
 
         return final_response
 
@@ -164,10 +441,10 @@ class query_question_workflow:
 
             # DONT FORGET TO GET THE ANSWER FROM THE USER AND ADD THAT TO THE BACKEND
 
-		
+
 
 
 
         return {
             "result": "success"
-        }
\ No newline at end of file
+        }
@@ -11,6 +11,8 @@ from restack_ai.workflow import workflow, log, workflow_info, import_functions
 with import_functions():
  
     from src.functions.RAG.ingestDocuments import ingest_documents_to_rag
+    from src.functions.cache.semanticCache import invalidate_semantic_cache
+    from src.services_config import step_options
 
     
 
@@ -34,12 +36,21 @@ class submit_answer_workflow:
         response = await workflow.step(
             ingest_documents_to_rag,
             input,
-            start_to_close_timeout=timedelta(minutes=2)
+            start_to_close_timeout=timedelta(minutes=2),
+            **step_options(ingest_documents_to_rag)
         )
 
 
         # find the query and to that add this response to the backend
 
+        # The cached answer for this question is stale now that there is a new one
+        await workflow.step(
+            invalidate_semantic_cache,
+            {"query": input["query"]},
+            start_to_close_timeout=timedelta(seconds=30),
+            **step_options(invalidate_semantic_cache)
+        )
+
 
        
 
@@ -0,0 +1,33 @@
+import time
+
+from src.functions.cache.retrievalCache import RetrievalCache
+
+
+def test_lookup_leaves_the_file_unlocked(tmp_path):
+    path = str(tmp_path / "retrieval_cache.sqlite3")
+    worker, other = RetrievalCache(path), RetrievalCache(path)
+
+    # A memory hit and a miss must not leave a write transaction open
+    assert worker.lookup("idx", "{}", "how do I deploy")[0] is None
+    worker._memory["key"] = ("idx", time.time(), "[]")
+    worker.lookup("idx", "{}", "how do I deploy")
+
+    assert other.invalidate("idx") == 1
+    key = other.lookup("idx", "{}", "how do I deploy")[1]
+    other.store(key, "idx", [])
+    assert worker.invalidate("idx") == 2
+
+
+def test_scheduled_invalidation_is_applied_once(tmp_path):
+    path = str(tmp_path / "retrieval_cache.sqlite3")
+    worker, other = RetrievalCache(path), RetrievalCache(path)
+
+    assert other.invalidate("idx", delay_seconds=0.05) == 0
+    worker.lookup("idx", "{}", "how do I deploy")
+    assert worker.invalidate("idx", delay_seconds=0.05) == 0
+
+    time.sleep(0.1)
+    worker.lookup("idx", "{}", "how do I deploy")
+    other.lookup("idx", "{}", "how do I deploy")
+    # Both scheduled bumps were due at the first lookup, which applied them as one
+    assert other.invalidate("idx") == 2
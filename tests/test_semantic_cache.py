@@ -0,0 +1,64 @@
+import numpy as np
+
+from src.functions.cache.semanticCache import SemanticCache
+
+
+# Stand-in for the embedding model: fixed unit vectors per question, the
+# paraphrase is close to the original and the opposite question isn't
+VECTORS = {
+    "how do i enable retries on a function": [1.0, 0.0, 0.0],
+    "what's the way to turn on retries for a function": [0.98, 0.199, 0.0],
+    "how do i disable retries on a function": [0.8, 0.0, 0.6],
+}
+
+
+def embed(text):
+    vector = np.asarray(VECTORS[text.lower()], dtype=np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def make_cache(tmp_path, **kwargs) -> SemanticCache:
+    return SemanticCache(path=str(tmp_path / "semantic_cache.sqlite3"), embed=embed, embedding_model="test", threshold=0.95, **kwargs)
+
+
+def test_exact_question_hits_without_a_model(tmp_path):
+    cache = SemanticCache(path=str(tmp_path / "semantic_cache.sqlite3"))
+    cache.store("How do I enable retries on a function?", {"rag_results": "Set a retry policy"})
+
+    hit = cache.lookup("how do i enable retries on a function")
+    assert hit["response"] == {"rag_results": "Set a retry policy"}
+    assert hit["similarity"] == 1.0
+    assert cache.lookup("What's the way to turn on retries for a function") is None
+
+
+def test_paraphrase_hits_above_the_threshold(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store("How do I enable retries on a function", {"rag_results": "Set a retry policy"})
+
+    hit = cache.lookup("What's the way to turn on retries for a function")
+    assert hit["query"] == "How do I enable retries on a function"
+    assert 0.95 <= hit["similarity"] < 1.0
+
+
+def test_different_question_below_the_threshold_misses(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store("How do I enable retries on a function", {"rag_results": "Set a retry policy"})
+
+    assert cache.lookup("How do I disable retries on a function") is None
+    assert cache.lookup("How do I disable retries on a function", threshold=0.75) is not None
+
+
+def test_vectors_of_another_model_are_not_compared(tmp_path):
+    make_cache(tmp_path).store("How do I enable retries on a function", {"rag_results": "Set a retry policy"})
+    other = SemanticCache(path=str(tmp_path / "semantic_cache.sqlite3"), embed=embed, embedding_model="other")
+
+    assert other.lookup("What's the way to turn on retries for a function") is None
+    assert other.lookup("How do I enable retries on a function") is not None
+
+
+def test_invalidate_drops_paraphrases(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store("How do I enable retries on a function", {"rag_results": "Set a retry policy"})
+
+    assert cache.invalidate("What's the way to turn on retries for a function") == 1
+    assert cache.lookup("How do I enable retries on a function") is None
@@ -0,0 +1,18 @@
+import pytest
+
+from src.utils.telemetry import llm_cost
+
+
+def test_llm_cost_prices_every_token_direction():
+    # 1M tokens each way: $3 input, $15 output, $0.30 cache read, $3.75 cache write
+    cost = llm_cost("claude-3-5-sonnet-20240620", 1_000_000, 1_000_000, 1_000_000, 1_000_000)
+    assert cost == pytest.approx(3.0 + 15.0 + 0.3 + 3.75)
+
+
+def test_llm_cost_defaults_cache_prices_from_the_input_price():
+    cost = llm_cost("gemini-2.0-flash-exp", 0, 0, cache_read_tokens=1_000_000, cache_write_tokens=1_000_000)
+    assert cost == pytest.approx(0.1 * 0.1 + 0.1 * 1.25)
+
+
+def test_llm_cost_is_unknown_for_unpriced_models():
+    assert llm_cost("mixtral-8x7b-instruct", 1000, 1000) is None